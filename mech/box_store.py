@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 Mike Kinney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+"""Store of extracted boxes (keyed by box digest) and creation of instance files from it."""
+
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import logging
+import os
+import shutil
+import sys
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (windows)
+    fcntl = None
+
+
+LOGGER = logging.getLogger('mech')
+
+# ioctl to make a file a copy-on-write clone of another (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Files of an extracted box that are only ever read (never changed by the hypervisor),
+# so instances can share them using hardlinks.
+READ_ONLY_FILES = ('*.ovf', '*.mf', 'metadata.json', 'info.json', 'Vagrantfile')
+
+
+def reflink(src, dst):
+    """Make dst a copy-on-write clone of src. Return False if the file system cannot."""
+    if sys.platform == 'darwin':
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            return libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0
+        except (AttributeError, OSError):
+            return False
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError as exc:
+            LOGGER.debug('no reflink for %s: %s', src, exc)
+    os.unlink(dst)
+    return False
+
+
+def data_segments(fd, size):
+    """Yield (start, end) of the parts of the file that have data (holes are skipped)."""
+    if not hasattr(os, 'SEEK_DATA'):
+        yield 0, size
+        return
+    position = 0
+    while position < size:
+        try:
+            start = os.lseek(fd, position, os.SEEK_DATA)
+        except OSError as exc:
+            if exc.errno == errno.ENXIO:
+                # no more data (the rest of the file is a hole)
+                return
+            # file system does not know about holes
+            yield position, size
+            return
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, end
+        position = end
+
+
+def copy_range(fsrc, fdst, start, end):
+    """Copy bytes start to end of fsrc to the same place in fdst."""
+    position = start
+    if hasattr(os, 'copy_file_range'):
+        # copy in the kernel (which can share the blocks on some file systems)
+        try:
+            while position < end:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), end - position,
+                                            position, position)
+                if not copied:
+                    break
+                position += copied
+            return
+        except OSError as exc:
+            LOGGER.debug('copy_file_range failed: %s', exc)
+    fsrc.seek(position)
+    fdst.seek(position)
+    while position < end:
+        data = fsrc.read(min(COPY_CHUNK_SIZE, end - position))
+        if not data:
+            break
+        fdst.write(data)
+        position += len(data)
+
+
+def sparse_copy(src, dst):
+    """Copy src to dst, keeping holes in sparse files (like disk images) as holes."""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        fdst.truncate(size)
+        for start, end in data_segments(fsrc.fileno(), size):
+            copy_range(fsrc, fdst, start, end)
+
+
+def clone_file(src, dst):
+    """Copy src to dst as cheaply as the file system allows."""
+    if not reflink(src, dst):
+        sparse_copy(src, dst)
+    shutil.copymode(src, dst)
+
+
+def link_file(src, dst):
+    """Hardlink src to dst (copy it if that is not possible)."""
+    try:
+        os.link(src, dst)
+    except OSError as exc:
+        LOGGER.debug('cannot hardlink %s: %s', src, exc)
+        clone_file(src, dst)
+
+
+def materialize(source, destination, link=READ_ONLY_FILES):
+    """Create the files of an instance in destination from the extracted box in source.
+
+       Files matching the patterns in link are hardlinked, the others
+       are cloned (reflink if possible, else a sparse copy).
+    """
+    LOGGER.debug('source:%s destination:%s', source, destination)
+    for root, dirnames, filenames in os.walk(source):
+        target = os.path.join(destination, os.path.relpath(root, source))
+        os.makedirs(target, exist_ok=True)
+        for dirname in dirnames:
+            os.makedirs(os.path.join(target, dirname), exist_ok=True)
+        for filename in filenames:
+            src = os.path.join(root, filename)
+            dst = os.path.join(target, filename)
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            if any(fnmatch.fnmatch(filename, pattern) for pattern in link):
+                link_file(src, dst)
+            else:
+                clone_file(src, dst)
+
+
+def add(extracted, path):
+    """Move the box extracted into the temporary directory extracted to path in the store.
+
+       If the box is already there (ex: added concurrently), extracted is removed.
+    """
+    try:
+        os.rename(extracted, path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+        shutil.rmtree(extracted, ignore_errors=True)
+    return path
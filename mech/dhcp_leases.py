@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 Mike Kinney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+"""Find the IP address of an instance in the host's DHCP lease databases.
+
+   VMware's DHCP server (vmnet*) writes ISC dhcpd.leases files and the
+   VirtualBox DHCP server of the host-only network (see
+   VBoxManage.add_hostonly_dhcp()) writes an xml file. The lease of an
+   instance is found by its MAC address, without asking the guest anything.
+   A lease found is remembered (in memory) until it expires.
+"""
+
+from __future__ import absolute_import
+
+import calendar
+import glob
+import logging
+import os
+import re
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+
+LOGGER = logging.getLogger('mech')
+
+VMWARE_LEASE_FILES = (
+    '/etc/vmware/vmnet*/dhcpd/dhcpd.leases',                    # linux
+    '/var/db/vmware/vmnet-dhcpd-vmnet*.leases',                 # macOS
+    os.path.join(os.environ.get('PROGRAMDATA', 'C:\\ProgramData'),
+                 'VMware', 'vmnetdhcp.leases'),                 # windows
+)
+VBOX_CONFIG_DIRS = ('~/.config/VirtualBox', '~/Library/VirtualBox', '~/.VirtualBox')
+VBOX_NETWORK = 'HostInterfaceNetworking-vboxnet0'
+
+_LOCK = threading.Lock()
+# mac -> (ip, expires)
+_LEASES = {}
+# path -> ((mtime, size), {mac: (ip, expires)})
+_FILES = {}
+
+_ISC_LEASE = re.compile(r'lease\s+([0-9.]+)\s*\{(.*?)\}', re.DOTALL)
+_ISC_TIME = re.compile(r'\b(starts|ends)\s+(?:\d\s+(\d{4}/\d\d/\d\d \d\d:\d\d:\d\d)|epoch\s+(\d+)'
+                       r'|(never))\s*;')
+_ISC_MAC = re.compile(r'hardware\s+ethernet\s+([0-9a-fA-F:]+)\s*;')
+
+
+def normalize_mac(mac):
+    """Return the MAC address in lower case, with colons (ex: '08:00:27:9d:5e:2f')."""
+    digits = re.sub(r'[^0-9a-f]', '', mac.lower())
+    if len(digits) != 12:
+        return None
+    return ':'.join(digits[i:i + 2] for i in range(0, 12, 2))
+
+
+def vmware_lease_files():
+    """Return the paths of the VMware DHCP lease files of this host."""
+    return sorted(path for pattern in VMWARE_LEASE_FILES for path in glob.glob(pattern))
+
+
+def vbox_lease_files(network=VBOX_NETWORK):
+    """Return the paths of the VirtualBox DHCP lease files of the network."""
+    paths = [os.path.join(os.path.expanduser(config_dir), '{}-Dhcpd.leases'.format(network))
+             for config_dir in VBOX_CONFIG_DIRS]
+    return [path for path in paths if os.path.isfile(path)]
+
+
+def parse_isc_leases(text):
+    """Parse an ISC dhcpd.leases file, return {mac: (ip, expires)}.
+
+       A MAC can have several leases, the one which started last is used.
+    """
+    leases = {}
+    started = {}
+    for ip_address, body in _ISC_LEASE.findall(text):
+        mac = _ISC_MAC.search(body)
+        if not mac:
+            continue
+        times = {'starts': 0, 'ends': float('inf')}
+        for name, date, epoch, never in _ISC_TIME.findall(body):
+            if date:
+                times[name] = calendar.timegm(time.strptime(date, '%Y/%m/%d %H:%M:%S'))
+            elif epoch:
+                times[name] = int(epoch)
+        mac = normalize_mac(mac.group(1))
+        if mac and times['starts'] >= started.get(mac, 0):
+            started[mac] = times['starts']
+            leases[mac] = (ip_address, times['ends'])
+    return leases
+
+
+def parse_vbox_leases(text):
+    """Parse a VirtualBox DHCP lease (xml) file, return {mac: (ip, expires)}."""
+    leases = {}
+    try:
+        root = ElementTree.fromstring(text)
+    except ElementTree.ParseError:
+        LOGGER.debug('cannot parse VirtualBox leases', exc_info=True)
+        return leases
+    for lease in root.iter('Lease'):
+        address = lease.find('Address')
+        lease_time = lease.find('Time')
+        mac = normalize_mac(lease.get('mac', ''))
+        if not mac or address is None or lease_time is None or \
+                lease.get('state', 'acked') != 'acked':
+            continue
+        try:
+            expires = int(lease_time.get('issued')) + int(lease_time.get('expiration'))
+        except (TypeError, ValueError):
+            continue
+        leases[mac] = (address.get('value'), expires)
+    return leases
+
+
+def read_leases(path, parse):
+    """Return the leases in the file (parsed again only when the file changed)."""
+    try:
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with _LOCK:
+            cached = _FILES.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        with open(path, errors='replace') as the_file:
+            leases = parse(the_file.read())
+    except OSError:
+        LOGGER.debug('cannot read leases from path:%s', path, exc_info=True)
+        return {}
+    with _LOCK:
+        _FILES[path] = (stamp, leases)
+    return leases
+
+
+def lookup(mac, paths, parse):
+    """Return the IP address leased to mac (in one of the lease files), None if there is none."""
+    mac = normalize_mac(mac or '')
+    if not mac:
+        return None
+    now = time.time()
+    with _LOCK:
+        cached = _LEASES.get(mac)
+    if cached and cached[1] > now:
+        return cached[0]
+    for path in paths:
+        lease = read_leases(path, parse).get(mac)
+        if lease and lease[1] > now:
+            LOGGER.debug('mac:%s ip:%s (from %s)', mac, lease[0], path)
+            with _LOCK:
+                _LEASES[mac] = lease
+            return lease[0]
+    return None
+
+
+def vmware_ip(mac):
+    """Return the IP address VMware's DHCP server leased to mac."""
+    return lookup(mac, vmware_lease_files(), parse_isc_leases)
+
+
+def vbox_ip(mac, network=VBOX_NETWORK):
+    """Return the IP address the VirtualBox DHCP server (of the network) leased to mac."""
+    return lookup(mac, vbox_lease_files(network), parse_vbox_leases)
@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 Mike Kinney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+"""HTTP access (shared session) and resumable (and segmented) downloads of boxes."""
+
+from __future__ import absolute_import
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import click
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+LOGGER = logging.getLogger('mech')
+
+# Number of segments downloaded at the same time (if the server supports ranges).
+DOWNLOAD_SEGMENTS = 4
+# Size of the pieces a download is split into. Completed pieces are recorded,
+# so at most this much is downloaded again after an interruption.
+DOWNLOAD_PIECE_SIZE = 16 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 60
+
+# Connections kept open per host, and retries of failed connections/requests.
+HTTP_POOL_SIZE = 16
+HTTP_RETRIES = 3
+HTTP_TIMEOUT = 30
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+# Checksum type for a checksum given without one (by length of the hex digest).
+CHECKSUM_TYPES = {32: 'md5', 40: 'sha1', 64: 'sha256', 96: 'sha384', 128: 'sha512'}
+
+
+class DownloadError(requests.RequestException):
+    """Download could not be completed."""
+
+
+class ChecksumError(Exception):
+    """Downloaded data does not match the expected checksum."""
+
+
+def parse_checksum(checksum):
+    """Return (checksum_type, hex digest) of a checksum like 'sha256:abcd...'.
+
+       The type can be left out, it is then guessed from the length of the digest.
+       Raises ValueError if the checksum is not valid.
+    """
+    checksum_type, _, digest = checksum.strip().rpartition(':')
+    digest = digest.lower()
+    checksum_type = checksum_type.lower() or CHECKSUM_TYPES.get(len(digest))
+    if checksum_type not in hashlib.algorithms_available or not re.match(r'^[0-9a-f]+$', digest):
+        raise ValueError('Invalid checksum: {}'.format(checksum))
+    return checksum_type, digest
+
+
+class Checksum():
+    """Checksum computed incrementally as data comes in."""
+
+    def __init__(self, checksum):
+        """Constructor - checksum is the expected checksum (ex: 'sha256:abcd...')."""
+        self.checksum_type, self.expected = parse_checksum(checksum)
+        self.hasher = hashlib.new(self.checksum_type)
+        self.position = 0
+
+    def update(self, data):
+        """Add data."""
+        self.hasher.update(data)
+        self.position += len(data)
+
+    def update_from_file(self, the_file, end):
+        """Add the data of the_file from the current position to end."""
+        the_file.seek(self.position)
+        while self.position < end:
+            data = the_file.read(min(DOWNLOAD_CHUNK_SIZE, end - self.position))
+            if not data:
+                break
+            self.update(data)
+
+    def verify(self, what):
+        """Raise ChecksumError if the data does not match the expected checksum."""
+        digest = self.hasher.hexdigest()
+        if digest != self.expected:
+            raise ChecksumError('{} checksum of {} is {}, expected {}'.format(
+                self.checksum_type, what, digest, self.expected))
+
+    def __str__(self):
+        """Return the checksum as 'type:digest'."""
+        return '{}:{}'.format(self.checksum_type, self.expected)
+
+
+def session():
+    """Return the shared requests.Session (connection pooling and retries)."""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            retries = Retry(total=HTTP_RETRIES, backoff_factor=0.5, raise_on_status=False,
+                            status_forcelist=(429, 500, 502, 503, 504))
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE,
+                                  max_retries=retries)
+            _SESSION = requests.Session()
+            _SESSION.mount('http://', adapter)
+            _SESSION.mount('https://', adapter)
+        return _SESSION
+
+
+def get(url, **kwargs):
+    """GET url using the shared session."""
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    return session().get(url, **kwargs)
+
+
+def offline():
+    """Return True if mech should not use the network (MECH_OFFLINE is set)."""
+    return os.environ.get('MECH_OFFLINE', '') not in ('', '0')
+
+
+def merge_ranges(ranges):
+    """Merge overlapping/adjacent [start, end) ranges."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def missing_pieces(length, done, piece_size=None):
+    """Return the [start, end) pieces of length that are not in the done ranges."""
+    if piece_size is None:
+        piece_size = DOWNLOAD_PIECE_SIZE
+    pieces = []
+    position = 0
+    for start, end in merge_ranges(done) + [[length, length]]:
+        while position < start:
+            pieces.append([position, min(start, position + piece_size)])
+            position = pieces[-1][1]
+        position = max(position, end)
+    return pieces
+
+
+def content_length(response):
+    """Return the total length of the resource (None if not known)."""
+    content_range = response.headers.get('content-range')
+    if content_range:
+        match = re.match(r'bytes \d+-\d+/(\d+)', content_range)
+        if match:
+            return int(match.group(1))
+    length = response.headers.get('content-length')
+    if response.status_code == 200 and length is not None and str(length).isdigit():
+        return int(length)
+    return None
+
+
+def validator(response):
+    """Return the value used to tell if the resource changed (ETag or Last-Modified)."""
+    return response.headers.get('etag') or response.headers.get('last-modified')
+
+
+class Download():
+    """Download of a url to a file.
+
+       Data is written to '<path>.part' and the completed ranges are recorded
+       in '<path>.part.json', so an interrupted download resumes where it stopped.
+       If the server supports HTTP ranges, the download is split in segments
+       that are downloaded in parallel. Otherwise it falls back to a single stream.
+    """
+
+    def __init__(self, url, path, segments=DOWNLOAD_SEGMENTS, checksum=None):
+        """Constructor. If checksum is given, the download is verified against it."""
+        self.url = url
+        self.path = path
+        self.part = path + '.part'
+        self.sidecar = path + '.part.json'
+        self.segments = max(1, segments)
+        self.lock = threading.Lock()
+        # set to stop the pieces being fetched (at their next chunk)
+        self.cancelled = threading.Event()
+        self.state = None
+        self.bar = None
+        self.checksum = Checksum(checksum) if checksum else None
+        self.checksum_lock = threading.Lock()
+
+    def load_state(self):
+        """Return the saved state of a previous download (or None)."""
+        try:
+            with open(self.sidecar) as the_file:
+                state = json.load(the_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if state.get('url') != self.url or not os.path.exists(self.part):
+            return None
+        return state
+
+    def save_state(self):
+        """Save the state (called with the lock held)."""
+        tmp = self.sidecar + '.tmp'
+        with open(tmp, 'w') as the_file:
+            json.dump(self.state, the_file)
+        os.replace(tmp, self.sidecar)
+
+    def progress(self, size):
+        """Update the progress bar with the number of bytes received."""
+        if self.bar is not None:
+            with self.lock:
+                self.bar.update(size)
+
+    def open_stream(self, save=True):
+        """Start downloading the url, to be read as it streams in.
+
+           Return a StreamReader, or None if the response is not a box (ex: a json
+           catalog) or an earlier attempt of this download can be resumed instead.
+        """
+        if self.load_state() is not None:
+            return None
+        response = get(self.url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        if response.headers.get('content-type') == 'application/json':
+            response.close()
+            return None
+        return StreamReader(self, response, save=save)
+
+    def start(self):
+        """Download the file. Return the content-type."""
+        saved = self.load_state()
+        response = get(self.url, stream=True, timeout=DOWNLOAD_TIMEOUT,
+                       headers={'Range': 'bytes=0-0'})
+        response.raise_for_status()
+        content_type = response.headers.get('content-type')
+        length = content_length(response)
+        ranges = response.status_code == 206 and length is not None
+        LOGGER.debug('url:%s status:%s length:%s content_type:%s',
+                     self.url, response.status_code, length, content_type)
+
+        if not ranges:
+            self.single_stream(response, length)
+        else:
+            response.close()
+            resumable = saved and saved.get('length') == length
+            if resumable and saved.get('validator') == validator(response):
+                self.state = saved
+                click.secho('Resuming download...', fg='blue')
+            else:
+                self.state = {'url': self.url, 'length': length,
+                              'validator': validator(response), 'done': []}
+                with open(self.part, 'wb'):
+                    pass
+            self.segmented(length)
+
+        self.verify()
+        os.replace(self.part, self.path)
+        if os.path.exists(self.sidecar):
+            os.unlink(self.sidecar)
+        return content_type
+
+    def verify(self):
+        """Check the part file against the checksum (if any). A corrupt download is removed."""
+        if self.checksum is None:
+            return
+        try:
+            self.checksum.verify(self.url)
+        except ChecksumError:
+            for path in (self.part, self.sidecar):
+                if os.path.exists(path):
+                    os.unlink(path)
+            raise
+
+    def update_checksum(self):
+        """Add the data downloaded contiguously from the start to the checksum."""
+        if self.checksum is None:
+            return
+        with self.checksum_lock:
+            with self.lock:
+                done = self.state['done']
+                end = done[0][1] if done and done[0][0] == 0 else 0
+            if self.checksum.position < end:
+                with open(self.part, 'rb') as the_file:
+                    self.checksum.update_from_file(the_file, end)
+
+    def single_stream(self, response, length):
+        """Download using one request (the server does not support ranges)."""
+        if response.status_code == 206:
+            response.close()
+            response = get(self.url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+            response.raise_for_status()
+        received = 0
+        with open(self.part, 'wb') as the_file:
+            with click.progressbar(length=length or 0, label='Downloading') as self.bar:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if chunk:
+                        the_file.write(chunk)
+                        if self.checksum is not None:
+                            self.checksum.update(chunk)
+                        received += len(chunk)
+                        self.progress(len(chunk))
+        if length is not None and received != length:
+            raise DownloadError('Received {} of {} bytes from {}'.format(
+                received, length, self.url))
+
+    def segmented(self, length):
+        """Download the missing pieces using up to self.segments requests at the same time."""
+        with open(self.part, 'r+b') as the_file:
+            the_file.truncate(length)
+        pieces = missing_pieces(length, self.state['done'])
+        done = length - sum(end - start for start, end in pieces)
+        with click.progressbar(length=length, label='Downloading') as self.bar:
+            self.progress(done)
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.segments)
+            futures = [pool.submit(self.get_piece, start, end) for start, end in pieces]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # stop at the first piece that cannot be downloaded (or on ctrl-c),
+                # without waiting: the pieces done so far are in the state, to resume
+                self.cancelled.set()
+                for future in futures:
+                    future.cancel()
+                raise
+            finally:
+                pool.shutdown(wait=False)
+        self.update_checksum()
+
+    def get_piece(self, start, end):
+        """Download the [start, end) piece, retrying on errors."""
+        attempt = 0
+        while True:
+            try:
+                self.fetch(start, end)
+                break
+            except requests.RequestException as exc:
+                attempt += 1
+                if attempt > DOWNLOAD_RETRIES or self.cancelled.is_set():
+                    raise
+                LOGGER.debug('piece:%s-%s attempt:%s error:%s', start, end, attempt, exc)
+                time.sleep(min(2 ** attempt, 30))
+        with self.lock:
+            self.state['done'] = merge_ranges(self.state['done'] + [[start, end]])
+            self.save_state()
+        # Note: pieces mostly complete in order, so this follows the download closely
+        self.update_checksum()
+
+    def fetch(self, start, end):
+        """Fetch the [start, end) piece and write it to the part file."""
+        response = get(self.url, stream=True, timeout=DOWNLOAD_TIMEOUT,
+                       headers={'Range': 'bytes={}-{}'.format(start, end - 1)})
+        response.raise_for_status()
+        if (response.status_code != 206 or not response.headers.get(
+                'content-range', '').startswith('bytes {}-'.format(start))):
+            raise DownloadError('Server did not return the range {}-{} of {}'.format(
+                start, end - 1, self.url))
+        position = start
+        with open(self.part, 'r+b') as the_file:
+            the_file.seek(start)
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if self.cancelled.is_set():
+                    raise DownloadError('Download of {} cancelled'.format(self.url))
+                if chunk:
+                    chunk = chunk[:end - position]
+                    the_file.write(chunk)
+                    position += len(chunk)
+                    self.progress(len(chunk))
+        if position != end:
+            # Note: the bytes of this piece are downloaded again
+            self.progress(start - position)
+            raise DownloadError('Received {} of {} bytes of range {}-{}'.format(
+                position - start, end - start, start, end - 1))
+
+
+class StreamReader():
+    """File-like object to read the body of a response as it streams in.
+
+       Everything read is also written to the part file of the download (unless
+       save is False), so the data only goes over the network and to disk once.
+       The sha256 digest of the body is computed as it goes by.
+    """
+
+    def __init__(self, download, response, save=True):
+        """Constructor."""
+        self.download = download
+        self.response = response
+        self.length = content_length(response)
+        self.validator = validator(response)
+        self.chunks = iter(response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE))
+        self.buffer = b''
+        self.offset = 0
+        self.received = 0
+        self.sha256 = hashlib.sha256()
+        self.the_file = open(download.part, 'wb') if save else None
+
+    def next_chunk(self):
+        """Return the next chunk of the body (b'' at the end)."""
+        for chunk in self.chunks:
+            if chunk:
+                if self.the_file is not None:
+                    self.the_file.write(chunk)
+                if self.download.checksum is not None:
+                    self.download.checksum.update(chunk)
+                self.sha256.update(chunk)
+                self.received += len(chunk)
+                self.download.progress(len(chunk))
+                return chunk
+        return b''
+
+    def read(self, size=-1):
+        """Read up to size bytes (everything that is left if size is negative)."""
+        parts = []
+        while size != 0:
+            if self.offset >= len(self.buffer):
+                self.buffer = self.next_chunk()
+                self.offset = 0
+                if not self.buffer:
+                    break
+            end = len(self.buffer) if size < 0 else self.offset + size
+            data = self.buffer[self.offset:end]
+            self.offset += len(data)
+            parts.append(data)
+            if size > 0:
+                size -= len(data)
+        return b''.join(parts)
+
+    def finish(self):
+        """Read what is left of the body and move the part file in place."""
+        while self.next_chunk():
+            pass
+        self.response.close()
+        if self.length is not None and self.received != self.length:
+            self.abort()
+            raise DownloadError('Received {} of {} bytes from {}'.format(
+                self.received, self.length, self.download.url))
+        if self.the_file is not None:
+            self.the_file.close()
+            self.download.verify()
+            os.replace(self.download.part, self.download.path)
+        elif self.download.checksum is not None:
+            self.download.checksum.verify(self.download.url)
+
+    def abort(self):
+        """Stop reading. Keep what was received so the download can be resumed."""
+        self.response.close()
+        if self.the_file is None or self.the_file.closed:
+            return
+        self.the_file.close()
+        if self.length is not None and self.validator and self.received:
+            self.download.state = {'url': self.download.url, 'length': self.length,
+                                   'validator': self.validator,
+                                   'done': [[0, self.received]]}
+            self.download.save_state()
+        else:
+            os.unlink(self.download.part)
+
+
+def download(url, path, segments=DOWNLOAD_SEGMENTS, checksum=None):
+    """Download url to path (resuming a previous attempt if possible).
+
+       If checksum is given (ex: 'sha256:abcd...'), the data is verified
+       as it comes in and ChecksumError is raised if it does not match.
+       Return the content-type of the response.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return Download(url, path, segments=segments, checksum=checksum).start()
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 Mike Kinney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+"""Stream of the state changes of instances (see 'mech events').
+
+   VMware instances are watched through their vmware.log: new lines are
+   matched with the patterns used by VMrun.vm_state() (the directory of
+   the log is watched with inotify on linux, elsewhere the log is checked
+   with a stat every interval). VirtualBox instances are checked every
+   interval, all at once, with 'VBoxManage list runningvms'. The instances
+   are also looked for every interval, so the ones created (or destroyed)
+   while watching are noticed.
+
+   Events are dicts like:
+       {"time": "2020-06-11T18:40:53Z", "instance": "first",
+        "provider": "vmware", "event": "started"}
+   with event one of started, stopped, paused, unpaused or ip (then with
+   an "ip" key: the instance got an IP address).
+"""
+
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+from . import readiness
+from . import utils
+from . import vmrun
+from .mech_instance import MechInstance
+from .vbm import VBoxManage
+
+
+LOGGER = logging.getLogger('mech')
+
+# seconds between checks of the VirtualBox instances (and of IP addresses)
+DEFAULT_INTERVAL = 2.0
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+_EVENT_HEADER = struct.Struct('iIII')
+
+_LIBC = None
+if sys.platform.startswith('linux'):
+    try:
+        _LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _LIBC.inotify_init1  # pylint: disable=pointless-statement
+    except (OSError, AttributeError):  # pragma: no cover
+        _LIBC = None
+
+
+def inotify_available():
+    """Return True if inotify can be used (linux)."""
+    return _LIBC is not None
+
+
+class Inotify():
+    """Watch directories for changes, with inotify."""
+
+    def __init__(self):
+        """Constructor - create the inotify instance."""
+        self.fd = _LIBC.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        self.watches = {}
+
+    def add_watch(self, path, mask=IN_MODIFY | IN_CREATE | IN_MOVED_TO):
+        """Watch the directory."""
+        wd = _LIBC.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch', path)
+        self.watches[wd] = path
+
+    def wait(self, timeout):
+        """Wait (at most timeout seconds) for changes, return the set of directories changed."""
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        while readable:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                wd, _, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size + length
+                if wd in self.watches:
+                    changed.add(self.watches[wd])
+        return changed
+
+    def close(self):
+        """Stop watching."""
+        os.close(self.fd)
+
+
+class LogTail():
+    """The new lines of a vmware.log (which is replaced when the VM starts)."""
+
+    def __init__(self, path):
+        """Constructor - start at the end of the log."""
+        self.path = path
+        self.inode = None
+        self.offset = 0
+        self.partial = b''
+        try:
+            stat = os.stat(path)
+            self.inode, self.offset = stat.st_ino, stat.st_size
+        except OSError:
+            pass
+
+    def states(self):
+        """Return the states found in the lines added since the last call (in order)."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return []
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            # a new log
+            self.inode, self.offset, self.partial = stat.st_ino, 0, b''
+        if stat.st_size == self.offset:
+            return []
+        with open(self.path, 'rb') as the_file:
+            the_file.seek(self.offset)
+            data = self.partial + the_file.read(stat.st_size - self.offset)
+        self.offset = stat.st_size
+        cut = data.rfind(b'\n') + 1
+        data, self.partial = data[:cut], data[cut:]
+        return [match.lastgroup for match in vmrun.VM_STATE_LINES.finditer(data)]
+
+
+def event(inst, name, **kwargs):
+    """Return an event (dict) of the instance."""
+    the_event = {'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                 'instance': inst.name, 'provider': inst.provider, 'event': name}
+    the_event.update(kwargs)
+    return the_event
+
+
+class Watcher():
+    """Watch instances, generating events as their state changes (see events())."""
+
+    def __init__(self, insts, interval=DEFAULT_INTERVAL):
+        """Constructor - note the current state of the (created) instances.
+
+           The instances created (or destroyed) later are noticed every interval.
+        """
+        self.interval = interval
+        self.candidates = list(insts)
+        self.insts = []
+        self.states = {}
+        # instance name -> (time of the next check, delays) for IP addresses not known yet
+        self.pending_ip = {}
+        self.tails = {}
+        self.vbm = VBoxManage()
+        self.vbox = []
+        self.vbox_installed = None
+        self.inotify = None
+        if any(inst.provider == 'vmware' for inst in self.candidates) and inotify_available():
+            try:
+                self.inotify = Inotify()
+            except OSError:
+                LOGGER.debug('cannot use inotify', exc_info=True)
+        for _ in self.refresh(initial=True):
+            pass
+
+    def refresh(self, initial=False):
+        """Start watching the instances created since the last check, stop watching
+           the ones destroyed, generating their events (none the first time).
+        """
+        running_vms = listed = None
+        for inst in self.candidates:
+            pattern = '*.vmx' if inst.provider == 'vmware' else '*.vbox'
+            found = utils.locate(inst.path, pattern)
+            if inst in self.insts:
+                if not found:
+                    self.insts.remove(inst)
+                    self.tails.pop(inst.name, None)
+                    if inst in self.vbox:
+                        self.vbox.remove(inst)
+                    self.pending_ip.pop(inst.name, None)
+                    inst.created = False
+                    inst.ip = None
+                    if self.states.pop(inst.name, None) != 'stopped':
+                        yield event(inst, 'stopped')
+                continue
+            if not found:
+                continue
+            inst.created = True
+            if inst.provider == 'vmware':
+                inst.vmx = found
+                path = os.path.join(os.path.dirname(found), 'vmware.log')
+                self.tails[inst.name] = LogTail(path)
+                state = vmrun.vmware_log_state(path)
+                if self.inotify is not None:
+                    try:
+                        self.inotify.add_watch(os.path.dirname(path))
+                    except OSError:
+                        LOGGER.debug('cannot watch %s', path, exc_info=True)
+            else:
+                inst.vbox = found
+                if self.vbox_installed is None:
+                    self.vbox_installed = self.vbm.installed()
+                if not self.vbox_installed:
+                    continue
+                if not listed:
+                    running_vms, listed = self.vbm.list_running(quiet=True), True
+                self.vbox.append(inst)
+                state = self.vbox_state(inst, running_vms)
+            self.insts.append(inst)
+            if initial or state is None:
+                self.baseline(inst, state)
+            else:
+                # a new instance: only its start is news
+                self.states[inst.name] = 'stopped'
+                if state != 'unknown':
+                    yield from self.transition(inst, state)
+
+    def baseline(self, inst, state):
+        """Note the state of the instance (None if not known yet), without an event."""
+        self.states[inst.name] = state
+        if state in ('started', 'unpaused'):
+            self.wait_for_ip(inst)
+
+    @staticmethod
+    def vbox_state(inst, running_vms):
+        """Return the state of the VirtualBox instance (None if running_vms is not known)."""
+        if running_vms is None:
+            return None
+        return 'started' if inst.name in running_vms else 'stopped'
+
+    def wait_for_ip(self, inst):
+        """Check for the IP address of the instance (from now on, with backoff)."""
+        inst.ip = None
+        self.pending_ip[inst.name] = (time.monotonic(),
+                                      readiness.delays(self.interval, 16 * self.interval))
+
+    def transition(self, inst, state):
+        """Generate the event of the instance (if its state changed)."""
+        if state == self.states.get(inst.name):
+            return
+        self.states[inst.name] = state
+        yield event(inst, state)
+        if state == 'stopped':
+            self.pending_ip.pop(inst.name, None)
+            inst.ip = None
+        elif state == 'started':
+            self.wait_for_ip(inst)
+
+    def check_logs(self, names):
+        """Generate the events found in the logs of the instances."""
+        for inst in self.insts:
+            if inst.name in names:
+                for state in self.tails[inst.name].states():
+                    yield from self.transition(inst, state)
+
+    def check_vbox(self):
+        """Generate the events of the VirtualBox instances (one 'list runningvms').
+
+           When VBoxManage fails, nothing is known (so nothing changed).
+        """
+        running_vms = self.vbm.list_running(quiet=True)
+        if running_vms is None:
+            return
+        for inst in self.vbox:
+            if self.states.get(inst.name) is None:
+                self.baseline(inst, self.vbox_state(inst, running_vms))
+            else:
+                yield from self.transition(inst, self.vbox_state(inst, running_vms))
+
+    def check_ips(self):
+        """Generate the events of the instances which got an IP address."""
+        now = time.monotonic()
+        for inst in self.insts:
+            if inst.name not in self.pending_ip or self.pending_ip[inst.name][0] > now:
+                continue
+            ip_address = inst.get_ip()
+            if ip_address:
+                del self.pending_ip[inst.name]
+                yield event(inst, 'ip', ip=ip_address)
+            else:
+                delays = self.pending_ip[inst.name][1]
+                self.pending_ip[inst.name] = (now + next(delays), delays)
+
+    def events(self):
+        """Generate the events, as they happen (forever)."""
+        next_check = time.monotonic()
+        try:
+            while True:
+                if self.inotify is not None:
+                    changed = self.inotify.wait(max(next_check - time.monotonic(), 0))
+                    names = [name for name, tail in self.tails.items()
+                             if os.path.dirname(tail.path) in changed]
+                else:
+                    time.sleep(max(next_check - time.monotonic(), 0))
+                    names = list(self.tails)
+                yield from self.check_logs(names)
+                if time.monotonic() >= next_check:
+                    next_check = time.monotonic() + self.interval
+                    yield from self.refresh()
+                    if self.vbox:
+                        yield from self.check_vbox()
+                    yield from self.check_ips()
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+
+
+def watch(insts=None, interval=DEFAULT_INTERVAL):
+    """Generate the events of the instances (forever), see Watcher.
+
+       insts are MechInstances or names of instances (default: all the
+       instances in the Mechfile).
+    """
+    if insts is None:
+        insts = utils.instances()
+    if any(isinstance(inst, str) for inst in insts):
+        mechfile = utils.load_mechfile()
+        insts = [MechInstance(inst, mechfile) if isinstance(inst, str) else inst
+                 for inst in insts]
+    return Watcher(insts, interval).events()
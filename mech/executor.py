@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 Mike Kinney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+"""Run an operation on a set of instances (optionally in parallel)."""
+
+from __future__ import absolute_import
+
+import collections
+import concurrent.futures
+import contextlib
+import logging
+import sys
+import threading
+import time
+
+import click
+
+
+LOGGER = logging.getLogger('mech')
+
+# Default max number of instances in each stage of a pipeline at the same time.
+DEFAULT_STAGE_LIMITS = {'download': 2, 'extract': 2, 'boot': 4, 'provision': 8}
+
+
+class PrefixedOutput():
+    """File-like object used in place of sys.stdout while instances are worked on.
+
+       Each line written by a worker thread is prefixed with the name of the
+       instance that thread is working on, so output of concurrent operations
+       can be told apart. Writes from other threads are passed through as is.
+    """
+
+    def __init__(self, stream, prefixed=True):
+        """Constructor - wrap stream (usually the original sys.stdout).
+
+           With prefixed=False, lines are not prefixed (only copied to the log files).
+        """
+        self.stream = stream
+        self.prefixed = prefixed
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def register(self, prefix, log=None):
+        """Prefix all lines written by the current thread with prefix (and copy them to log)."""
+        self.local.prefix = prefix
+        self.local.buffer = ''
+        self.local.log = log
+
+    def unregister(self):
+        """Stop prefixing lines written by the current thread."""
+        if getattr(self.local, 'buffer', ''):
+            self.write('\n')
+        self.local.prefix = None
+        self.local.log = None
+
+    def write(self, data):
+        """Write data, prefixing each complete line if needed."""
+        prefix = getattr(self.local, 'prefix', None)
+        if prefix is None:
+            with self.lock:
+                return self.stream.write(data)
+        lines = (self.local.buffer + data).split('\n')
+        self.local.buffer = lines.pop()
+        if lines:
+            with self.lock:
+                if self.local.log is not None:
+                    for line in lines:
+                        self.local.log.write('{}\n'.format(click.unstyle(line)))
+                for line in lines:
+                    if self.prefixed:
+                        self.stream.write('{}: {}\n'.format(prefix, line))
+                    else:
+                        self.stream.write('{}\n'.format(line))
+        return len(data)
+
+    def flush(self):
+        """Flush the wrapped stream."""
+        with self.lock:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        """Everything else (encoding, isatty, ...) comes from the wrapped stream."""
+        return getattr(self.stream, name)
+
+
+def inherit_output(func):
+    """Wrap func so that, run in another thread, it writes its output like the current thread.
+
+       (with the same prefix and log file, see PrefixedOutput)
+    """
+    output = sys.stdout
+    if not isinstance(output, PrefixedOutput) or getattr(output.local, 'prefix', None) is None:
+        return func
+    prefix, log = output.local.prefix, output.local.log
+
+    def wrapper(*args, **kwargs):
+        output.register(prefix, log)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            output.unregister()
+    return wrapper
+
+
+class InstanceResult():
+    """Outcome of running an operation on one instance."""
+
+    def __init__(self, name, ok=False, duration=0.0, error=None, log=None):
+        """Constructor."""
+        self.name = name
+        self.ok = ok
+        self.duration = duration
+        self.error = error
+        self.log = log
+
+    def __repr__(self):
+        """Return a representation of the result."""
+        return 'InstanceResult(name={} ok={} duration={:.1f} error={})'.format(
+            self.name, self.ok, self.duration, self.error)
+
+
+def run_operation(name, operation, output=None, log=None):
+    """Run operation(name) and return an InstanceResult.
+
+       The operation returns False (or raises/exits) when it did not succeed.
+       If log (a path) is given, the output is also written to that file.
+    """
+    log_file = None
+    if output is not None:
+        if log is not None:
+            log_file = open(log, 'w')
+        output.register(name, log_file)
+    start = time.time()
+    result = InstanceResult(name, log=log if log_file is not None else None)
+    try:
+        result.ok = operation(name) is not False
+    except SystemExit as exc:
+        # Note: most of mech reports errors using sys.exit()
+        if exc.code not in (None, 0):
+            result.error = str(exc.code)
+            click.echo(result.error)
+        else:
+            result.ok = True
+    except Exception as exc:  # pylint: disable=broad-except
+        LOGGER.debug('name:%s', name, exc_info=True)
+        result.error = '{}: {}'.format(exc.__class__.__name__, exc)
+        click.secho(result.error, fg='red')
+    finally:
+        result.duration = time.time() - start
+        if output is not None:
+            output.unregister()
+        if log_file is not None:
+            log_file.close()
+    return result
+
+
+def run_on_instances(names, operation, parallel=1, log=None):
+    """Run operation(name) for each instance name using up to parallel workers.
+
+    Args:
+        names (list of str): names of the instances
+        operation (function): called with the name of the instance, returns False on failure
+        parallel (int): max number of instances to work on at the same time
+        log (function): called with the name of the instance, returns the path of
+                        the file to also write its output to (or None)
+
+    Returns:
+        list of InstanceResult (in the same order as names)
+
+    Notes:
+        When there is more than one instance, each line of output is prefixed
+        with the name of the instance.
+    """
+    if parallel is None or parallel < 1:
+        parallel = 1
+    if len(names) < 2 and log is None:
+        return [run_operation(name, operation) for name in names]
+
+    def run(name):
+        return run_operation(name, operation, output, log(name) if log else None)
+
+    original_stdout = sys.stdout
+    output = PrefixedOutput(original_stdout, prefixed=len(names) > 1)
+    sys.stdout = output
+    try:
+        if parallel == 1:
+            return [run(name) for name in names]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as pool:
+            futures = [pool.submit(run, name) for name in names]
+            return [future.result() for future in futures]
+    finally:
+        sys.stdout = original_stdout
+
+
+def print_summary(results):
+    """Print a table of the results (if there was more than one instance)."""
+    if len(results) < 2:
+        return
+    logs = any(result.log for result in results)
+    click.echo()
+    header = ('NAME'.rjust(20), 'RESULT'.rjust(8), 'DURATION'.rjust(10), '\tLOG' if logs else '')
+    click.echo('{}\t{}\t{}{}'.format(*header))
+    for result in results:
+        click.secho('{}\t{}\t{}{}'.format(
+            result.name.rjust(20),
+            ('ok' if result.ok else 'FAILED').rjust(8),
+            '{:.1f}s'.format(result.duration).rjust(10),
+            '\t{}'.format(result.log or '') if logs else '',
+        ), fg='green' if result.ok else 'red')
+
+
+def exit_on_failure(results):
+    """Exit with a non-zero exit code if the operation failed on any instance."""
+    failed = [result.name for result in results if not result.ok]
+    if failed:
+        if len(results) > 1:
+            sys.exit(click.style('Failed on {} of {} instances: {}'.format(
+                len(failed), len(results), ', '.join(failed)), fg='red'))
+        sys.exit(1)
+
+
+def finish(results):
+    """Print the summary and exit non-zero if any instance failed."""
+    print_summary(results)
+    exit_on_failure(results)
+
+
+def parse_stage_limits(values):
+    """Parse values like ('download=1', 'boot=8') into a dict of stage limits."""
+    limits = dict(DEFAULT_STAGE_LIMITS)
+    for value in values or []:
+        stage, _, limit = value.partition('=')
+        if stage not in DEFAULT_STAGE_LIMITS or not limit.isdigit() or int(limit) < 1:
+            sys.exit(click.style("Invalid stage limit '{}' (expected STAGE=N where STAGE "
+                                 "is one of: {})".format(value, ', '.join(DEFAULT_STAGE_LIMITS)),
+                                 fg="red"))
+        limits[stage] = int(limit)
+    return limits
+
+
+def dependency_order(names, depends_on, circular="Circular 'depends_on' between instances"):
+    """Return names ordered so that each instance comes after the instances it depends on.
+
+       depends_on is a dict of name to a list of names. Dependencies that are not
+       in names are ignored. The original order is kept where possible.
+       Exits with the circular message if there is a cycle.
+    """
+    ordered = []
+    visiting = []
+
+    def visit(name):
+        if name in ordered:
+            return
+        if name in visiting:
+            sys.exit(click.style("{}: {}".format(
+                circular, ' -> '.join(str(node) for node in
+                                      visiting[visiting.index(name):] + [name])), fg="red"))
+        visiting.append(name)
+        for dependency in depends_on.get(name) or []:
+            if dependency in names:
+                visit(dependency)
+        visiting.pop()
+        ordered.append(name)
+
+    for name in names:
+        visit(name)
+    return ordered
+
+
+def run_graph(nodes, depends_on, operation, parallel=1, fail_fast=True):
+    """Run operation(node) for each node once the nodes it depends on have succeeded.
+
+    Args:
+        nodes (list): the nodes, in the order to start them in (when they are ready)
+        depends_on (dict): node to the list of nodes it depends on (others are ignored)
+        operation (function): called with the node, returns False on failure
+        parallel (int): max number of nodes to run at the same time
+        fail_fast (bool): start no other node once a node has failed
+
+    Returns:
+        dict of node to True/False (nodes which were not run are missing)
+
+    Notes:
+        The nodes depending (even indirectly) on a failed node are never started.
+    """
+    parallel = max(parallel or 1, 1)
+    operation = inherit_output(operation)
+    results = {}
+    pending = list(nodes)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as pool:
+        while pending or running:
+            if fail_fast and False in results.values():
+                pending = []
+            for node in list(pending):
+                if len(running) >= parallel:
+                    break
+                if all(results.get(dependency, dependency not in nodes)
+                       for dependency in depends_on.get(node) or []):
+                    pending.remove(node)
+                    running[pool.submit(operation, node)] = node
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(running,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result() is not False
+    return results
+
+
+class Batcher():
+    """Do the same work (by key) for the instances working at the same time, once.
+
+       Instances say when they start() and finish() working. run(key, name, value)
+       waits until each working instance which may run key (a candidate) has called
+       run() for it too (or is itself waiting in run() for something else). Then
+       operation(key, values) is called once with the values of all of them.
+    """
+
+    def __init__(self, operation, candidates):
+        """Constructor.
+
+        Args:
+            operation (function): called with the key and a dict of name to value,
+                                  returns a dict of name to result
+            candidates (dict): key to the names of the instances which may run it
+        """
+        self.operation = operation
+        self.candidates = candidates
+        self.condition = threading.Condition()
+        self.working = set()
+        self.waiting = collections.Counter()
+        self.arrived = {}
+        self.results = {}
+
+    def start(self, name):
+        """The instance is working (so may call run())."""
+        with self.condition:
+            self.working.add(name)
+            self.condition.notify_all()
+
+    def finish(self, name):
+        """The instance is not working anymore."""
+        with self.condition:
+            self.working.discard(name)
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def working_on(self, name):
+        """Context manager for the time the instance is working."""
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.finish(name)
+
+    def ready(self, key):
+        """Return True if no other candidate for key has to be waited for."""
+        arrived = self.arrived.get(key, {})
+        return all(name in arrived or name not in self.working or self.waiting[name]
+                   for name in self.candidates.get(key, ()))
+
+    def run(self, key, name, value):
+        """Run the work for key (together with the other instances). Return the result."""
+        with self.condition:
+            self.arrived.setdefault(key, {})[name] = value
+            self.waiting[name] += 1
+            self.condition.notify_all()
+            try:
+                while (key, name) not in self.results:
+                    if name in self.arrived.get(key, {}) and self.ready(key):
+                        batch = self.arrived.pop(key)
+                        break
+                    self.condition.wait()
+                else:
+                    return self.results.pop((key, name))
+            finally:
+                self.waiting[name] -= 1
+                self.condition.notify_all()
+
+        LOGGER.debug('key:%s names:%s', key, sorted(batch))
+        results = {}
+        try:
+            results = self.operation(key, batch)
+            return results.get(name)
+        finally:
+            with self.condition:
+                for other in batch:
+                    if other != name:
+                        self.results[(key, other)] = results.get(other)
+                self.condition.notify_all()
+
+
+class Pipeline():
+    """Work on instances concurrently, with a limit on the number of instances in each stage.
+
+       The operation uses stage() around each step, once() for work that is shared
+       between instances (ex: downloading a box) and wait_for() to wait until
+       the instances it depends on are done.
+    """
+
+    def __init__(self, limits=None):
+        """Constructor."""
+        self.limits = dict(DEFAULT_STAGE_LIMITS)
+        self.limits.update(limits or {})
+        self.semaphores = {stage: threading.BoundedSemaphore(limit)
+                           for stage, limit in self.limits.items()}
+        self.lock = threading.Lock()
+        self.shared = {}
+        self.done = {}
+        self.results = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager to run a stage of the pipeline."""
+        semaphore = self.semaphores.get(name)
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            LOGGER.debug('stage:%s started', name)
+            yield
+            LOGGER.debug('stage:%s finished', name)
+
+    def once(self, key, func, stage=None):
+        """Call func() once for key. Concurrent callers wait for (and share) the result.
+
+           With stage, func() is run in that stage: only the caller running it
+           holds a slot of the stage, not the callers waiting for it.
+        """
+        with self.lock:
+            entry = self.shared.setdefault(key, {'lock': threading.Lock()})
+        with entry['lock']:
+            if 'result' not in entry:
+                with self.stage(stage):
+                    entry['result'] = func()
+            return entry['result']
+
+    def wait_for(self, names):
+        """Wait until the instances in names are done. Return the names of those that failed."""
+        failed = []
+        for name in names or []:
+            event = self.done.get(name)
+            if event is None:
+                continue
+            event.wait()
+            if not self.results.get(name):
+                failed.append(name)
+        return failed
+
+    def run(self, names, operation, parallel=1, log=None):
+        """Run operation(name) for each instance, see run_on_instances()."""
+        for name in names:
+            self.done[name] = threading.Event()
+
+        def tracked(name):
+            ok = False
+            try:
+                ok = operation(name) is not False
+                return ok
+            finally:
+                self.results[name] = ok
+                self.done[name].set()
+
+        return run_on_instances(names, tracked, parallel, log)
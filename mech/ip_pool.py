@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 Mike Kinney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+"""Fixed IP addresses for the instances on the host-only network.
+
+   Instances with 'static_ip' in the Mechfile get an address from a subnet
+   ('ip_subnet', default 192.168.56.0/24), which is remembered in
+   ~/.mech/ip_pool.json. The host-only network is shared by every Mechfile
+   on the host, so is the pool: instances are known by their directory
+   (.mech/<name>) and the file is locked while it is changed.
+   The host has the first address of the subnet and the DHCP server hands
+   out the addresses at offsets 100 to 200 (as it did before there was a
+   pool), the others can be given to instances.
+   A larger subnet (ex: 192.168.56.0/22) makes room for more instances.
+"""
+
+from __future__ import absolute_import
+
+import contextlib
+import ipaddress
+import json
+import logging
+import os
+import sys
+import threading
+
+import click
+
+from . import utils
+
+
+LOGGER = logging.getLogger('mech')
+
+DEFAULT_SUBNET = '192.168.56.0/24'
+# offsets (in the subnet) of the first and last address handed out by the DHCP server
+DHCP_RANGE = (100, 200)
+
+_LOCK = threading.Lock()
+
+
+def state_file():
+    """Return the full path of the file the addresses given to instances are saved in."""
+    return os.path.join(os.path.expanduser('~'), '.mech', 'ip_pool.json')
+
+
+def instance_key(name):
+    """Return the key of the instance in the pool (its directory, unique on the host)."""
+    return os.path.join(os.path.abspath(utils.mech_dir()), name)
+
+
+@contextlib.contextmanager
+def locked():
+    """Hold the pool (in this process and, where possible, in the other mech processes)."""
+    with _LOCK, utils.file_lock(state_file() + '.lock'):
+        yield
+
+
+def load():
+    """Return the saved state ({'subnet': ..., 'addresses': {name: address}})."""
+    try:
+        with open(state_file()) as the_file:
+            state = json.load(the_file)
+    except (IOError, OSError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def save(state):
+    """Save the state."""
+    path = state_file()
+    utils.makedirs(os.path.dirname(path))
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as the_file:
+        json.dump(state, the_file, sort_keys=True, indent=2)
+    os.replace(tmp_path, path)
+
+
+def network(subnet):
+    """Return the ipaddress network of subnet (exits if it cannot be used)."""
+    try:
+        net = ipaddress.IPv4Network(subnet, strict=False)
+    except ValueError:
+        sys.exit(click.style("Invalid 'ip_subnet': {}".format(subnet), fg="red"))
+    if net.prefixlen > 24:
+        sys.exit(click.style("The 'ip_subnet' must be a /24 or larger: {}".format(subnet),
+                             fg="red"))
+    return net
+
+
+def dhcp_settings(subnet=None):
+    """Return the settings of the host-only network (and its DHCP server) for subnet.
+
+       Ex: {'ip': '192.168.56.1', 'netmask': '255.255.255.0',
+            'lower_ip': '192.168.56.100', 'upper_ip': '192.168.56.200'}
+    """
+    net = network(subnet or DEFAULT_SUBNET)
+    return {'ip': str(net[1]), 'netmask': str(net.netmask),
+            'lower_ip': str(net[DHCP_RANGE[0]]), 'upper_ip': str(net[DHCP_RANGE[1]])}
+
+
+def reserved(net, address):
+    """Return True if the address cannot be given to an instance."""
+    offset = int(address) - int(net.network_address)
+    return offset in (0, 1, net.num_addresses - 1) or DHCP_RANGE[0] <= offset <= DHCP_RANGE[1]
+
+
+def subnet():
+    """Return the subnet of the pool."""
+    return load().get('subnet') or DEFAULT_SUBNET
+
+
+def address(name):
+    """Return the address given to the instance, None if there is none."""
+    return load().get('addresses', {}).get(instance_key(name))
+
+
+def allocate(name, ip_subnet=None, wanted=None):
+    """Give an address to the instance (the first free one, or wanted) and return it.
+
+       An instance keeps its address until it is released.
+    """
+    key = instance_key(name)
+    with locked():
+        state = load()
+        addresses = state.setdefault('addresses', {})
+        ip_subnet = ip_subnet or state.get('subnet') or DEFAULT_SUBNET
+        if addresses and state.get('subnet', DEFAULT_SUBNET) != ip_subnet:
+            sys.exit(click.style("All instances must use the same 'ip_subnet' ({})".format(
+                state.get('subnet', DEFAULT_SUBNET)), fg="red"))
+        if key in addresses and wanted in (None, addresses[key]):
+            return addresses[key]
+
+        net = network(ip_subnet)
+        used = set(a_address for a_key, a_address in addresses.items() if a_key != key)
+        if wanted:
+            try:
+                the_address = ipaddress.IPv4Address(wanted)
+            except ValueError:
+                the_address = None
+            if the_address is None or the_address not in net or reserved(net, the_address) \
+                    or wanted in used:
+                sys.exit(click.style("Cannot give {} to instance '{}' (not in {}, reserved "
+                                     "or in use)".format(wanted, name, ip_subnet), fg="red"))
+        else:
+            the_address = next((host for host in net.hosts()
+                                if not reserved(net, host) and str(host) not in used), None)
+            if the_address is None:
+                sys.exit(click.style("No free IP address left in {} (use a larger "
+                                     "'ip_subnet')".format(ip_subnet), fg="red"))
+        LOGGER.debug('name:%s address:%s', name, the_address)
+        addresses[key] = str(the_address)
+        state['subnet'] = ip_subnet
+        save(state)
+        return addresses[key]
+
+
+def release(name):
+    """Forget the address given to the instance (so it can be given to another one)."""
+    with locked():
+        state = load()
+        if state.get('addresses', {}).pop(instance_key(name), None) is not None:
+            save(state)
@@ -23,6 +23,7 @@
 # IN THE SOFTWARE.
 #
 '''Mech cli functionality.'''
+import json
 import logging
 import os
 import platform
@@ -32,6 +33,11 @@ import sys
 
 import click
 
+from . import event_stream
+from . import executor
+from . import ip_pool
+from . import readiness
+from . import ssh_pool
 from . import utils
 from .mech_instance import MechInstance
 from .vmrun import VMrun
@@ -56,9 +62,14 @@ class MechAliasedGroup(click.Group):
 @click.group(context_settings=utils.context_settings(), cls=MechAliasedGroup)
 @click.option('--debug', is_flag=True, default=False)
 @click.option('--cloud')
+@click.option('--offline', is_flag=True, default=False,
+              help='Do not use the network (only cached catalogs and boxes).')
+@click.option('--ssh-transport', type=click.Choice(ssh_pool.SSH_TRANSPORTS), default=None,
+              help='Use ssh/scp commands (openssh, the default) or connections '
+              'kept in process (paramiko) to talk to instances.')
 @click.version_option(version=__version__, message='%(prog)s v%(version)s')
 @click.pass_context
-def cli(ctx, debug, cloud):
+def cli(ctx, debug, cloud, offline, ssh_transport):
     '''Mech is a command line utility for virtual machine automation.
 
     Create, start, stop, destroy virtual machines (aka instances) with ease.
@@ -77,7 +88,18 @@ def cli(ctx, debug, cloud):
     if debug:
         click.echo('Debug is on')
         LOGGER.setLevel(logging.DEBUG)
-        LOGGER.debug('cloud:%s', cloud)
+        LOGGER.debug('cloud:%s offline:%s ssh_transport:%s', cloud, offline, ssh_transport)
+
+    if offline:
+        # Note: also seen by code that does not have the context (see download.offline())
+        os.environ['MECH_OFFLINE'] = '1'
+
+    if ssh_transport:
+        # Note: also seen by code that does not have the context (see ssh_pool.enabled())
+        os.environ['MECH_SSH_TRANSPORT'] = ssh_transport
+        if ssh_transport == 'paramiko' and not ssh_pool.available():
+            click.secho("The 'paramiko' ssh transport needs paramiko "
+                        "(pip install paramiko), using ssh instead.", fg="yellow")
 
     # ensure that ctx.obj exists and is a dict
     ctx.ensure_object(dict)
@@ -120,13 +142,12 @@ def list(ctx, detail, instance):
     LOGGER.debug('instances:%s', instances)
     mechfiles = utils.load_mechfile()
     LOGGER.debug('mechfiles:%s', mechfiles)
-    for name in instances:
+    insts = [MechInstance(name, mechfiles) for name in instances]
+    # Note: rows are printed as soon as each instance resolves
+    for inst, ip_address, vm_state in utils.fleet_state(insts):
+        name = inst.name
         LOGGER.debug('name:%s', name)
-        inst = MechInstance(name, mechfiles)
-        vm_state = 'unknown'
         if inst.created:
-            ip_address = inst.get_ip()
-            vm_state = inst.get_vm_state()
             if vm_state is None:
                 vm_state = 'unknown'
             if ip_address is None:
@@ -235,8 +256,16 @@ def port(ctx, instance):
 @cli.command()
 @click.argument('instance', required=False)
 @click.option('-s', '--show-only', is_flag=True, default=False)
+@click.option('--force', is_flag=True, default=False,
+              help='Run all entries (even the unchanged ones).')
+@click.option('--only', type=click.IntRange(min=1), metavar='N',
+              help='Only run entry N (starting at 1).')
+@click.option('--from', 'start', type=click.IntRange(min=1), metavar='N',
+              help='Run entry N and the ones after it.')
+@click.option('--parallel', '-j', metavar='N', type=int, default=1,
+              help='Number of instances to provision at the same time.')
 @click.pass_context
-def provision(ctx, instance, show_only):
+def provision(ctx, instance, show_only, force, only, start, parallel):
     '''
     Provision the instance(s).
 
@@ -246,6 +275,12 @@ def provision(ctx, instance, show_only):
 
     'shell' or 'ps' can be inline.
 
+    A 'file' source can also be a directory or a glob (then the destination is a
+    directory). Consecutive 'file' entries are copied using one tar stream.
+
+    With '"stdin": true', a 'shell' script is sent to 'bash -s' in the instance
+    (one ssh command, no temporary files) instead of being copied there first.
+
     'shell', 'ps', and 'pyinfra' can have a remote endpoint ('http', 'https', 'ftp') for the script.
     (ex: 'http://example.com/somefile.sh' or ex: 'ftp://foo.com/install.sh')
 
@@ -254,13 +289,28 @@ def provision(ctx, instance, show_only):
 
     Provisioning is run when the instance is started or you can re-run the provisioning.
 
+    Entries (with their files, scripts and args) unchanged since the last successful
+    run are skipped: after editing one script, only it and the entries after it are
+    run. Use --force, --only N or --from N to choose the entries to run.
+
+    Entries are run in order. An entry with an 'after' list (of the 'id' of
+    other entries, can be empty) only waits for those entries, so independent
+    entries run at the same time (up to 'provision_parallel' of the instance,
+    default 4).
+
+    With '--parallel N', up to N instances are provisioned at the same time.
+    The output of each instance is also saved in .mech/<instance>/logs/.
+    A 'pyinfra' entry (same script and args) of instances provisioned at the
+    same time is run once for all of them (with an inventory of the instances).
+
     An example of provisioning could be installing puppet (or your config tool of choice)
     or preparing the instance "just the way you want it".
 
     '''
 
     cloud_name = ctx.obj['cloud_name']
-    LOGGER.debug('cloud_name:%s show_only:%s instance:%s', cloud_name, show_only, instance)
+    LOGGER.debug('cloud_name:%s show_only:%s instance:%s force:%s only:%s start:%s '
+                 'parallel:%s', cloud_name, show_only, instance, force, only, start, parallel)
 
     if cloud_name:
         utils.cloud_run(cloud_name, ['provision'])
@@ -273,59 +323,155 @@ def provision(ctx, instance, show_only):
         # multiple instances
         instances = utils.instances()
 
-    for an_instance in instances:
+    # pyinfra entries shared by instances provisioned at the same time are run once
+    batcher = utils.pyinfra_batcher([MechInstance(name) for name in instances])
+    for an_instance in instances[:max(parallel, 1)]:
+        batcher.start(an_instance)
+
+    def provision_instance(an_instance):
         inst = MechInstance(an_instance)
 
-        if inst.created:
-            utils.provision(inst, show_only)
-        else:
-            click.echo('VM not created.')
+        with batcher.working_on(an_instance):
+            if inst.created:
+                return utils.provision(inst, show_only, force=force, only=only, start=start,
+                                       batcher=batcher)
+        click.echo('VM not created.')
+        return True
+
+    executor.finish(executor.run_on_instances(
+        instances, provision_instance, parallel,
+        log=None if show_only else lambda name: utils.log_file(name, 'provision')))
 
 
 @cli.command()
-@click.argument('instance', required=True)
+@click.argument('instance', required=False)
+@click.option('--wait', is_flag=True, default=False,
+              help='Wait for the IP address (at most ready_timeout seconds, from the Mechfile).')
 @click.pass_context
-def ip(ctx, instance):
+def ip(ctx, instance, wait):
     '''
     Outputs the IP address of the instance.
+
+    If no instance is specified, the IP addresses of all instances are shown.
+    With '--wait', all instances are waited for at the same time, each
+    shown as soon as its IP address is known.
     '''
 
     cloud_name = ctx.obj['cloud_name']
-    LOGGER.debug('cloud_name:%s instance:%s', cloud_name, instance)
+    LOGGER.debug('cloud_name:%s instance:%s wait:%s', cloud_name, instance, wait)
 
     if cloud_name:
         utils.cloud_run(cloud_name, ['ip', 'ip_address'])
         return
 
-    inst = MechInstance(instance)
+    if instance:
+        inst = MechInstance(instance)
 
-    if inst.created:
-        ip_address = inst.get_ip()
-        if ip_address:
-            click.secho(ip_address, fg='green')
+        if inst.created:
+            ip_address = inst.get_ip(wait=wait)
+            if ip_address:
+                click.secho(ip_address, fg='green')
+            else:
+                click.secho('Unknown IP address', fg='red')
         else:
-            click.secho('Unknown IP address', fg='red')
+            click.secho('VM not created', fg='yellow')
+        return
+
+    insts = []
+    for an_instance in utils.instances():
+        inst = MechInstance(an_instance)
+        if inst.created:
+            insts.append(inst)
+        else:
+            click.secho('{} VM not created'.format(inst.name), fg='yellow')
+    if wait:
+        results = readiness.wait_for_ips(insts)
     else:
-        click.secho('VM not created', fg='yellow')
+        results = ((inst, inst.get_ip()) for inst in insts)
+    for inst, ip_address in results:
+        if ip_address:
+            click.secho('{} {}'.format(inst.name, ip_address), fg='green')
+        else:
+            click.secho('{} Unknown IP address'.format(inst.name), fg='red')
 
 
 @cli.command()
-@click.argument('src', required=True)
-@click.argument('dst', required=True)
-@click.argument('extra-ssh-args', required=False)
+@click.argument('instance', required=False)
+@click.option('--interval', type=float, default=event_stream.DEFAULT_INTERVAL, show_default=True,
+              help='Seconds between checks of the VirtualBox instances and of IP addresses.')
 @click.pass_context
-def scp(ctx, src, dst, extra_ssh_args):
+def events(ctx, instance, interval):
+    '''
+    Outputs the state changes of the instance(s) as they happen.
+
+    Each event is a json object (with the time, instance, provider and
+    event) on its own line.
+
+    Events are started, stopped, paused and unpaused (vmware only), and
+    ip (the instance got an IP address, given in "ip"). VMware instances
+    are watched through their vmware.log (with inotify on linux) and
+    VirtualBox instances are checked every '--interval' seconds, all with
+    one 'VBoxManage list runningvms'. Instances created while watching
+    are picked up at the next check.
+    '''
+    cloud_name = ctx.obj['cloud_name']
+    LOGGER.debug('cloud_name:%s instance:%s interval:%s', cloud_name, instance, interval)
+
+    if cloud_name:
+        click.secho('Using `events` on cloud instance is not supported.', fg='red')
+        return
+
+    try:
+        for an_event in event_stream.watch([instance] if instance else None, interval):
+            click.echo(json.dumps(an_event))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+
+@cli.command()
+@click.argument('paths', nargs=-1, required=True, metavar='SRC... DST [EXTRA-SSH-ARGS]')
+@click.option('--tar', 'use_tar', is_flag=True, default=False,
+              help='Copy the sources (files, directories or globs) into the DST '
+              'directory of the instance using one tar stream.')
+@click.pass_context
+def scp(ctx, paths, use_tar):
     '''
     Copies files to and from the instance using SCP.
+
+    With --tar, several sources (files, directories or globs) are copied
+    to the instance at once (ex: mech scp --tar 'conf/*' scripts first:/tmp/).
     '''
     cloud_name = ctx.obj['cloud_name']
-    LOGGER.debug('cloud_name:%s src:%s dst:%s extra_ssh_args:%s',
-                 cloud_name, src, dst, extra_ssh_args)
+    LOGGER.debug('cloud_name:%s paths:%s use_tar:%s', cloud_name, paths, use_tar)
 
     if cloud_name:
         utils.cloud_run(cloud_name, ['scp'])
         return
 
+    if use_tar:
+        if len(paths) < 2:
+            sys.exit(click.style('Need at least one SRC and a DST', fg='red'))
+        instance_name, dst_is_host, dst = paths[-1].partition(':')
+        if not dst_is_host:
+            sys.exit(click.style('DST must be an instance destination (ex: first:/tmp/)',
+                                 fg='red'))
+        inst = MechInstance(instance_name)
+        if inst.created:
+            return_code, _, stderr = utils.copy_to_guest(inst, paths[:-1], dst)
+            if stderr != '':
+                click.echo(stderr)
+            if return_code != 0:
+                sys.exit(1)
+        else:
+            click.secho('VM not created.', fg='red')
+        return
+
+    if len(paths) not in (2, 3):
+        sys.exit(click.style('Need a SRC and a DST (use --tar to copy several sources)',
+                             fg='red'))
+    src, dst, extra_ssh_args = (paths + (None,))[:3]
+
     dst_instance, dst_is_host, dst = dst.partition(':')
     src_instance, src_is_host, src = src.partition(':')
 
@@ -420,8 +566,10 @@ def ssh_config(ctx, instance):
 
 @cli.command()
 @click.argument('instance', required=False)
+@click.option('--parallel', '-j', metavar='N', type=int, default=1,
+              help='Number of instances to work on at the same time.')
 @click.pass_context
-def suspend(ctx, instance):
+def suspend(ctx, instance, parallel):
     '''
     Suspends the instance(s).
     '''
@@ -439,7 +587,7 @@ def suspend(ctx, instance):
         # multiple instances
         instances = utils.instances()
 
-    for an_instance in instances:
+    def suspend_instance(an_instance):
         inst = MechInstance(an_instance)
 
         if inst.created:
@@ -447,20 +595,26 @@ def suspend(ctx, instance):
                 vmrun = VMrun(inst.vmx)
                 if vmrun.suspend() is None:
                     click.secho('Not suspended', fg='red')
-                else:
-                    click.secho('Suspended', fg='green')
+                    return False
+                click.secho('Suspended', fg='green')
             else:
                 click.secho('Not sure equivalent command on this platform.', fg='red')
                 click.secho('If you know, please open issue on github.', fg='red')
+                return False
         else:
             click.secho('VM has not been created.')
+        return True
+
+    executor.finish(executor.run_on_instances(instances, suspend_instance, parallel))
 
 
 @cli.command()
 @click.argument('instance', required=False)
 @click.option('--disable-shared-folders', is_flag=True, default=False)
+@click.option('--parallel', '-j', metavar='N', type=int, default=1,
+              help='Number of instances to work on at the same time.')
 @click.pass_context
-def resume(ctx, instance, disable_shared_folders):
+def resume(ctx, instance, disable_shared_folders, parallel):
     '''
     Resume paused/suspended instance(s).
     '''
@@ -479,10 +633,10 @@ def resume(ctx, instance, disable_shared_folders):
         # multiple instances
         instances = utils.instances()
 
-    for an_instance in instances:
+    def resume_instance(an_instance):
         inst = MechInstance(an_instance)
         inst.disable_shared_folders = disable_shared_folders
-        LOGGER.debug('instance:%s', instance)
+        LOGGER.debug('instance:%s', an_instance)
 
         # if we have started this instance before, try to unpause
         if inst.created:
@@ -490,11 +644,15 @@ def resume(ctx, instance, disable_shared_folders):
         else:
             click.secho('VM not created', fg='red')
 
+    executor.finish(executor.run_on_instances(instances, resume_instance, parallel))
+
 
 @cli.command()
 @click.argument('instance', required=False)
+@click.option('--parallel', '-j', metavar='N', type=int, default=1,
+              help='Number of instances to work on at the same time.')
 @click.pass_context
-def upgrade(ctx, instance):
+def upgrade(ctx, instance, parallel):
     '''
     Upgrade the VM and virtual hardware for the instance(s).
 
@@ -515,7 +673,7 @@ def upgrade(ctx, instance):
         # multiple instances
         instances = utils.instances()
 
-    for an_instance in instances:
+    def upgrade_instance(an_instance):
         inst = MechInstance(an_instance)
 
         if inst.created:
@@ -524,21 +682,27 @@ def upgrade(ctx, instance):
                 state = vmrun.check_tools_state(quiet=True)
                 if state == 'running':
                     click.secho('VM must be stopped before doing upgrade.')
-                else:
-                    if vmrun.upgradevm(quiet=False) is None:
-                        click.secho('Not upgraded', fg='red')
-                    else:
-                        click.secho('Upgraded', fg='yellow')
+                    return False
+                if vmrun.upgradevm(quiet=False) is None:
+                    click.secho('Not upgraded', fg='red')
+                    return False
+                click.secho('Upgraded', fg='yellow')
             else:
                 click.secho('Functionality not available on this platform.', fg='red')
+                return False
         else:
             click.secho('VM ({}) not created.'.format(an_instance), fg='red')
+        return True
+
+    executor.finish(executor.run_on_instances(instances, upgrade_instance, parallel))
 
 
 @cli.command()
 @click.argument('instance', required=False)
+@click.option('--parallel', '-j', metavar='N', type=int, default=1,
+              help='Number of instances to work on at the same time.')
 @click.pass_context
-def pause(ctx, instance):
+def pause(ctx, instance, parallel):
     '''
     Pauses the instance(s).
     '''
@@ -556,33 +720,34 @@ def pause(ctx, instance):
         # multiple instances
         instances = utils.instances()
 
-    for an_instance in instances:
+    def pause_instance(an_instance):
         inst = MechInstance(an_instance)
 
         if inst.created:
             if inst.provider == 'vmware':
                 vmrun = VMrun(inst.vmx)
                 pause_results = vmrun.pause()
-                if pause_results is None:
-                    click.secho('Not paused', fg='red')
-                else:
-                    click.secho('Paused', fg='yellow')
             else:
                 vbm = VBoxManage()
                 pause_results = vbm.pause(inst.name)
-                if pause_results is None:
-                    click.secho('Not paused', fg='red')
-                else:
-                    click.secho('Paused', fg='yellow')
+            if pause_results is None:
+                click.secho('Not paused', fg='red')
+                return False
+            click.secho('Paused', fg='yellow')
         else:
             click.secho('VM ({}) not created.'.format(an_instance), fg='red')
+        return True
+
+    executor.finish(executor.run_on_instances(instances, pause_instance, parallel))
 
 
 @cli.command()
 @click.argument('instance', required=False)
 @click.option('--force', '-f', is_flag=True, default=False, help='Force a hard stop.')
+@click.option('--parallel', '-j', metavar='N', type=int, default=1,
+              help='Number of instances to work on at the same time.')
 @click.pass_context
-def down(ctx, instance, force):
+def down(ctx, instance, force, parallel):
     '''
     Stops the instance(s).
     '''
@@ -600,36 +765,38 @@ def down(ctx, instance, force):
         # multiple instances
         instances = utils.instances()
 
-    for an_instance in instances:
+    def stop_instance(an_instance):
         inst = MechInstance(an_instance)
 
         if inst.created:
+            utils.close_ssh_control(inst)
             if inst.provider == 'vmware':
                 vmrun = VMrun(inst.vmx)
                 if not force and vmrun.installed_tools():
                     stopped = vmrun.stop()
                 else:
                     stopped = vmrun.stop(mode='hard')
-                if stopped is None:
-                    click.secho('Not stopped', fg='red')
-                else:
-                    click.secho('Stopped', fg='green')
             else:
                 vbm = VBoxManage()
                 stopped = vbm.stop(vmname=inst.name, quiet=True)
-                if stopped is None:
-                    click.secho('Not stopped', fg='red')
-                else:
-                    click.secho('Stopped', fg='green')
+            if stopped is None:
+                click.secho('Not stopped', fg='red')
+                return False
+            click.secho('Stopped', fg='green')
         else:
             click.secho('VM ({}) not created.'.format(an_instance), fg='red')
+        return True
+
+    executor.finish(executor.run_on_instances(instances, stop_instance, parallel))
 
 
 @cli.command()
 @click.argument('instance', required=False)
 @click.option('-f', '--force', is_flag=True, default=False, help='Destroy without confirmation.')
+@click.option('--parallel', '-j', metavar='N', type=int, default=1,
+              help='Number of instances to work on at the same time.')
 @click.pass_context
-def destroy(ctx, instance, force):
+def destroy(ctx, instance, force, parallel):
     '''
     Stops and deletes all traces of the instances.
     '''
@@ -647,31 +814,45 @@ def destroy(ctx, instance, force):
         # multiple instances
         instances = utils.instances()
 
+    # Note: ask for all confirmations up front, before any (parallel) work is done
+    to_delete = []
     for an_instance in instances:
         inst = MechInstance(an_instance)
 
         if os.path.exists(inst.path):
             if force or utils.confirm('Are you sure you want to delete {} '
                                       'at {}'.format(inst.name, inst.path), default='n'):
-                click.secho('Deleting ({})...'.format(an_instance), fg='green')
-
-                if inst.provider == 'vmware':
-                    vmrun = VMrun(inst.vmx)
-                    vmrun.stop(mode='hard', quiet=True)
-                    vmrun.delete_vm()
-                else:
-                    vbm = VBoxManage()
-                    vbm.stop(vmname=inst.name, quiet=True)
-                    vbm.unregister(vmname=inst.name, quiet=True)
-
-                if os.path.exists(inst.path):
-                    shutil.rmtree(inst.path)
-                click.echo('Deleted')
+                to_delete.append(an_instance)
             else:
                 click.secho('Delete aborted.', fg='red')
         else:
             click.secho('VM ({}) not created.'.format(an_instance), fg='red')
 
+    def destroy_instance(an_instance):
+        inst = MechInstance(an_instance)
+        click.secho('Deleting ({})...'.format(an_instance), fg='green')
+        utils.close_ssh_control(inst)
+
+        if inst.provider == 'vmware':
+            vmrun = VMrun(inst.vmx)
+            vmrun.stop(mode='hard', quiet=True)
+            vmrun.delete_vm()
+        else:
+            vbm = VBoxManage()
+            vbm.stop(vmname=inst.name, quiet=True)
+            if ip_pool.address(inst.name):
+                # while the VM is still registered (the dhcp server knows it by name)
+                vbm.dhcp_remove_fixed_address(inst.name, quiet=True)
+            vbm.unregister(vmname=inst.name, quiet=True)
+            utils.remove_template_clone(vbm, inst.path)
+
+        if os.path.exists(inst.path):
+            shutil.rmtree(inst.path)
+        ip_pool.release(inst.name)
+        click.echo('Deleted')
+
+    executor.finish(executor.run_on_instances(to_delete, destroy_instance, parallel))
+
 
 @cli.command()
 @click.argument('instance', required=True)
@@ -735,9 +916,14 @@ def global_status(ctx, purge):
               help='Do not use NAT networking (i.e., use bridged).')
 @click.option('--numvcpus', metavar='VCPUS', help='Specify number of vcpus.')
 @click.option('-r', '--remove-vagrant', is_flag=True, default=False, help='Remove vagrant user.')
+@click.option('--parallel', '-j', metavar='N', type=int, default=1,
+              help='Number of instances to work on at the same time.')
+@click.option('--stage-limit', metavar='STAGE=N', multiple=True,
+              help='Max instances in a stage (download, extract, boot or provision) '
+              'at the same time.')
 @click.pass_context
 def up(ctx, instance, disable_provisioning, disable_shared_folders, gui, memsize, no_cache,
-       no_nat, numvcpus, remove_vagrant):
+       no_nat, numvcpus, remove_vagrant, parallel, stage_limit):
     '''
     Starts and provisions instance(s).
 
@@ -763,12 +949,38 @@ def up(ctx, instance, disable_provisioning, disable_shared_folders, gui, memsize
     guest VM which is what 'mech' uses to communicate with the VM.
     Be sure you can connect/admin the instance before using this option.
     Be sure to check that root cannot ssh, or change the root password.
+
+    With '--parallel N', up to N instances are brought up at the same time.
+    Each stage has its own limit (defaults: download=2, extract=2, boot=4
+    and provision=8), which can be changed with '--stage-limit STAGE=N'.
+    Instances using the same box share a single download. An instance
+    with 'depends_on' in the Mechfile waits for those instances to be up.
+
+    An instance with 'clone_from' in the Mechfile is created as a linked
+    clone of that instance (vmware only), from a snapshot called
+    'mech-template'. An instance with '"template": true' is created
+    but never started, so it can be cloned from.
+
+    Remote provisioning scripts are fetched (into .mech/cache/provision)
+    while the instances are created and boot.
+
+    After starting, an instance is waited for (to have an IP address) at
+    most 'ready_timeout' seconds from the Mechfile (default: 300).
+    With '"ip_resolver": "dhcp"', the IP address is read from the host's
+    DHCP leases (matching the MAC address of the instance) instead of
+    asking the guest.
+
+    An instance with '"static_ip": true' (virtualbox) gets a fixed address
+    from the 'ip_subnet' of the host-only network (default: 192.168.56.0/24,
+    saved in ~/.mech/ip_pool.json), or the address given in 'static_ip'. It is
+    known before the instance boots, so there is no IP discovery.
     '''
     cloud_name = ctx.obj['cloud_name']
     LOGGER.debug('cloud_name:%s instance:%s disable_provisioning:%s disable_shared_folders:%s '
-                 'gui:%s memsize:%s no_cache:%s no_nat:%s numvcpus:%s remove_vagrant:%s',
+                 'gui:%s memsize:%s no_cache:%s no_nat:%s numvcpus:%s remove_vagrant:%s '
+                 'parallel:%s stage_limit:%s',
                  cloud_name, instance, disable_provisioning, disable_shared_folders,
-                 gui, memsize, no_cache, no_nat, numvcpus, remove_vagrant)
+                 gui, memsize, no_cache, no_nat, numvcpus, remove_vagrant, parallel, stage_limit)
 
     if cloud_name:
         utils.cloud_run(cloud_name, ['up', 'start'])
@@ -781,17 +993,33 @@ def up(ctx, instance, disable_provisioning, disable_shared_folders, gui, memsize
         # multiple instances
         instances = utils.instances()
 
-    for an_instance in instances:
+    pipeline = executor.Pipeline(executor.parse_stage_limits(stage_limit))
+    mechfile = utils.load_mechfile()
+    instances = executor.dependency_order(
+        instances, {name: MechInstance(name, mechfile).depends_on for name in instances})
+    insts = [MechInstance(name, mechfile) for name in instances]
+    batcher = utils.pyinfra_batcher(insts)
+    if not disable_provisioning:
+        # remote provisioning scripts download while the instances are created and boot
+        utils.prefetch_provision_artifacts(insts)
+
+    def up_instance(an_instance):
         inst = MechInstance(an_instance)
 
         inst.gui = gui
         inst.disable_shared_folders = disable_shared_folders
-        inst.disable_provisioning = disable_provisioning
+        inst.disable_provisioning = True
         inst.remove_vagrant = remove_vagrant
         inst.no_nat = no_nat
 
         if not utils.report_provider(inst.provider):
-            return
+            return False
+
+        failed = pipeline.wait_for(inst.depends_on)
+        if failed:
+            click.secho('Not starting, depends on instance(s) that failed: {}'.format(
+                ', '.join(failed)), fg='red')
+            return False
 
         location = inst.url
         if not location:
@@ -800,33 +1028,65 @@ def up(ctx, instance, disable_provisioning, disable_shared_folders, gui, memsize
         # only run init_box on first 'up'
         # extracts the VM files from the singular .box archive
         if not inst.created:
-            path_to_vmx_or_vbox = utils.init_box(
-                an_instance,
-                box=inst.box,
-                box_version=inst.box_version,
-                location=location,
-                instance_path=inst.path,
-                save=not no_cache,
-                numvcpus=numvcpus,
-                memsize=memsize,
-                no_nat=no_nat,
-                windows=inst.windows,
-                provider=inst.provider)
-            if inst.provider == 'vmware':
-                inst.vmx = path_to_vmx_or_vbox
-            else:
-                inst.vbox = path_to_vmx_or_vbox
-                vbm = VBoxManage()
-                if memsize:
-                    vbm.memory(inst.name, memsize)
-                if numvcpus:
-                    vbm.cpus(inst.name, numvcpus)
-                # virtualbox wants to add shared folder before starting VM
-                utils.share_folders(inst)
+            def init():
+                return an_instance, utils.init_box(
+                    an_instance,
+                    box=inst.box,
+                    box_version=inst.box_version,
+                    location=location,
+                    instance_path=inst.path,
+                    save=not no_cache,
+                    numvcpus=numvcpus,
+                    memsize=memsize,
+                    no_nat=no_nat,
+                    windows=inst.windows,
+                    provider=inst.provider,
+                    box_checksum=inst.box_checksum)
+
+            path_to_vmx_or_vbox = None
+            if inst.clone_from:
+                with pipeline.stage('extract'):
+                    path_to_vmx_or_vbox = utils.clone_instance(
+                        inst, MechInstance(inst.clone_from), numvcpus=numvcpus,
+                        memsize=memsize, no_nat=no_nat)
+            elif location and not no_cache:
+                # The first instance using a box downloads it (extracting it as it
+                # streams in), the others wait for it and extract from the box cache.
+                first, path = pipeline.once((inst.provider, inst.box, inst.box_version), init,
+                                            stage='download')
+                if first == an_instance:
+                    path_to_vmx_or_vbox = path
+            with pipeline.stage('extract'):
+                if path_to_vmx_or_vbox is None:
+                    _, path_to_vmx_or_vbox = init()
+                if inst.provider == 'vmware':
+                    inst.vmx = path_to_vmx_or_vbox
+                else:
+                    inst.vbox = path_to_vmx_or_vbox
+                    vbm = VBoxManage()
+                    if memsize:
+                        vbm.memory(inst.name, memsize)
+                    if numvcpus:
+                        vbm.cpus(inst.name, numvcpus)
+                    # virtualbox wants to add shared folder before starting VM
+                    utils.share_folders(inst)
 
             inst.created = True
 
-        utils.start_vm(inst)
+        if inst.template:
+            click.secho("Instance '{}' is a template, not starting it.".format(inst.name),
+                        fg="blue")
+            return True
+
+        with pipeline.stage('boot'):
+            started = utils.start_vm(inst)
+
+        if started and not disable_provisioning:
+            with pipeline.stage('provision'), batcher.working_on(an_instance):
+                utils.provision(inst, show=False, batcher=batcher)
+        return started
+
+    executor.finish(pipeline.run(instances, up_instance, parallel))
 
 
 @cli.command()
@@ -33,6 +33,7 @@ import sys
 import click
 
 from . import utils
+from .vbm import VBoxManage
 
 LOGGER = logging.getLogger('mech')
 
@@ -140,6 +141,9 @@ def list(ctx):
 def remove(ctx, name, provider, version):
     """
     Remove a box that matches the name, provider and version.
+
+    With virtualbox, the template VM imported from the box is deleted too
+    (once the instances created as linked clones of it are destroyed).
     """
     cloud_name = ctx.obj['cloud_name']
     LOGGER.debug('cloud_name:%s name:%s provider:%s version:%s',
@@ -155,6 +159,9 @@ def remove(ctx, name, provider, version):
 
     path = os.path.abspath(os.path.join(utils.mech_dir(), 'boxes', provider, name, version))
     if os.path.exists(path):
+        digests = utils.remove_extracted_boxes(path)
+        if provider == 'virtualbox':
+            utils.remove_box_templates(VBoxManage(), digests)
         shutil.rmtree(path)
         print("Removed {} {}".format(name, version))
     else:
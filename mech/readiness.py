@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 Mike Kinney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+"""Wait for instances to be ready (have an IP address), with timeouts.
+
+   Waiting is done by commands which block until something changes
+   ('VBoxManage guestproperty wait', 'vmrun getGuestIPAddress -wait'),
+   bounded by the time left. When such a command returns early (for
+   example, the VM tools are not running yet) it is retried after an
+   exponentially growing delay, so a slow guest does not cost a process
+   per second.
+"""
+
+from __future__ import absolute_import
+
+import concurrent.futures
+import logging
+import socket
+import time
+
+
+LOGGER = logging.getLogger('mech')
+
+# Default number of seconds to wait for an instance to be ready.
+DEFAULT_TIMEOUT = 300
+BACKOFF_INITIAL = 0.5
+BACKOFF_MAX = 8
+
+
+def delays(initial=BACKOFF_INITIAL, maximum=BACKOFF_MAX):
+    """Generate the delays between attempts (doubling, up to maximum)."""
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * 2, maximum)
+
+
+def wait_until(check, timeout=None, initial=BACKOFF_INITIAL, maximum=BACKOFF_MAX):
+    """Call check(time_left) until it returns something, at most for timeout seconds.
+
+       check can block (up to time_left seconds) waiting for a change.
+       Return what check returned, None if it timed out.
+    """
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+    deadline = time.monotonic() + timeout
+    for delay in delays(initial, maximum):
+        result = check(max(deadline - time.monotonic(), 0))
+        if result:
+            return result
+        time_left = deadline - time.monotonic()
+        if time_left <= 0:
+            LOGGER.debug('timed out after %ss', timeout)
+            return None
+        time.sleep(min(delay, time_left))
+
+
+def wait_for_port(host, port=22, timeout=None):
+    """Wait until something listens on the port of host (ex: sshd of an instance
+       with a known IP address). Return True if it does, False if it timed out.
+    """
+    def check(time_left):
+        try:
+            with socket.create_connection((host, port), timeout=max(min(time_left, 5), 0.1)):
+                return True
+        except OSError:
+            return False
+
+    return bool(wait_until(check, timeout))
+
+
+def wait_for_ips(insts, timeout=None):
+    """Wait for the IP addresses of the instances, all at the same time.
+
+       Generate (inst, ip_address) as each instance becomes ready (ip_address
+       is None for the instances which timed out).
+    """
+    if not insts:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(insts)) as pool:
+        futures = {pool.submit(inst.get_ip, wait=True, timeout=timeout): inst for inst in insts}
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 Mike Kinney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+"""In-process ssh transport (paramiko) with a pool of connections to the instances.
+
+   Used by utils.ssh() and utils.scp() in place of the ssh/scp commands
+   when MECH_SSH_TRANSPORT is 'paramiko' (see 'mech --ssh-transport').
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import logging
+import os
+import posixpath
+import stat
+import threading
+
+try:
+    import paramiko
+except ImportError:  # pragma: no cover
+    paramiko = None
+
+
+LOGGER = logging.getLogger('mech')
+
+SSH_TRANSPORTS = ('openssh', 'paramiko')
+SSH_CONNECT_TIMEOUT = 30
+
+_POOL = {}
+_POOL_LOCK = threading.Lock()
+
+
+def available():
+    """Return True if the in-process transport can be used (paramiko is installed)."""
+    return paramiko is not None
+
+
+def enabled():
+    """Return True if the in-process transport should be used."""
+    return os.environ.get('MECH_SSH_TRANSPORT', 'openssh') == 'paramiko' and available()
+
+
+def connect(config_ssh):
+    """Return a new paramiko.SSHClient connected as described by config_ssh."""
+    client = paramiko.SSHClient()
+    # same as 'StrictHostKeyChecking no' and 'UserKnownHostsFile /dev/null'
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(hostname=config_ssh['HostName'],
+                   port=int(config_ssh.get('Port', 22)),
+                   username=config_ssh.get('User'),
+                   key_filename=os.path.expanduser(config_ssh['IdentityFile']),
+                   look_for_keys=False,
+                   allow_agent=False,
+                   timeout=SSH_CONNECT_TIMEOUT)
+    return client
+
+
+def client(name, config_ssh):
+    """Return the connected client of the instance (connecting if needed)."""
+    with _POOL_LOCK:
+        entry = _POOL.setdefault(name, {'lock': threading.Lock(), 'client': None, 'host': None})
+    with entry['lock']:
+        the_client = entry['client']
+        transport = the_client.get_transport() if the_client is not None else None
+        if transport is None or not transport.is_active() or \
+                entry['host'] != config_ssh['HostName']:
+            if the_client is not None:
+                the_client.close()
+            LOGGER.debug('connecting to %s (%s)', name, config_ssh['HostName'])
+            entry['client'] = connect(config_ssh)
+            entry['host'] = config_ssh['HostName']
+        return entry['client']
+
+
+def close(name):
+    """Close the connection to the instance (if there is one)."""
+    with _POOL_LOCK:
+        entry = _POOL.pop(name, None)
+    if entry is not None and entry['client'] is not None:
+        LOGGER.debug('closing connection to %s', name)
+        entry['client'].close()
+
+
+@atexit.register
+def close_all():
+    """Close all connections."""
+    with _POOL_LOCK:
+        names = list(_POOL)
+    for name in names:
+        close(name)
+
+
+def run(name, config_ssh, command, stdin=None):
+    """Run command on the instance (on a new channel of the pooled connection).
+
+       If stdin is given, it is sent to the command on its standard input (it can
+       also be a function writing it to a stream, see tar_stream.writer()).
+       Return (return_code, stdout, stderr) like utils.ssh().
+    """
+    LOGGER.debug('name:%s command:%s', name, command)
+    try:
+        command_stdin, stdout, stderr = client(name, config_ssh).exec_command(command)
+        # read stderr at the same time, so a command writing a lot to it does not block
+        errors = []
+        reader = threading.Thread(target=lambda: errors.append(stderr.read()))
+        reader.start()
+        if callable(stdin):
+            stdin(command_stdin)
+        elif stdin is not None:
+            command_stdin.write(stdin.encode('utf-8'))
+        if stdin is not None:
+            command_stdin.channel.shutdown_write()
+        output = stdout.read()
+        reader.join()
+        return_code = stdout.channel.recv_exit_status()
+    except (paramiko.SSHException, OSError) as exc:
+        LOGGER.debug('name:%s', name, exc_info=True)
+        close(name)
+        return 255, '', str(exc)
+    return (return_code, output.decode('utf-8', 'replace').strip(),
+            b''.join(errors).decode('utf-8', 'replace').strip())
+
+
+def remote_path(sftp, path):
+    """Return the path in the instance, with '~' expanded (SFTP does not expand it).
+
+       An empty path is the home directory, like with scp.
+    """
+    if path in ('', '~'):
+        return sftp.normalize('.')
+    if path.startswith('~/'):
+        return posixpath.join(sftp.normalize('.'), path[2:])
+    return path
+
+
+def remote_isdir(sftp, path):
+    """Return True if path is a directory in the instance."""
+    try:
+        return stat.S_ISDIR(sftp.stat(path).st_mode)
+    except IOError:
+        return False
+
+
+def copy(name, config_ssh, src, dst, dst_is_host):
+    """Copy a file to (or from) the instance using SFTP.
+
+       Like scp, a file copied to a directory keeps its name.
+       Return (return_code, stdout, stderr) like utils.scp().
+    """
+    LOGGER.debug('name:%s src:%s dst:%s dst_is_host:%s', name, src, dst, dst_is_host)
+    try:
+        sftp = client(name, config_ssh).open_sftp()
+        try:
+            if dst_is_host:
+                dst = remote_path(sftp, dst)
+                if remote_isdir(sftp, dst):
+                    dst = posixpath.join(dst, os.path.basename(src))
+                sftp.put(src, dst)
+            else:
+                src = remote_path(sftp, src)
+                dst = os.path.expanduser(dst) or '.'
+                if os.path.isdir(dst):
+                    dst = os.path.join(dst, posixpath.basename(src))
+                sftp.get(src, dst)
+        finally:
+            sftp.close()
+    except (paramiko.SSHException, OSError) as exc:
+        LOGGER.debug('name:%s', name, exc_info=True)
+        return 1, '', str(exc)
+    return 0, '', ''
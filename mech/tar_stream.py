@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 Mike Kinney
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+"""Copy files to an instance as one (compressed) tar stream.
+
+   The sources are packed on the host while they are sent, and unpacked in
+   the guest by a single 'tar -x' (see utils.tar_to_guest()).
+"""
+
+from __future__ import absolute_import
+
+import fnmatch
+import glob
+import gzip
+import logging
+import os
+import shlex
+import tarfile
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+LOGGER = logging.getLogger('mech')
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Content that is already compressed (compressing it again only costs time).
+INCOMPRESSIBLE = ('*.gz', '*.tgz', '*.bz2', '*.xz', '*.zst', '*.lz4', '*.zip', '*.7z', '*.rar',
+                  '*.jar', '*.whl', '*.deb', '*.rpm', '*.apk', '*.box', '*.iso', '*.jpg',
+                  '*.jpeg', '*.png', '*.gif', '*.webp', '*.mp3', '*.mp4', '*.mkv', '*.pdf')
+
+
+def zstd_available():
+    """Return True if streams can be compressed with zstd (zstandard is installed)."""
+    return zstandard is not None
+
+
+def has_glob(source):
+    """Return True if source is a glob pattern (ex: 'files/*.txt')."""
+    return glob.has_magic(source)
+
+
+def expand(sources, destination):
+    """Return the tar members (path, arcname) to copy sources into the destination directory.
+
+       Sources can be files, directories (copied with their content) or globs.
+    """
+    members = []
+    for source in sources:
+        paths = sorted(glob.glob(source)) if has_glob(source) else [source]
+        if not paths or not all(os.path.exists(path) for path in paths):
+            raise OSError('Cannot find ({})'.format(source))
+        for path in paths:
+            name = os.path.basename(os.path.normpath(path))
+            members.append((path, os.path.join(destination, name) if destination else name))
+    return members
+
+
+def walk(members):
+    """Yield (path, size) of the files of the members."""
+    for path, _ in members:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in files:
+                    file_path = os.path.join(root, name)
+                    yield file_path, os.path.getsize(file_path)
+        else:
+            yield path, os.path.getsize(path)
+
+
+def incompressible(path):
+    """Return True if the content of path is already compressed."""
+    name = path.lower()
+    return any(fnmatch.fnmatch(name, pattern) for pattern in INCOMPRESSIBLE)
+
+
+def choose_compression(members, zstd=False):
+    """Return the compression to use for the members: 'zstd', 'gzip' or None.
+
+       Nothing is compressed when most of the content is already compressed.
+    """
+    total = skipped = 0
+    for path, size in walk(members):
+        total += size
+        if incompressible(path):
+            skipped += size
+    if not total or skipped * 2 > total:
+        return None
+    return 'zstd' if zstd and zstd_available() else 'gzip'
+
+
+def write(stream, members, compression=None):
+    """Write the tar of the members (compressed with compression) to stream."""
+    if compression == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(
+            stream, closefd=False)
+    elif compression == 'gzip':
+        compressor = gzip.GzipFile(fileobj=stream, mode='wb', compresslevel=GZIP_LEVEL)
+    else:
+        compressor = None
+    with tarfile.open(fileobj=compressor or stream, mode='w|') as tar:
+        for path, arcname in members:
+            LOGGER.debug('path:%s arcname:%s', path, arcname)
+            tar.add(path, arcname=arcname)
+    if compressor is not None:
+        compressor.close()
+    stream.flush()
+
+
+def writer(members, compression=None):
+    """Return a function writing the tar of the members to a stream (see utils.ssh() stdin)."""
+    return lambda stream: write(stream, members, compression)
+
+
+def extract_command(directory, compression=None):
+    """Return the command (run in the guest) extracting the tar stream into directory.
+
+       An empty directory means the home directory of the user.
+    """
+    if compression == 'zstd':
+        tar = 'zstd -dcq | tar -x -f -'
+    elif compression == 'gzip':
+        tar = 'tar -xz -f -'
+    else:
+        tar = 'tar -x -f -'
+    if not directory:
+        return tar
+    directory = shlex.quote(directory)
+    return 'mkdir -p {0} && {1} -C {0}'.format(directory, tar)
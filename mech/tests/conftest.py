@@ -4,6 +4,58 @@
 import json
 import pytest
 
+import mech.utils
+import mech.ip_pool
+
+
+@pytest.fixture(autouse=True)
+def host_cache(tmp_path, monkeypatch):
+    """Use an empty host capability cache (not the one in the home directory)."""
+    cache_file = str(tmp_path / 'host_capabilities.json')
+    monkeypatch.setattr(mech.utils, 'host_cache_file', lambda: cache_file)
+    monkeypatch.setattr(mech.utils, '_HOST_CACHE', None)
+    return cache_file
+
+
+@pytest.fixture(autouse=True)
+def catalog_cache(tmp_path, monkeypatch):
+    """Use an empty catalog cache (not the one in the home directory)."""
+    cache_dir = str(tmp_path / 'catalogs')
+    monkeypatch.setattr(mech.utils, 'catalog_cache_dir', lambda: cache_dir)
+    monkeypatch.delenv('MECH_OFFLINE', raising=False)
+    return cache_dir
+
+
+@pytest.fixture(autouse=True)
+def provision_cache(tmp_path, monkeypatch):
+    """Use an empty provisioning cache (not the one in the current directory)."""
+    cache_dir = str(tmp_path / 'provision')
+    monkeypatch.setattr(mech.utils, 'provision_cache_dir', lambda: cache_dir)
+    monkeypatch.setattr(mech.utils, '_ARTIFACTS', {})
+    return cache_dir
+
+
+@pytest.fixture(autouse=True)
+def ip_pool_file(tmp_path, monkeypatch):
+    """Use an empty pool of IP addresses (not the one in the home directory)."""
+    pool_file = str(tmp_path / 'ip_pool.json')
+    monkeypatch.setattr(mech.ip_pool, 'state_file', lambda: pool_file)
+    return pool_file
+
+
+@pytest.fixture(autouse=True)
+def templates_dir(tmp_path, monkeypatch):
+    """Keep the records of the template VMs in a temporary directory."""
+    path = str(tmp_path / 'templates')
+    monkeypatch.setattr(mech.utils, 'templates_dir', lambda: path)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def ssh_transport(monkeypatch):
+    """Use the default ssh transport (ssh/scp commands)."""
+    monkeypatch.delenv('MECH_SSH_TRANSPORT', raising=False)
+
 
 @pytest.fixture
 def mechcloudfile_one_entry():
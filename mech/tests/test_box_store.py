@@ -0,0 +1,86 @@
+# Copyright (c) 2020 Mike Kinney
+"""Tests for the store of extracted boxes."""
+import os
+from unittest.mock import patch
+
+import mech.box_store
+
+
+def write_file(path, data):
+    """Write data to path."""
+    with open(path, 'wb') as the_file:
+        the_file.write(data)
+
+
+def read_file(path):
+    """Return the data in path."""
+    with open(path, 'rb') as the_file:
+        return the_file.read()
+
+
+def test_sparse_copy(tmp_path):
+    """Test holes in a file are kept."""
+    src = str(tmp_path / 'disk.vmdk')
+    with open(src, 'wb') as the_file:
+        the_file.write(b'start')
+        the_file.seek(8 * 1024 * 1024)
+        the_file.write(b'end')
+    dst = str(tmp_path / 'copy.vmdk')
+    mech.box_store.sparse_copy(src, dst)
+    assert read_file(dst) == read_file(src)
+    assert os.stat(dst).st_blocks <= os.stat(src).st_blocks + 8
+
+
+@patch('os.copy_file_range', side_effect=OSError('not supported'), create=True)
+def test_sparse_copy_without_copy_file_range(mock_copy_file_range, tmp_path):
+    """Test copying when the kernel cannot copy the file."""
+    src = str(tmp_path / 'disk.vmdk')
+    write_file(src, b'x' * 3000000)
+    dst = str(tmp_path / 'copy.vmdk')
+    mech.box_store.sparse_copy(src, dst)
+    assert read_file(dst) == read_file(src)
+
+
+@patch('fcntl.ioctl', side_effect=OSError('not supported'))
+def test_clone_file_without_reflink(mock_ioctl, tmp_path):
+    """Test the file is copied when it cannot be cloned."""
+    src = str(tmp_path / 'some.vmx')
+    write_file(src, b'vmx')
+    os.chmod(src, 0o600)
+    dst = str(tmp_path / 'copy.vmx')
+    mech.box_store.clone_file(src, dst)
+    assert read_file(dst) == b'vmx'
+    assert os.stat(dst).st_mode & 0o777 == 0o600
+    assert not os.path.samefile(src, dst)
+
+
+def test_materialize(tmp_path):
+    """Test creating the files of an instance from an extracted box."""
+    source = tmp_path / 'extracted'
+    os.makedirs(str(source / 'sub'))
+    write_file(str(source / 'some.vmx'), b'vmx')
+    write_file(str(source / 'metadata.json'), b'{}')
+    write_file(str(source / 'sub' / 'disk.vmdk'), b'disk')
+    destination = tmp_path / 'first'
+    mech.box_store.materialize(str(source), str(destination))
+    assert read_file(str(destination / 'sub' / 'disk.vmdk')) == b'disk'
+    assert os.path.samefile(str(source / 'metadata.json'), str(destination / 'metadata.json'))
+    assert not os.path.samefile(str(source / 'some.vmx'), str(destination / 'some.vmx'))
+    # changing the instance does not change the store
+    write_file(str(destination / 'some.vmx'), b'changed')
+    assert read_file(str(source / 'some.vmx')) == b'vmx'
+    # again (ex: instance files being recreated)
+    mech.box_store.materialize(str(source), str(destination), link=('*',))
+    assert os.path.samefile(str(source / 'some.vmx'), str(destination / 'some.vmx'))
+
+
+def test_add(tmp_path):
+    """Test adding an extracted box to the store (twice)."""
+    path = str(tmp_path / 'abcd')
+    first = str(tmp_path / '.tmp-1')
+    second = str(tmp_path / '.tmp-2')
+    os.makedirs(first)
+    os.makedirs(second)
+    assert mech.box_store.add(first, path) == path
+    assert mech.box_store.add(second, path) == path
+    assert sorted(os.listdir(str(tmp_path))) == ['abcd']
@@ -0,0 +1,124 @@
+# Copyright (c) 2020 Mike Kinney
+"""Tests for finding IP addresses in DHCP lease files."""
+from unittest.mock import patch
+
+import pytest
+
+import mech.dhcp_leases
+
+
+ISC_LEASES = """
+# All times in this file are in UTC (GMT), not your local timezone.
+lease 192.168.56.128 {
+    starts 4 2020/06/11 18:40:53;
+    ends 4 2020/06/11 19:10:53;
+    hardware ethernet 00:0c:29:aa:bb:cc;
+    client-hostname "ubuntu";
+}
+lease 192.168.56.129 {
+    starts 4 2020/06/11 19:40:53;
+    ends never;
+    hardware ethernet 00:0C:29:AA:BB:CC;
+}
+lease 192.168.56.130 {
+    starts epoch 1591900000;
+    ends epoch 1591901800;
+    hardware ethernet 00:0c:29:dd:ee:ff;
+}
+lease 192.168.56.131 {
+    starts 4 2020/06/11 18:40:53;
+}
+"""
+
+VBOX_LEASES = """<?xml version="1.0"?>
+<Leases version="1.0">
+  <InternalNetwork>HostInterfaceNetworking-vboxnet0</InternalNetwork>
+  <Lease mac="08:00:27:9d:5e:2f" id="01080027" network="0.0.0.0" state="acked">
+    <Address value="192.168.56.101"/>
+    <Time issued="1591900000" expiration="600"/>
+  </Lease>
+  <Lease mac="08:00:27:00:00:01" network="0.0.0.0" state="offered">
+    <Address value="192.168.56.102"/>
+    <Time issued="1591900000" expiration="600"/>
+  </Lease>
+</Leases>
+"""
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    """Start with no leases remembered."""
+    monkeypatch.setattr(mech.dhcp_leases, '_LEASES', {})
+    monkeypatch.setattr(mech.dhcp_leases, '_FILES', {})
+
+
+def test_normalize_mac():
+    """Test MAC addresses are compared in one format."""
+    assert mech.dhcp_leases.normalize_mac('0800279D5E2F') == '08:00:27:9d:5e:2f'
+    assert mech.dhcp_leases.normalize_mac('08-00-27-9D-5E-2F') == '08:00:27:9d:5e:2f'
+    assert mech.dhcp_leases.normalize_mac('08:00:27') is None
+
+
+def test_parse_isc_leases():
+    """Test parsing dhcpd.leases (the lease which started last is used)."""
+    leases = mech.dhcp_leases.parse_isc_leases(ISC_LEASES)
+    assert leases == {'00:0c:29:aa:bb:cc': ('192.168.56.129', float('inf')),
+                      '00:0c:29:dd:ee:ff': ('192.168.56.130', 1591901800)}
+
+
+def test_parse_vbox_leases():
+    """Test parsing the VirtualBox lease file (only acked leases)."""
+    leases = mech.dhcp_leases.parse_vbox_leases(VBOX_LEASES)
+    assert leases == {'08:00:27:9d:5e:2f': ('192.168.56.101', 1591900600)}
+    assert mech.dhcp_leases.parse_vbox_leases('not xml') == {}
+
+
+def test_lookup(tmp_path):
+    """Test looking up a MAC address, cached until the lease expires."""
+    path = tmp_path / 'Dhcpd.leases'
+    path.write_text(VBOX_LEASES)
+    paths = [str(path)]
+    parse = mech.dhcp_leases.parse_vbox_leases
+    with patch('time.time', return_value=1591900100):
+        assert mech.dhcp_leases.lookup('0800279D5E2F', paths, parse) == '192.168.56.101'
+        assert mech.dhcp_leases.lookup('080027000001', paths, parse) is None
+        assert mech.dhcp_leases.lookup(None, paths, parse) is None
+        # still leased: no need to read the file again
+        with patch('mech.dhcp_leases.read_leases') as mock_read:
+            assert mech.dhcp_leases.lookup('08:00:27:9d:5e:2f', paths, parse) == '192.168.56.101'
+            mock_read.assert_not_called()
+    with patch('time.time', return_value=1591900700):
+        # expired
+        assert mech.dhcp_leases.lookup('08:00:27:9d:5e:2f', paths, parse) is None
+
+
+def test_read_leases(tmp_path):
+    """Test lease files are only parsed again when they change."""
+    path = tmp_path / 'dhcpd.leases'
+    path.write_text(ISC_LEASES)
+    with patch('mech.dhcp_leases.parse_isc_leases', return_value={}) as mock_parse:
+        mech.dhcp_leases.read_leases(str(path), mech.dhcp_leases.parse_isc_leases)
+        mech.dhcp_leases.read_leases(str(path), mech.dhcp_leases.parse_isc_leases)
+        assert mock_parse.call_count == 1
+        path.write_text(ISC_LEASES + '\n')
+        mech.dhcp_leases.read_leases(str(path), mech.dhcp_leases.parse_isc_leases)
+        assert mock_parse.call_count == 2
+    assert mech.dhcp_leases.read_leases(str(tmp_path / 'no'), None) == {}
+
+
+def test_vmware_ip(tmp_path):
+    """Test finding the IP address VMware leased."""
+    path = tmp_path / 'dhcpd.leases'
+    path.write_text(ISC_LEASES)
+    with patch('mech.dhcp_leases.vmware_lease_files', return_value=[str(path)]):
+        assert mech.dhcp_leases.vmware_ip('00:0c:29:aa:bb:cc') == '192.168.56.129'
+        assert mech.dhcp_leases.vmware_ip('00:0c:29:dd:ee:ff') is None
+
+
+def test_vbox_lease_files(tmp_path, monkeypatch):
+    """Test finding the VirtualBox lease file of the host-only network."""
+    monkeypatch.setattr(mech.dhcp_leases, 'VBOX_CONFIG_DIRS', (str(tmp_path),))
+    assert mech.dhcp_leases.vbox_lease_files() == []
+    path = tmp_path / 'HostInterfaceNetworking-vboxnet0-Dhcpd.leases'
+    path.write_text(VBOX_LEASES)
+    assert mech.dhcp_leases.vbox_lease_files() == [str(path)]
@@ -0,0 +1,171 @@
+# Copyright (c) 2020 Mike Kinney
+"""Tests for resumable downloads."""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from unittest.mock import patch, MagicMock
+
+import pytest
+import requests
+
+import mech.download
+
+
+DATA = bytes(range(256)) * 40
+
+
+def fake_get(ranges=True, fail=None):
+    """Return a fake requests.get() serving DATA (optionally with ranges)."""
+    calls = []
+
+    def get(url, stream=False, timeout=None, headers=None):
+        calls.append((headers or {}).get('Range'))
+        response = MagicMock()
+        response.headers = {'content-type': 'application/octet-stream', 'etag': '"abc"'}
+        match = re.match(r'bytes=(\d+)-(\d+)', (headers or {}).get('Range', ''))
+        if ranges and match:
+            start, end = int(match.group(1)), int(match.group(2))
+            if fail and start in fail:
+                raise requests.ConnectionError('network blip')
+            body = DATA[start:end + 1]
+            response.status_code = 206
+            response.headers['content-range'] = 'bytes {}-{}/{}'.format(start, end, len(DATA))
+        else:
+            body = DATA
+            response.status_code = 200
+            response.headers['content-length'] = str(len(DATA))
+        response.iter_content.return_value = [body[i:i + 100] for i in range(0, len(body), 100)]
+        return response
+    get.calls = calls
+    return get
+
+
+def test_missing_pieces():
+    """Test splitting what is left to download in pieces."""
+    assert mech.download.missing_pieces(10, [], piece_size=4) == [[0, 4], [4, 8], [8, 10]]
+    assert mech.download.missing_pieces(10, [[2, 4], [4, 6]], piece_size=4) == [[0, 2], [6, 10]]
+    assert mech.download.missing_pieces(10, [[0, 10]]) == []
+
+
+@patch('mech.download.DOWNLOAD_PIECE_SIZE', 1000)
+def test_download_segmented(tmp_path):
+    """Test a download in segments."""
+    path = str(tmp_path / 'a.box')
+    get = fake_get()
+    with patch('requests.Session.get', side_effect=get):
+        content_type = mech.download.download('http://example.com/a.box', path, segments=3)
+    assert content_type == 'application/octet-stream'
+    with open(path, 'rb') as the_file:
+        assert the_file.read() == DATA
+    assert not os.path.exists(path + '.part.json')
+    assert len(get.calls) == 1 + 11
+
+
+@patch('mech.download.DOWNLOAD_RETRIES', 0)
+@patch('mech.download.DOWNLOAD_PIECE_SIZE', 1000)
+def test_download_resumes(tmp_path):
+    """Test an interrupted download resumes where it stopped."""
+    path = str(tmp_path / 'a.box')
+    with patch('requests.Session.get', side_effect=fake_get(fail=[5000])):
+        with pytest.raises(requests.ConnectionError):
+            mech.download.download('http://example.com/a.box', path, segments=1)
+    with open(path + '.part.json') as the_file:
+        assert json.load(the_file)['done'][0] == [0, 5000]
+
+    get = fake_get()
+    with patch('requests.Session.get', side_effect=get):
+        mech.download.download('http://example.com/a.box', path, segments=2)
+    with open(path, 'rb') as the_file:
+        assert the_file.read() == DATA
+    # only the pieces that were missing were downloaded
+    assert 'bytes=5000-5999' in get.calls
+    assert 'bytes=0-999' not in get.calls
+
+
+@patch('mech.download.DOWNLOAD_PIECE_SIZE', 1000)
+def test_download_interrupted(tmp_path):
+    """Test ctrl-c stops a download without waiting for the pieces being fetched."""
+    path = str(tmp_path / 'a.box')
+    get = fake_get()
+    release = threading.Event()
+
+    def interrupted_get(url, stream=False, timeout=None, headers=None):
+        if (headers or {}).get('Range') == 'bytes=3000-3999':
+            raise KeyboardInterrupt()
+        if (headers or {}).get('Range') in ('bytes=4000-4999', 'bytes=5000-5999'):
+            # being fetched when ctrl-c is pressed
+            release.wait(5)
+        return get(url, stream=stream, timeout=timeout, headers=headers)
+
+    with patch('requests.Session.get', side_effect=interrupted_get):
+        started = time.monotonic()
+        with pytest.raises(KeyboardInterrupt):
+            mech.download.download('http://example.com/a.box', path, segments=2)
+        assert time.monotonic() - started < 4
+        release.set()
+        time.sleep(0.2)
+    # the pieces that were not started were cancelled, the others stopped
+    assert 'bytes=6000-6999' not in get.calls
+    with open(path + '.part.json') as the_file:
+        assert json.load(the_file)['done'] == [[0, 3000]]
+
+
+def test_download_without_ranges(tmp_path):
+    """Test falling back to a single stream."""
+    path = str(tmp_path / 'a.box')
+    with patch('requests.Session.get', side_effect=fake_get(ranges=False)):
+        mech.download.download('http://example.com/a.box', path)
+    with open(path, 'rb') as the_file:
+        assert the_file.read() == DATA
+
+
+def test_parse_checksum():
+    """Test parsing of checksums."""
+    digest = hashlib.sha256(DATA).hexdigest()
+    assert mech.download.parse_checksum('SHA256:' + digest.upper()) == ('sha256', digest)
+    assert mech.download.parse_checksum(digest) == ('sha256', digest)
+    with pytest.raises(ValueError):
+        mech.download.parse_checksum('foo:1234')
+    with pytest.raises(ValueError):
+        mech.download.parse_checksum('sha1:not-hex')
+
+
+@pytest.mark.parametrize('ranges', [True, False])
+@patch('mech.download.DOWNLOAD_PIECE_SIZE', 1000)
+def test_download_checksum(ranges, tmp_path):
+    """Test a download is verified as it comes in."""
+    path = str(tmp_path / 'a.box')
+    checksum = 'sha256:' + hashlib.sha256(DATA).hexdigest()
+    with patch('requests.Session.get', side_effect=fake_get(ranges=ranges)):
+        mech.download.download('http://example.com/a.box', path, checksum=checksum)
+    assert os.path.exists(path)
+
+
+@patch('mech.download.DOWNLOAD_PIECE_SIZE', 1000)
+def test_download_checksum_mismatch(tmp_path):
+    """Test a corrupt download is removed."""
+    path = str(tmp_path / 'a.box')
+    checksum = 'sha256:' + hashlib.sha256(b'something else').hexdigest()
+    with patch('requests.Session.get', side_effect=fake_get()):
+        with pytest.raises(mech.download.ChecksumError):
+            mech.download.download('http://example.com/a.box', path, checksum=checksum)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_session():
+    """Test the shared session pools connections and retries."""
+    session = mech.download.session()
+    assert session is mech.download.session()
+    adapter = session.get_adapter('https://example.com')
+    assert adapter.max_retries.total == mech.download.HTTP_RETRIES
+
+
+def test_offline(monkeypatch):
+    """Test offline mode."""
+    monkeypatch.delenv('MECH_OFFLINE', raising=False)
+    assert not mech.download.offline()
+    monkeypatch.setenv('MECH_OFFLINE', '1')
+    assert mech.download.offline()
@@ -0,0 +1,134 @@
+# Copyright (c) 2020 Mike Kinney
+"""Tests for the stream of instance events."""
+import os
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import mech.event_stream
+
+
+STARTED = 'Reporting power state change (opcode=2, err=0)\n'
+STOPPED = 'VMX exit (0)\n'
+PAUSED = 'VMAutomation_Pause: pause = TRUE\n'
+
+
+def vmware_instance(tmp_path, name='first'):
+    """Return a (mock) created vmware instance, with a vmware.log."""
+    inst = MagicMock()
+    inst.name = name
+    inst.provider = 'vmware'
+    inst.created = True
+    inst.path = str(tmp_path)
+    inst.vmx = str(tmp_path / 'some.vmx')
+    inst.get_ip.return_value = None
+    (tmp_path / 'some.vmx').write_text('')
+    (tmp_path / 'vmware.log').write_text('blah\n' + STOPPED)
+    return inst
+
+
+def append(path, text):
+    """Append text to the file."""
+    with open(str(path), 'a') as the_file:
+        the_file.write(text)
+
+
+def test_log_tail(tmp_path):
+    """Test only the lines added are read, and a new log is read from the start."""
+    path = tmp_path / 'vmware.log'
+    path.write_text(STOPPED)
+    tail = mech.event_stream.LogTail(str(path))
+    assert tail.states() == []
+    append(path, 'blah\n' + STARTED + PAUSED[:10])
+    assert tail.states() == ['started']
+    append(path, PAUSED[10:])
+    assert tail.states() == ['paused']
+    os.unlink(str(path))
+    assert tail.states() == []
+    path.write_text(STARTED)
+    assert tail.states() == ['started']
+
+
+@pytest.mark.parametrize('inotify', [True, False])
+def test_watch_vmware(tmp_path, monkeypatch, inotify):
+    """Test events of a vmware instance, from its vmware.log."""
+    if not inotify:
+        monkeypatch.setattr(mech.event_stream, 'inotify_available', lambda: False)
+    elif not mech.event_stream.inotify_available():
+        pytest.skip('inotify is not available')
+    inst = vmware_instance(tmp_path)
+    watcher = mech.event_stream.Watcher([inst], interval=0.01)
+    assert (watcher.inotify is not None) == inotify
+    events = watcher.events()
+    append(tmp_path / 'vmware.log', STARTED)
+    an_event = next(events)
+    assert an_event['instance'] == 'first'
+    assert an_event['provider'] == 'vmware'
+    assert an_event['event'] == 'started'
+    inst.get_ip.return_value = '192.168.1.100'
+    assert next(events)['ip'] == '192.168.1.100'
+    append(tmp_path / 'vmware.log', PAUSED + STOPPED)
+    assert [next(events)['event'] for _ in range(2)] == ['paused', 'stopped']
+    events.close()
+
+
+def virtualbox_instance(tmp_path, name, created=True):
+    """Return a (mock) virtualbox instance."""
+    inst = MagicMock()
+    inst.name = name
+    inst.provider = 'virtualbox'
+    inst.path = str(tmp_path / name)
+    os.makedirs(inst.path)
+    if created:
+        (tmp_path / name / '{}.vbox'.format(name)).write_text('')
+    return inst
+
+
+@patch('mech.vbm.VBoxManage.installed', return_value=True)
+def test_watch_virtualbox(mock_installed, tmp_path):
+    """Test events of virtualbox instances, with one 'list runningvms' per check."""
+    first = virtualbox_instance(tmp_path, 'first')
+    second = virtualbox_instance(tmp_path, 'second')
+    first.get_ip.return_value = '192.168.56.2'
+    second.get_ip.return_value = '192.168.56.3'
+    not_created = virtualbox_instance(tmp_path, 'third', created=False)
+    # VBoxManage failing (None) is not a change
+    running = [['second'], None, ['second'], ['first', 'second'], None, ['first']]
+    with patch('mech.vbm.VBoxManage.list_running', side_effect=running) as mock_list_running:
+        events = mech.event_stream.watch([first, second, not_created], interval=0.01)
+        got = [(e['instance'], e['event'], e.get('ip')) for e in (next(events) for _ in range(4))]
+        events.close()
+    assert got == [('second', 'ip', '192.168.56.3'), ('first', 'started', None),
+                   ('first', 'ip', '192.168.56.2'), ('second', 'stopped', None)]
+    assert mock_list_running.call_count == 6
+
+
+@patch('mech.vbm.VBoxManage.installed', return_value=True)
+def test_watch_created_later(mock_installed, tmp_path):
+    """Test the instances created (and destroyed) while watching are noticed."""
+    first = virtualbox_instance(tmp_path, 'first', created=False)
+    first.get_ip.return_value = '192.168.56.2'
+    with patch('mech.vbm.VBoxManage.list_running', return_value=['first']):
+        watcher = mech.event_stream.Watcher([first], interval=0.01)
+        assert watcher.insts == []
+        events = watcher.events()
+        (tmp_path / 'first' / 'first.vbox').write_text('')
+        got = [(e['instance'], e['event']) for e in (next(events) for _ in range(2))]
+        assert got == [('first', 'started'), ('first', 'ip')]
+        assert first.created
+        os.unlink(str(tmp_path / 'first' / 'first.vbox'))
+        assert next(events)['event'] == 'stopped'
+        events.close()
+    assert watcher.insts == []
+
+
+@patch('mech.vbm.VBoxManage.installed', return_value=True)
+def test_watch_virtualbox_unknown_at_start(mock_installed, tmp_path):
+    """Test the state is only noted (no event) when VBoxManage failed at the start."""
+    first = virtualbox_instance(tmp_path, 'first')
+    first.get_ip.return_value = '192.168.56.2'
+    with patch('mech.vbm.VBoxManage.list_running', side_effect=[None, ['first'], []]):
+        events = mech.event_stream.watch([first], interval=0.01)
+        got = [e['event'] for e in (next(events) for _ in range(2))]
+        events.close()
+    assert got == ['ip', 'stopped']
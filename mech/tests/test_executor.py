@@ -0,0 +1,240 @@
+# Copyright (c) 2020 Mike Kinney
+"""Tests for the instance executor."""
+import io
+import sys
+import threading
+import time
+
+import pytest
+
+import mech.executor
+
+
+def test_prefixed_output():
+    """Test lines written by a registered thread get prefixed."""
+    stream = io.StringIO()
+    output = mech.executor.PrefixedOutput(stream)
+    output.write('not prefixed\n')
+    output.register('first')
+    output.write('one\ntw')
+    output.write('o\n')
+    output.write('partial')
+    output.unregister()
+    assert stream.getvalue() == 'not prefixed\nfirst: one\nfirst: two\nfirst: partial\n'
+
+
+def test_run_operation_results():
+    """Test how the outcome of an operation is recorded."""
+    assert mech.executor.run_operation('first', lambda name: None).ok
+    assert not mech.executor.run_operation('first', lambda name: False).ok
+
+    def exits(name):
+        sys.exit('boom')
+    result = mech.executor.run_operation('first', exits)
+    assert not result.ok
+    assert result.error == 'boom'
+
+    def raises(name):
+        raise ValueError('bad')
+    result = mech.executor.run_operation('first', raises)
+    assert not result.ok
+    assert result.error == 'ValueError: bad'
+
+
+@pytest.mark.parametrize('parallel', [1, 3])
+def test_run_on_instances(parallel, capsys):
+    """Test running an operation on multiple instances."""
+    def operation(name):
+        print('working on {}'.format(name))
+        return name != 'second'
+    results = mech.executor.run_on_instances(['first', 'second', 'third'], operation, parallel)
+    assert [result.name for result in results] == ['first', 'second', 'third']
+    assert [result.ok for result in results] == [True, False, True]
+    out = capsys.readouterr().out
+    assert 'first: working on first\n' in out
+    assert 'second: working on second\n' in out
+    assert 'third: working on third\n' in out
+
+
+def test_run_on_instances_single(capsys):
+    """Test output is not prefixed for a single instance."""
+    results = mech.executor.run_on_instances(['first'], lambda name: print('hi'), 4)
+    assert results[0].ok
+    assert capsys.readouterr().out == 'hi\n'
+
+
+@pytest.mark.parametrize('names', [['first'], ['first', 'second']])
+def test_run_on_instances_log(names, capsys, tmp_path):
+    """Test the output of each instance is also written to its log file."""
+    def operation(name):
+        print('working on {}'.format(name))
+    results = mech.executor.run_on_instances(
+        names, operation, 2, log=lambda name: str(tmp_path / '{}.log'.format(name)))
+    for result in results:
+        assert result.log == str(tmp_path / '{}.log'.format(result.name))
+        with open(result.log) as the_file:
+            assert the_file.read() == 'working on {}\n'.format(result.name)
+    out = capsys.readouterr().out
+    if len(names) == 1:
+        assert out == 'working on first\n'
+    else:
+        assert 'second: working on second\n' in out
+        mech.executor.finish(results)
+        assert 'second.log' in capsys.readouterr().out
+
+
+def test_finish(capsys):
+    """Test summary and exit code."""
+    ok = mech.executor.InstanceResult('first', ok=True, duration=1.0)
+    bad = mech.executor.InstanceResult('second', ok=False, duration=2.0)
+    mech.executor.finish([ok])
+    mech.executor.finish([ok, ok])
+    assert 'first' in capsys.readouterr().out
+    with pytest.raises(SystemExit) as exc:
+        mech.executor.finish([bad])
+    assert exc.value.code == 1
+    with pytest.raises(SystemExit) as exc:
+        mech.executor.finish([ok, bad])
+    assert 'Failed on 1 of 2 instances: second' in exc.value.code
+    assert 'FAILED' in capsys.readouterr().out
+
+
+def test_parse_stage_limits():
+    """Test parsing of stage limits."""
+    limits = mech.executor.parse_stage_limits(['boot=1'])
+    assert limits['boot'] == 1
+    assert limits['download'] == mech.executor.DEFAULT_STAGE_LIMITS['download']
+    with pytest.raises(SystemExit, match='Invalid stage limit'):
+        mech.executor.parse_stage_limits(['boot=0'])
+    with pytest.raises(SystemExit, match='Invalid stage limit'):
+        mech.executor.parse_stage_limits(['foo=2'])
+
+
+def test_dependency_order():
+    """Test instances are ordered after their dependencies."""
+    names = ['web', 'db', 'cache']
+    assert mech.executor.dependency_order(names, {}) == names
+    assert mech.executor.dependency_order(
+        names, {'web': ['db', 'missing'], 'db': ['cache']}) == ['cache', 'db', 'web']
+    with pytest.raises(SystemExit, match='Circular'):
+        mech.executor.dependency_order(names, {'web': ['db'], 'db': ['web']})
+
+
+def test_pipeline():
+    """Test shared work, dependencies and failures in a pipeline."""
+    pipeline = mech.executor.Pipeline({'boot': 1})
+    calls = []
+    waited = {}
+
+    def operation(name):
+        pipeline.once('box', lambda: calls.append(name), stage='download')
+        with pipeline.stage('boot'):
+            pass
+        if name == 'web':
+            waited[name] = pipeline.wait_for(['db', 'cache', 'missing'])
+        return name != 'cache'
+
+    names = ['db', 'cache', 'web']
+    results = pipeline.run(names, operation, parallel=3)
+    assert [result.ok for result in results] == [True, False, True]
+    assert len(calls) == 1
+    assert waited['web'] == ['cache']
+
+
+def test_pipeline_once_stage():
+    """Test the callers waiting for shared work do not hold a slot of its stage."""
+    pipeline = mech.executor.Pipeline({'download': 2})
+    release = threading.Event()
+
+    def download(name):
+        if name == 'box':
+            release.wait(5)
+        return name
+
+    first = threading.Thread(target=pipeline.once, args=('box', lambda: download('box')),
+                             kwargs={'stage': 'download'})
+    waiter = threading.Thread(target=pipeline.once, args=('box', lambda: download('box')),
+                              kwargs={'stage': 'download'})
+    first.start()
+    waiter.start()
+    time.sleep(0.1)
+    # the second slot is free for another box
+    started = time.monotonic()
+    assert pipeline.once('other', lambda: download('other'), stage='download') == 'other'
+    assert time.monotonic() - started < 2
+    release.set()
+    first.join()
+    waiter.join()
+
+
+def test_run_graph():
+    """Test nodes run after their dependencies (and independent ones at the same time)."""
+    order = []
+    both_running = threading.Barrier(2, timeout=5)
+
+    def operation(node):
+        if node in ('conf', 'packages'):
+            # both are independent, they run at the same time
+            both_running.wait()
+        order.append(node)
+        return node != 'broken'
+
+    depends_on = {'conf': ['skipped'], 'packages': [], 'app': ['conf', 'packages']}
+    results = mech.executor.run_graph(['conf', 'packages', 'app'], depends_on, operation, 2)
+    assert results == {'conf': True, 'packages': True, 'app': True}
+    assert order[-1] == 'app'
+
+    # sequential, and nothing is started after a failure
+    order[:] = []
+    results = mech.executor.run_graph(['one', 'broken', 'two'], {}, operation)
+    assert order == ['one', 'broken']
+    assert results == {'one': True, 'broken': False}
+
+    # only the nodes depending on the failed one are skipped
+    order[:] = []
+    depends_on = {'two': ['broken'], 'three': ['two']}
+    results = mech.executor.run_graph(['one', 'broken', 'two', 'three', 'four'], depends_on,
+                                      operation, fail_fast=False)
+    assert order == ['one', 'broken', 'four']
+    assert results == {'one': True, 'broken': False, 'four': True}
+
+
+def test_run_graph_output(capsys):
+    """Test the output of the nodes is prefixed like the output of their instance."""
+    def operation(name):
+        mech.executor.run_graph(['a', 'b'], {}, lambda node: print(node), 2)
+    mech.executor.run_on_instances(['first', 'second'], operation, 1)
+    out = capsys.readouterr().out
+    assert 'first: a\n' in out
+    assert 'second: b\n' in out
+
+
+def test_batcher():
+    """Test instances working at the same time share the work."""
+    calls = []
+
+    def operation(key, values):
+        calls.append((key, sorted(values)))
+        return {name: value * 2 for name, value in values.items()}
+
+    batcher = mech.executor.Batcher(operation, {'deploy': {'first', 'second', 'third'}})
+    for name in ('first', 'second'):
+        batcher.start(name)
+    results = {}
+
+    def work(name, value):
+        with batcher.working_on(name):
+            results[name] = batcher.run('deploy', name, value)
+
+    threads = [threading.Thread(target=work, args=args) for args in (('first', 1),
+                                                                     ('second', 2))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    # 'third' is not working, so it is not waited for
+    assert calls == [('deploy', ['first', 'second'])]
+    assert results == {'first': 2, 'second': 4}
+    # alone
+    assert batcher.run('other', 'third', 3) == 6
+    assert calls[-1] == ('other', ['third'])
@@ -0,0 +1,80 @@
+# Copyright (c) 2020 Mike Kinney
+"""Tests for the pool of fixed IP addresses."""
+import json
+import os
+from unittest.mock import patch
+
+import pytest
+from pytest import raises
+
+import mech.ip_pool
+
+
+@pytest.fixture(autouse=True)
+def pool_dir(tmp_path):
+    """Use a temporary .mech directory for the instances."""
+    with patch('mech.utils.mech_dir', return_value=str(tmp_path / '.mech')):
+        yield tmp_path
+
+
+def test_dhcp_settings():
+    """Test the host-only network settings of a subnet."""
+    assert mech.ip_pool.dhcp_settings() == {'ip': '192.168.56.1', 'netmask': '255.255.255.0',
+                                            'lower_ip': '192.168.56.100',
+                                            'upper_ip': '192.168.56.200'}
+    assert mech.ip_pool.dhcp_settings('10.1.0.0/22') == {'ip': '10.1.0.1',
+                                                         'netmask': '255.255.252.0',
+                                                         'lower_ip': '10.1.0.100',
+                                                         'upper_ip': '10.1.0.200'}
+    with raises(SystemExit, match=r"Invalid 'ip_subnet'"):
+        mech.ip_pool.dhcp_settings('10.1.0.0/33')
+    with raises(SystemExit, match=r"/24 or larger"):
+        mech.ip_pool.dhcp_settings('10.1.0.0/25')
+
+
+def test_allocate():
+    """Test addresses are given outside of the DHCP range and kept."""
+    assert mech.ip_pool.allocate('first') == '192.168.56.2'
+    assert mech.ip_pool.allocate('second') == '192.168.56.3'
+    assert mech.ip_pool.allocate('first') == '192.168.56.2'
+    assert mech.ip_pool.address('second') == '192.168.56.3'
+    assert mech.ip_pool.subnet() == '192.168.56.0/24'
+    mech.ip_pool.release('first')
+    assert mech.ip_pool.address('first') is None
+    assert mech.ip_pool.allocate('third') == '192.168.56.2'
+
+
+def test_allocate_projects(tmp_path):
+    """Test the pool is shared by the Mechfiles of the host."""
+    assert mech.ip_pool.allocate('first') == '192.168.56.2'
+    with patch('mech.utils.mech_dir', return_value=str(tmp_path / 'other' / '.mech')):
+        assert mech.ip_pool.address('first') is None
+        assert mech.ip_pool.allocate('first') == '192.168.56.3'
+        mech.ip_pool.release('first')
+    assert mech.ip_pool.address('first') == '192.168.56.2'
+    with open(mech.ip_pool.state_file()) as the_file:
+        assert list(json.load(the_file)['addresses']) == [
+            os.path.join(str(tmp_path), '.mech', 'first')]
+
+
+def test_allocate_wanted():
+    """Test giving a chosen address."""
+    assert mech.ip_pool.allocate('first', wanted='192.168.56.50') == '192.168.56.50'
+    for wanted in ('192.168.56.50', '192.168.56.150', '192.168.56.1', '10.0.0.5', 'bad'):
+        with raises(SystemExit, match=r"Cannot give"):
+            mech.ip_pool.allocate('second', wanted=wanted)
+
+
+def test_allocate_full():
+    """Test a /24 has room for 152 instances, a larger subnet for more."""
+    for i in range(152):
+        mech.ip_pool.allocate('vm{}'.format(i))
+    assert mech.ip_pool.address('vm98') == '192.168.56.201'
+    with raises(SystemExit, match=r"No free IP address left"):
+        mech.ip_pool.allocate('one_more')
+    with raises(SystemExit, match=r"same 'ip_subnet'"):
+        mech.ip_pool.allocate('one_more', '192.168.56.0/22')
+    for i in range(152):
+        mech.ip_pool.release('vm{}'.format(i))
+    assert mech.ip_pool.allocate('one_more', '192.168.56.0/22') == '192.168.56.2'
+    assert mech.ip_pool.subnet() == '192.168.56.0/22'
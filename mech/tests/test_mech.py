@@ -1,6 +1,8 @@
 # Copyright (c) 2020 Mike Kinney
 
 """mech tests"""
+import json
+import logging
 import os
 import re
 
@@ -9,6 +11,7 @@ from click.testing import CliRunner
 
 import mech.mech
 import mech.vmrun
+import mech.ip_pool
 from mech.mech_cli import cli
 import mech.mech_instance
 
@@ -85,6 +88,19 @@ def test_mech_ip_with_cloud():
         mock_cloud_run.assert_called()
 
 
+def test_mech_events(caplog):
+    """Test 'mech events' outputs one json object per line."""
+    # debug output (left on by the tests using --debug) would go to stdout
+    caplog.set_level(logging.WARNING, logger='mech')
+    runner = CliRunner()
+    events = [{'instance': 'first', 'event': 'started'},
+              {'instance': 'first', 'event': 'ip', 'ip': '192.168.1.145'}]
+    with patch('mech.event_stream.watch', return_value=iter(events)) as mock_watch:
+        result = runner.invoke(cli, ['events', 'first', '--interval', '5'])
+    mock_watch.assert_called_with(['first'], 5.0)
+    assert [json.loads(line) for line in result.output.splitlines()] == events
+
+
 def test_mech_ssh_with_cloud():
     """Test 'mech ssh' with cloud."""
     runner = CliRunner()
@@ -355,6 +371,28 @@ def test_mech_destroy_virtualbox(mock_locate, mock_load_mechfile,
     assert re.search(r'Deleted', result.output, re.MULTILINE)
 
 
+@patch('os.path.exists', return_value=True)
+@patch('shutil.rmtree')
+@patch('mech.vbm.VBoxManage.unregister')
+@patch('mech.vbm.VBoxManage.dhcp_remove_fixed_address')
+@patch('mech.vbm.VBoxManage.stop', return_value=True)
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value='/tmp/first/some.vbox')
+def test_mech_destroy_virtualbox_static_ip(mock_locate, mock_load_mechfile, mock_stop,
+                                           mock_dhcp_remove_fixed_address, mock_unregister,
+                                           mock_rmtree, mock_path_exists,
+                                           mechfile_one_entry_virtualbox):
+    """Test 'mech destroy' gives back the fixed address of the instance."""
+    mock_load_mechfile.return_value = mechfile_one_entry_virtualbox
+    mech.ip_pool.allocate('first')
+    runner = CliRunner()
+    result = runner.invoke(cli, ['destroy', '--force', 'first'])
+    assert re.search(r'Deleted', result.output, re.MULTILINE)
+    mock_dhcp_remove_fixed_address.assert_called_with('first', quiet=True)
+    mock_unregister.assert_called()
+    assert mech.ip_pool.address('first') is None
+
+
 @patch('os.path.exists', return_value=True)
 @patch('mech.utils.load_mechfile')
 @patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
@@ -405,6 +443,40 @@ def test_mech_down(mock_locate, mock_load_mechfile,
     assert re.search(r'Stopped', result.output, re.MULTILINE)
 
 
+@patch('mech.vmrun.VMrun.installed_tools', return_value='running')
+@patch('mech.vmrun.VMrun.stop', return_value=True)
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_down_parallel(mock_locate, mock_load_mechfile,
+                            mock_vmrun_stop, mock_installed_tools,
+                            mechfile_two_entries):
+    """Test 'mech down --parallel' prefixes output and prints a summary."""
+    mock_load_mechfile.return_value = mechfile_two_entries
+    runner = CliRunner()
+    result = runner.invoke(cli, ['down', '-j', '2'])
+    assert mock_vmrun_stop.call_count == 2
+    assert result.exit_code == 0
+    assert re.search(r'^first: Stopped', result.output, re.MULTILINE)
+    assert re.search(r'^second: Stopped', result.output, re.MULTILINE)
+    assert re.search(r'second\s+ok', result.output, re.MULTILINE)
+
+
+@patch('mech.vmrun.VMrun.installed_tools', return_value='running')
+@patch('mech.vmrun.VMrun.stop', side_effect=[True, None])
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_down_parallel_fails(mock_locate, mock_load_mechfile,
+                                  mock_vmrun_stop, mock_installed_tools,
+                                  mechfile_two_entries):
+    """Test 'mech down --parallel' exits non-zero when an instance fails."""
+    mock_load_mechfile.return_value = mechfile_two_entries
+    runner = CliRunner()
+    result = runner.invoke(cli, ['down', '--parallel', '1'])
+    assert result.exit_code == 1
+    assert re.search(r'^second: Not stopped', result.output, re.MULTILINE)
+    assert re.search(r'Failed on 1 of 2 instances: second', result.output, re.MULTILINE)
+
+
 @patch('mech.vbm.VBoxManage.stop', return_value=True)
 @patch('mech.utils.load_mechfile')
 @patch('mech.utils.locate', return_value='/tmp/first/some.vbox')
@@ -500,6 +572,21 @@ def test_mech_ip_unknown(mock_locate, mock_load_mechfile,
         assert re.search(r'Unknown', result.output, re.MULTILINE)
 
 
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_ip_all_wait(mock_locate, mock_load_mechfile, mechfile_two_entries):
+    """Test 'mech ip --wait' for all instances."""
+    mock_load_mechfile.return_value = mechfile_two_entries
+    runner = CliRunner()
+    with patch.object(mech.mech_instance.MechInstance,
+                      'get_ip', side_effect=['192.168.1.145', None]) as mock_get_ip:
+        result = runner.invoke(cli, ['ip', '--wait'])
+        assert mock_get_ip.call_count == 2
+        assert mock_get_ip.call_args[1]['wait']
+    assert re.search(r'^\w+ 192.168.1.145$', result.output, re.MULTILINE)
+    assert re.search(r'^\w+ Unknown IP address$', result.output, re.MULTILINE)
+
+
 @patch('mech.utils.load_mechfile')
 @patch('mech.utils.locate', return_value=None)
 def test_mech_ip_not_created(mock_locate, mock_load_mechfile,
@@ -585,17 +672,20 @@ versions/1578437753/providers/vmware_desktop.box",
         ]
     },
 }
-@patch('mech.utils.provision_file', return_value=True)
+@patch('mech.utils.provision_files', return_value=True)
 @patch('mech.utils.load_mechfile', return_value=MECHFILE_WITH_PROVISIONING)
 @patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
 def test_mech_provision_file(mock_locate, mock_load_mechfile,
-                             mock_provision_file):
+                             mock_provision_files):
     """Test 'mech provision' (using file provisioning)."""
     runner = CliRunner()
     result = runner.invoke(cli, ['provision', 'first'])
     mock_locate.assert_called()
     mock_load_mechfile.assert_called()
-    mock_provision_file.assert_called()
+    # both (consecutive) files are copied together
+    mock_provision_files.assert_called_once()
+    assert mock_provision_files.call_args[0][1] == [('file1.txt', '/tmp/file1.txt'),
+                                                    ('file2.txt', '/tmp/file2.txt')]
     assert re.search(r' Provision ', result.output, re.MULTILINE)
 
 
@@ -650,6 +740,35 @@ def test_mech_provision_shell(mock_locate, mock_load_mechfile,
     assert re.search(r' Provision ', result.output, re.MULTILINE)
 
 
+@patch('mech.utils.provision_shell', return_value=(0, '', ''))
+@patch('mech.utils.load_mechfile', return_value=MECHFILE_WITH_PROVISIONING)
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_provision_only(mock_locate, mock_load_mechfile, mock_provision_shell):
+    """Test 'mech provision --only N'."""
+    runner = CliRunner()
+    result = runner.invoke(cli, ['provision', '--only', '3', 'second'])
+    assert result.exit_code == 0
+    mock_provision_shell.assert_called_once()
+    assert mock_provision_shell.call_args[0][1] == 'echo hello from inline'
+    result = runner.invoke(cli, ['provision', '--from', '0', 'second'])
+    assert result.exit_code == 2
+
+
+@patch('mech.utils.provision', side_effect=lambda inst, *args, **kwargs: inst.name != 'second')
+@patch('mech.utils.log_file', return_value=None)
+@patch('mech.utils.load_mechfile', return_value=MECHFILE_WITH_PROVISIONING)
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_provision_parallel(mock_locate, mock_load_mechfile, mock_log_file,
+                                 mock_provision):
+    """Test 'mech provision -j N' on all instances."""
+    runner = CliRunner()
+    result = runner.invoke(cli, ['provision', '-j', '2'])
+    assert mock_provision.call_count == 4
+    mock_log_file.assert_any_call('first', 'provision')
+    assert result.exit_code == 1
+    assert re.search(r'Failed on 1 of 4 instances: second', '{}'.format(result.exception))
+
+
 @patch('mech.vmrun.VMrun.suspend', return_value=True)
 @patch('mech.utils.load_mechfile')
 @patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
@@ -1151,6 +1270,51 @@ def test_mech_up_virtualbox(mock_locate, mock_load_mechfile,
     mock_memory.assert_called()
 
 
+@patch('mech.utils.provision')
+@patch('mech.utils.start_vm', return_value=True)
+@patch('mech.utils.init_box', return_value='/tmp/first/one.vmx')
+@patch('mech.utils.report_provider', return_value=True)
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value=None)
+def test_mech_up_parallel(mock_locate, mock_load_mechfile, mock_report_provider,
+                          mock_init_box, mock_start_vm, mock_provision,
+                          mechfile_two_entries):
+    """Test 'mech up --parallel' with a shared box and depends_on."""
+    mechfile_two_entries['first']['depends_on'] = 'second'
+    mock_load_mechfile.return_value = mechfile_two_entries
+    runner = CliRunner()
+    result = runner.invoke(cli, ['up', '-j', '2', '--stage-limit', 'boot=1'])
+    assert result.exit_code == 0
+    assert mock_init_box.call_count == 2
+    # 'second' is brought up before 'first' (which depends on it)
+    assert [call[0][0].name for call in mock_start_vm.call_args_list] == ['second', 'first']
+    assert mock_provision.call_count == 2
+
+
+@patch('mech.utils.provision')
+@patch('mech.utils.start_vm', return_value=True)
+@patch('mech.utils.clone_instance', return_value='/tmp/second/second.vmx')
+@patch('mech.utils.init_box', return_value='/tmp/first/one.vmx')
+@patch('mech.utils.report_provider', return_value=True)
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value=None)
+def test_mech_up_linked_clone(mock_locate, mock_load_mechfile, mock_report_provider,
+                              mock_init_box, mock_clone_instance, mock_start_vm,
+                              mock_provision, mechfile_two_entries):
+    """Test 'mech up' with a template and a linked clone of it."""
+    mechfile_two_entries['first']['template'] = True
+    mechfile_two_entries['second']['clone_from'] = 'first'
+    mock_load_mechfile.return_value = mechfile_two_entries
+    runner = CliRunner()
+    result = runner.invoke(cli, ['up', '-j', '2'])
+    assert result.exit_code == 0
+    assert re.search(r"'first' is a template", result.output)
+    mock_init_box.assert_called_once()
+    assert mock_clone_instance.call_args[0][1].name == 'first'
+    # the template is not started
+    assert [call[0][0].name for call in mock_start_vm.call_args_list] == ['second']
+
+
 @patch('mech.utils.report_provider', return_value=True)
 @patch('mech.vmrun.VMrun.start', return_value='')
 @patch('mech.utils.load_mechfile')
@@ -1499,7 +1663,7 @@ def test_mech_port_without_nat_from_mac(mock_locate, mock_load_mechfile,
     assert re.search(r'Cannot find a nat network', result.output, re.MULTILINE)
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 @patch('os.path.exists')
 @patch('os.getcwd')
 def test_mech_init(mock_os_getcwd, mock_os_path_exists,
@@ -1509,6 +1673,7 @@ def test_mech_init(mock_os_getcwd, mock_os_path_exists,
     mock_os_path_exists.return_value = False
     mock_requests_get.return_value.status_code = 200
     mock_requests_get.return_value.json.return_value = catalog_as_json
+    mock_requests_get.return_value.headers = {}
     runner = CliRunner()
     result = runner.invoke(cli, ['init', 'bento/ubuntu-18.04'])
     assert re.search(r'Loading metadata', result.output, re.MULTILINE)
@@ -1561,7 +1726,7 @@ def test_mech_init_with_invalid_location(mock_os_getcwd, mock_os_path_exists):
 
 
 @patch('mech.utils.report_provider', return_value=True)
-@patch('requests.get')
+@patch('requests.Session.get')
 @patch('os.getcwd')
 def test_mech_add_mechfile_exists(mock_os_getcwd,
                                   mock_requests_get, mock_report_provider,
@@ -1570,6 +1735,7 @@ def test_mech_add_mechfile_exists(mock_os_getcwd,
     mock_os_getcwd.return_value = '/tmp'
     mock_requests_get.return_value.status_code = 200
     mock_requests_get.return_value.json.return_value = catalog_as_json
+    mock_requests_get.return_value.headers = {}
     runner = CliRunner()
     result = runner.invoke(cli, ['--debug', 'add', 'second', 'bento/ubuntu-18.04'])
     mock_os_getcwd.assert_called()
@@ -1769,6 +1935,33 @@ def test_mech_scp_guest_to_host_not_created(mock_locate,
         mock_load_mechfile.assert_called()
 
 
+@patch('mech.utils.copy_to_guest', return_value=(0, '', ''))
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_scp_tar(mock_locate, mock_load_mechfile, mock_copy_to_guest,
+                      mechfile_two_entries):
+    """Test 'mech scp --tar' with several sources."""
+    mock_load_mechfile.return_value = mechfile_two_entries
+    runner = CliRunner()
+    result = runner.invoke(cli, ['scp', '--tar', 'conf/*', 'scripts', 'first:/tmp/'])
+    assert result.exit_code == 0
+    mock_copy_to_guest.assert_called_once()
+    assert mock_copy_to_guest.call_args[0][1:] == (('conf/*', 'scripts'), '/tmp/')
+    mock_copy_to_guest.return_value = (1, '', 'Cannot find (conf/*)')
+    result = runner.invoke(cli, ['scp', '--tar', 'conf/*', 'first:/tmp/'])
+    assert result.exit_code == 1
+    assert re.search(r'Cannot find', result.output)
+    result = runner.invoke(cli, ['scp', '--tar', 'conf/*', '/tmp/'])
+    assert re.search(r'DST must be an instance', '{}'.format(result.exception))
+
+
+def test_mech_scp_too_many_paths():
+    """Test 'mech scp' with several sources (without --tar)."""
+    runner = CliRunner()
+    result = runner.invoke(cli, ['scp', 'a', 'b', 'c', 'first:/tmp/'])
+    assert re.search(r'use --tar', '{}'.format(result.exception))
+
+
 def test_mech_scp_both_are_guests():
     """Test 'mech scp'."""
     runner = CliRunner()
@@ -102,7 +102,7 @@ def test_mech_box_list_one_box_legacy(mock_os_getcwd):
         assert re.search(r'ubuntu-18.04', result.output, re.MULTILINE)
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 @patch('os.path.exists')
 @patch('os.getcwd')
 def test_mech_box_add_new(mock_os_getcwd, mock_os_path_exists,
@@ -113,6 +113,7 @@ def test_mech_box_add_new(mock_os_getcwd, mock_os_path_exists,
     runner = CliRunner()
     mock_requests_get.return_value.status_code = 200
     mock_requests_get.return_value.json.return_value = catalog_as_json
+    mock_requests_get.return_value.headers = {}
     result = runner.invoke(cli, ['box', 'add', '--provider', 'vmware', 'bento/ubuntu-18.04'])
     assert re.search(r'Checking integrity', result.output, re.MULTILINE)
 
@@ -132,7 +133,7 @@ def test_mech_box_remove_with_invalid_provider():
     assert re.search(r'Need to provide valid provider', result.output, re.MULTILINE)
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 @patch('os.path.exists')
 @patch('os.getcwd')
 def test_mech_box_add_existing(mock_os_getcwd, mock_os_path_exists,
@@ -143,6 +144,7 @@ def test_mech_box_add_existing(mock_os_getcwd, mock_os_path_exists,
     runner = CliRunner()
     mock_requests_get.return_value.status_code = 200
     mock_requests_get.return_value.json.return_value = catalog_as_json
+    mock_requests_get.return_value.headers = {}
     result = runner.invoke(cli, ['box', 'add', 'bento/ubuntu-18.04'])
     assert re.search(r'Loading metadata', result.output, re.MULTILINE)
 
@@ -161,6 +163,20 @@ def test_mech_box_remove_exists(mock_os_path_exists, mock_rmtree):
     assert re.search(r'Removed ', result.output, re.MULTILINE)
 
 
+@patch('mech.utils.remove_box_templates')
+@patch('mech.utils.remove_extracted_boxes', return_value=['abcd'])
+@patch('shutil.rmtree')
+@patch('os.path.exists', return_value=True)
+def test_mech_box_remove_virtualbox(mock_os_path_exists, mock_rmtree,
+                                    mock_remove_extracted_boxes, mock_remove_box_templates):
+    """Test 'mech box remove' deletes the template VMs of the box."""
+    runner = CliRunner()
+    result = runner.invoke(cli, ['box', 'remove', '--version', 'somever',
+                                 '--provider', 'virtualbox', '--name', 'bento/ubuntu-18.04'])
+    assert re.search(r'Removed ', result.output, re.MULTILINE)
+    assert mock_remove_box_templates.call_args[0][1] == ['abcd']
+
+
 @patch('os.path.exists')
 def test_mech_box_remove_does_not_exists(mock_os_path_exists):
     """Test 'mech box remove'."""
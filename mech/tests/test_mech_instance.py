@@ -35,6 +35,71 @@ def test_mech_instance_windows(mock_locate, mechfile_one_entry_windows):
     assert inst.windows is True
 
 
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_instance_provision_parallel(mock_locate, mechfile_one_entry_windows):
+    """Test the max number of provisioner entries run at the same time."""
+    inst = mech.mech.MechInstance('first', mechfile_one_entry_windows)
+    assert inst.provision_parallel == mech.mech_instance.DEFAULT_PROVISION_PARALLEL
+    mechfile_one_entry_windows['first']['provision_parallel'] = '8'
+    inst = mech.mech.MechInstance('first', mechfile_one_entry_windows)
+    assert inst.provision_parallel == 8
+
+
+@patch('mech.readiness.wait_for_port', return_value=True)
+@patch('mech.ip_pool.address', return_value='192.168.56.2')
+@patch('mech.utils.locate', return_value='/tmp/first/some.vbox')
+def test_mech_instance_get_ip_static(mock_locate, mock_address, mock_wait_for_port,
+                                     mechfile_one_entry_virtualbox):
+    """Test the ip address of an instance with a static ip is known."""
+    mechfile_one_entry_virtualbox['first']['static_ip'] = 'true'
+    inst = mech.mech.MechInstance('first', mechfile_one_entry_virtualbox)
+    assert inst.static_ip is True
+    with patch('mech.vbm.VBoxManage.ip') as mock_ip:
+        assert inst.get_ip(wait=True) == '192.168.56.2'
+        mock_ip.assert_not_called()
+    mock_wait_for_port.assert_called_with('192.168.56.2', 22, inst.ready_timeout)
+    # without waiting, only while the VM is running
+    with patch('mech.vbm.VBoxManage.vm_state', return_value='running'):
+        inst = mech.mech.MechInstance('first', mechfile_one_entry_virtualbox)
+        assert inst.get_ip() == '192.168.56.2'
+    with patch('mech.vbm.VBoxManage.vm_state', return_value='powered off'), \
+            patch('mech.vbm.VBoxManage.ip', return_value=None):
+        inst = mech.mech.MechInstance('first', mechfile_one_entry_virtualbox)
+        assert inst.get_ip() is None
+
+
+@patch('mech.vmrun.VMrun.get_guest_ip_address', return_value="192.168.1.100")
+@patch('mech.dhcp_leases.vmware_ip', side_effect=['192.168.1.101', None])
+@patch('mech.utils.locate')
+def test_mech_instance_get_ip_dhcp(mock_locate, mock_vmware_ip, mock_get_ip_address,
+                                   mechfile_one_entry, tmp_path):
+    """Test getting the ip address from the DHCP leases."""
+    vmx = tmp_path / 'some.vmx'
+    vmx.write_text('ethernet0.present = "TRUE"\nethernet0.generatedAddress = "00:0c:29:aa:bb:cc"\n')
+    mock_locate.return_value = str(vmx)
+    mechfile_one_entry['first']['ip_resolver'] = 'dhcp'
+    inst = mech.mech.MechInstance('first', mechfile_one_entry)
+    assert inst.get_mac() == '00:0c:29:aa:bb:cc'
+    assert inst.get_ip() == '192.168.1.101'
+    mock_vmware_ip.assert_called_with('00:0c:29:aa:bb:cc')
+    mock_get_ip_address.assert_not_called()
+    # no lease: ask the guest
+    inst = mech.mech.MechInstance('first', mechfile_one_entry)
+    assert inst.get_ip() == '192.168.1.100'
+    mock_get_ip_address.assert_called()
+
+
+@patch('mech.vmrun.VMrun.get_guest_ip_address', return_value="192.168.1.100")
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_instance_ready_timeout(mock_locate, mock_get_ip_address, mechfile_one_entry):
+    """Test the IP address is waited for at most ready_timeout seconds."""
+    mechfile_one_entry['first']['ready_timeout'] = '20'
+    inst = mech.mech.MechInstance('first', mechfile_one_entry)
+    assert inst.ready_timeout == 20
+    inst.get_ip(wait=True)
+    assert mock_get_ip_address.call_args[1]['timeout'] == 20
+
+
 @patch('mech.vmrun.VMrun.get_guest_ip_address', return_value="192.168.1.100")
 @patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
 def test_mech_instance_get_ip(mock_locate, mock_get_ip_address,
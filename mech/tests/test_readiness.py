@@ -0,0 +1,69 @@
+# Copyright (c) 2020 Mike Kinney
+"""Tests for readiness (waiting for instances)."""
+import socket
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import mech.readiness
+
+
+def test_delays():
+    """Test the delays double up to the maximum."""
+    delays = mech.readiness.delays(initial=1, maximum=5)
+    assert [next(delays) for _ in range(5)] == [1, 2, 4, 5, 5]
+
+
+def test_wait_until():
+    """Test wait_until returns what check returned."""
+    results = iter([None, '', 'ready'])
+    time_lefts = []
+
+    def check(time_left):
+        time_lefts.append(time_left)
+        return next(results)
+
+    with patch('mech.readiness.time.sleep') as mock_sleep:
+        assert mech.readiness.wait_until(check, timeout=60) == 'ready'
+    assert [c[0][0] for c in mock_sleep.call_args_list] == [0.5, 1]
+    assert all(0 < time_left <= 60 for time_left in time_lefts)
+
+
+def test_wait_until_timeout():
+    """Test wait_until gives up after the timeout."""
+    check = MagicMock(return_value=None)
+    start = time.monotonic()
+    assert mech.readiness.wait_until(check, timeout=0.05, initial=0.01) is None
+    assert time.monotonic() - start < 1
+    assert check.call_count >= 2
+
+
+def test_wait_for_port():
+    """Test waiting for something to listen on a port."""
+    with socket.socket() as server:
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        assert mech.readiness.wait_for_port('127.0.0.1', port, timeout=5)
+    assert not mech.readiness.wait_for_port('127.0.0.1', port, timeout=0.05)
+
+
+def test_wait_for_ips():
+    """Test instances are waited for at the same time, and given as they are ready."""
+    first_ready = threading.Event()
+    first = MagicMock()
+    first.get_ip.side_effect = lambda wait, timeout: first_ready.wait(5) and '192.168.1.1'
+    second = MagicMock()
+    second.get_ip.return_value = None
+
+    results = mech.readiness.wait_for_ips([first, second], timeout=30)
+    assert next(results) == (second, None)
+    first_ready.set()
+    assert next(results) == (first, '192.168.1.1')
+    assert list(results) == []
+    first.get_ip.assert_called_with(wait=True, timeout=30)
+
+
+def test_wait_for_ips_none():
+    """Test waiting for no instances."""
+    assert list(mech.readiness.wait_for_ips([])) == []
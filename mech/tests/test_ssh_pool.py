@@ -0,0 +1,171 @@
+# Copyright (c) 2020 Mike Kinney
+"""Tests for the in-process ssh transport."""
+import os
+import stat
+import subprocess
+from unittest.mock import patch, MagicMock
+
+import paramiko
+
+import mech.mech_instance
+import mech.ssh_pool
+import mech.utils
+
+
+CONFIG_SSH = {
+    'Host': 'first',
+    'HostName': '192.168.2.120',
+    'User': 'vagrant',
+    'Port': '22',
+    'IdentityFile': '/tmp/insecure_private_key',
+}
+
+
+def mock_client(exit_status=0, stdout=b'some output\n', stderr=b''):
+    """Return a mocked paramiko.SSHClient."""
+    client = MagicMock()
+    client.get_transport.return_value.is_active.return_value = True
+    out = MagicMock()
+    out.read.return_value = stdout
+    out.channel.recv_exit_status.return_value = exit_status
+    err = MagicMock()
+    err.read.return_value = stderr
+    client.exec_command.return_value = (MagicMock(), out, err)
+    return client
+
+
+@patch('paramiko.SSHClient')
+def test_run_reuses_connection(mock_ssh_client):
+    """Test commands are run on new channels of one (pooled) connection."""
+    client = mock_client(stderr=b'warning')
+    mock_ssh_client.return_value = client
+    try:
+        assert mech.ssh_pool.run('first', CONFIG_SSH, 'uptime') == (0, 'some output', 'warning')
+        assert mech.ssh_pool.run('first', CONFIG_SSH, 'hostname')[0] == 0
+        client.connect.assert_called_once_with(
+            hostname='192.168.2.120', port=22, username='vagrant',
+            key_filename='/tmp/insecure_private_key', look_for_keys=False,
+            allow_agent=False, timeout=mech.ssh_pool.SSH_CONNECT_TIMEOUT)
+        assert client.exec_command.call_count == 2
+        # a dead connection is replaced
+        client.get_transport.return_value.is_active.return_value = False
+        mech.ssh_pool.run('first', CONFIG_SSH, 'uptime')
+        assert client.connect.call_count == 2
+    finally:
+        mech.ssh_pool.close('first')
+    client.close.assert_called()
+
+
+@patch('paramiko.SSHClient')
+def test_run_cannot_connect(mock_ssh_client):
+    """Test a connection error is reported like ssh does."""
+    mock_ssh_client.return_value.connect.side_effect = paramiko.SSHException('no way')
+    assert mech.ssh_pool.run('first', CONFIG_SSH, 'uptime') == (255, '', 'no way')
+    assert 'first' not in mech.ssh_pool._POOL
+
+
+@patch('paramiko.SSHClient')
+def test_copy(mock_ssh_client):
+    """Test copying files with SFTP."""
+    client = mock_client()
+    mock_ssh_client.return_value = client
+    sftp = client.open_sftp.return_value
+    sftp.stat.side_effect = IOError('No such file')
+    try:
+        assert mech.ssh_pool.copy('first', CONFIG_SSH, '/tmp/a', '/tmp/b', True) == (0, '', '')
+        sftp.put.assert_called_once_with('/tmp/a', '/tmp/b')
+        assert mech.ssh_pool.copy('first', CONFIG_SSH, '/tmp/b', '/tmp/a', False) == (0, '', '')
+        sftp.get.assert_called_once_with('/tmp/b', '/tmp/a')
+        sftp.put.side_effect = IOError('No such file')
+        assert mech.ssh_pool.copy('first', CONFIG_SSH, '/tmp/c', '/tmp/b', True)[0] == 1
+    finally:
+        mech.ssh_pool.close('first')
+
+
+@patch('paramiko.SSHClient')
+def test_copy_directories(mock_ssh_client, tmp_path, monkeypatch):
+    """Test copying into directories, the home directory and '~' paths (like scp)."""
+    client = mock_client()
+    mock_ssh_client.return_value = client
+    sftp = client.open_sftp.return_value
+    sftp.normalize.return_value = '/home/vagrant'
+    directories = ('/home/vagrant', '/tmp/')
+
+    def sftp_stat(path):
+        if path not in directories:
+            raise IOError('No such file')
+        return MagicMock(st_mode=stat.S_IFDIR | 0o755)
+    sftp.stat.side_effect = sftp_stat
+    monkeypatch.setenv('HOME', str(tmp_path))
+    try:
+        # to the instance
+        for dst, expected in (('', '/home/vagrant/a.txt'), ('/tmp/', '/tmp/a.txt'),
+                              ('~', '/home/vagrant/a.txt'), ('~/b.txt', '/home/vagrant/b.txt')):
+            sftp.put.reset_mock()
+            assert mech.ssh_pool.copy('first', CONFIG_SSH, '/src/a.txt', dst, True)[0] == 0
+            sftp.put.assert_called_once_with('/src/a.txt', expected)
+        # from the instance
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / 'dir').mkdir()
+        for src, dst, expected in (
+                ('/etc/hosts', '.', ('/etc/hosts', os.path.join('.', 'hosts'))),
+                ('/etc/hosts', '', ('/etc/hosts', os.path.join('.', 'hosts'))),
+                ('/etc/hosts', str(tmp_path / 'dir'),
+                 ('/etc/hosts', str(tmp_path / 'dir' / 'hosts'))),
+                ('~/x', '~', ('/home/vagrant/x', str(tmp_path / 'x'))),
+                ('~/x', 'y', ('/home/vagrant/x', 'y'))):
+            sftp.get.reset_mock()
+            assert mech.ssh_pool.copy('first', CONFIG_SSH, src, dst, False)[0] == 0
+            sftp.get.assert_called_once_with(*expected)
+    finally:
+        mech.ssh_pool.close('first')
+
+
+@patch('mech.ssh_pool.run', return_value=(0, 'up', ''))
+@patch('subprocess.run')
+@patch('mech.utils.vm_ready_based_on_state', return_value=True)
+def test_utils_ssh_uses_pool(mock_ready, mock_subprocess_run, mock_run, mechfile_one_entry,
+                             monkeypatch):
+    """Test utils.ssh() runs commands in process with the 'paramiko' transport."""
+    monkeypatch.setenv('MECH_SSH_TRANSPORT', 'paramiko')
+    inst = mech.mech_instance.MechInstance('first', mechfile_one_entry)
+    inst.created = True
+    with patch.object(inst, 'config_ssh', return_value=CONFIG_SSH):
+        assert mech.utils.ssh(inst, 'uptime', command_args='-p') == (0, 'up', '')
+    mock_run.assert_called_once_with('first', CONFIG_SSH, 'uptime -p', stdin=None)
+    mock_subprocess_run.assert_not_called()
+    # extra ssh arguments need the ssh command
+    mock_subprocess_run.return_value = subprocess.CompletedProcess(
+        args='', returncode=0, stdout=b'', stderr=b'')
+    with patch.object(inst, 'config_ssh', return_value=CONFIG_SSH):
+        mech.utils.ssh(inst, 'uptime', extra='-q')
+    mock_subprocess_run.assert_called_once()
+
+
+@patch('paramiko.SSHClient')
+def test_run_with_stdin(mock_ssh_client):
+    """Test sending data to the standard input of a command."""
+    client = mock_client()
+    mock_ssh_client.return_value = client
+    try:
+        mech.ssh_pool.run('first', CONFIG_SSH, 'bash -s --', stdin='echo hello')
+    finally:
+        mech.ssh_pool.close('first')
+    command_stdin = client.exec_command.return_value[0]
+    command_stdin.write.assert_called_once_with(b'echo hello')
+    command_stdin.channel.shutdown_write.assert_called_once()
+
+
+@patch('paramiko.SSHClient')
+def test_run_with_stdin_writer(mock_ssh_client):
+    """Test a function writing the standard input of a command (ex: a tar stream)."""
+    client = mock_client()
+    mock_ssh_client.return_value = client
+    try:
+        mech.ssh_pool.run('first', CONFIG_SSH, 'tar -x -f -',
+                          stdin=lambda stream: stream.write(b'data'))
+    finally:
+        mech.ssh_pool.close('first')
+    command_stdin = client.exec_command.return_value[0]
+    command_stdin.write.assert_called_once_with(b'data')
+    command_stdin.channel.shutdown_write.assert_called_once()
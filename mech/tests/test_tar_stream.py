@@ -0,0 +1,82 @@
+# Copyright (c) 2020 Mike Kinney
+"""Tests for copying files as a tar stream."""
+import io
+import os
+import tarfile
+from unittest.mock import patch
+
+from pytest import raises
+
+import mech.tar_stream
+
+
+def write_file(path, data):
+    """Write data to path."""
+    with open(path, 'wb') as the_file:
+        the_file.write(data)
+
+
+def make_tree(tmp_path):
+    """Create some files to copy."""
+    os.makedirs(str(tmp_path / 'conf' / 'sub'))
+    write_file(str(tmp_path / 'conf' / 'a.txt'), b'a' * 1000)
+    write_file(str(tmp_path / 'conf' / 'b.txt'), b'b' * 1000)
+    write_file(str(tmp_path / 'conf' / 'sub' / 'c.txt'), b'c' * 1000)
+    write_file(str(tmp_path / 'archive.tar.gz'), b'x' * 10000)
+
+
+def test_expand(tmp_path):
+    """Test expanding files, directories and globs."""
+    make_tree(tmp_path)
+    members = mech.tar_stream.expand([str(tmp_path / 'conf' / '*.txt'),
+                                      str(tmp_path / 'conf' / 'sub') + '/'], 'tmp/dst')
+    assert members == [(str(tmp_path / 'conf' / 'a.txt'), 'tmp/dst/a.txt'),
+                       (str(tmp_path / 'conf' / 'b.txt'), 'tmp/dst/b.txt'),
+                       (str(tmp_path / 'conf' / 'sub') + '/', 'tmp/dst/sub')]
+    assert mech.tar_stream.expand([str(tmp_path / 'archive.tar.gz')], '') == [
+        (str(tmp_path / 'archive.tar.gz'), 'archive.tar.gz')]
+
+
+def test_expand_missing(tmp_path):
+    """Test expanding sources which do not exist."""
+    with raises(OSError, match=r'Cannot find'):
+        mech.tar_stream.expand([str(tmp_path / '*.txt')], '')
+    with raises(OSError, match=r'Cannot find'):
+        mech.tar_stream.expand([str(tmp_path / 'missing.txt')], '')
+
+
+def test_choose_compression(tmp_path):
+    """Test choosing the compression depending on the content."""
+    make_tree(tmp_path)
+    conf = [(str(tmp_path / 'conf'), 'conf')]
+    archive = [(str(tmp_path / 'archive.tar.gz'), 'archive.tar.gz')]
+    assert mech.tar_stream.choose_compression(conf) == 'gzip'
+    assert mech.tar_stream.choose_compression(conf + archive) is None
+    assert mech.tar_stream.choose_compression([]) is None
+    with patch('mech.tar_stream.zstd_available', return_value=True):
+        assert mech.tar_stream.choose_compression(conf, zstd=True) == 'zstd'
+    with patch('mech.tar_stream.zstd_available', return_value=False):
+        assert mech.tar_stream.choose_compression(conf, zstd=True) == 'gzip'
+
+
+def test_write(tmp_path):
+    """Test writing (and reading back) a tar stream."""
+    make_tree(tmp_path)
+    members = [(str(tmp_path / 'conf'), 'tmp/conf'),
+               (str(tmp_path / 'archive.tar.gz'), 'tmp/other.tar.gz')]
+    for compression, mode in ((None, 'r|'), ('gzip', 'r|gz')):
+        stream = io.BytesIO()
+        mech.tar_stream.writer(members, compression)(stream)
+        stream.seek(0)
+        with tarfile.open(fileobj=stream, mode=mode) as tar:
+            names = sorted(tar.getnames())
+        assert names == ['tmp/conf', 'tmp/conf/a.txt', 'tmp/conf/b.txt', 'tmp/conf/sub',
+                         'tmp/conf/sub/c.txt', 'tmp/other.tar.gz']
+
+
+def test_extract_command():
+    """Test the commands extracting the stream in the guest."""
+    assert mech.tar_stream.extract_command('') == 'tar -x -f -'
+    assert mech.tar_stream.extract_command('/', 'gzip') == 'mkdir -p / && tar -xz -f - -C /'
+    assert mech.tar_stream.extract_command('my dir', 'zstd') == \
+        "mkdir -p 'my dir' && zstd -dcq | tar -x -f - -C 'my dir'"
@@ -1,13 +1,17 @@
 # Copyright (c) 2020 Mike Kinney
 
 """Test mech utils."""
+import hashlib
+import io
 import os
 import re
 import sys
+import tarfile
+import threading
 import requests
 import subprocess
 
-from unittest.mock import patch, mock_open, MagicMock
+from unittest.mock import patch, mock_open, MagicMock, call
 from collections import OrderedDict
 from pytest import raises
 
@@ -112,6 +116,23 @@ def test_start_vm_vbm(mechfile_one_entry):
                         mock_create_hostonly.assert_called()
 
 
+@patch('mech.vbm.VBoxManage.guestproperty_set')
+@patch('mech.vbm.VBoxManage.dhcp_fixed_address')
+@patch('mech.vbm.VBoxManage.configure_hostonly')
+def test_assign_static_ip(mock_configure_hostonly, mock_dhcp_fixed_address,
+                          mock_guestproperty_set, mechfile_one_entry_virtualbox, tmp_path):
+    """Test an instance with a static ip gets its address at first boot."""
+    mechfile_one_entry_virtualbox['first']['static_ip'] = True
+    mechfile_one_entry_virtualbox['first']['ip_subnet'] = '10.1.0.0/22'
+    inst = mech.mech_instance.MechInstance('first', mechfile_one_entry_virtualbox)
+    with patch('mech.utils.mech_dir', return_value=str(tmp_path)):
+        assert mech.utils.assign_static_ip(inst, mech.vbm.VBoxManage()) == '10.1.0.2'
+        assert mech.ip_pool.address('first') == '10.1.0.2'
+    mock_configure_hostonly.assert_called_with('10.1.0.0/22', quiet=True)
+    mock_dhcp_fixed_address.assert_called_with('first', '10.1.0.2', quiet=True)
+    mock_guestproperty_set.assert_called_with('first', '/mech/ip', '10.1.0.2', quiet=True)
+
+
 def test_unpause_vm_vbm(mechfile_one_entry):
     """Test unpause_vm()."""
     inst = mech.mech_instance.MechInstance('first', mechfile_one_entry)
@@ -850,7 +871,7 @@ def test_build_mechfile_entry_file_location_but_file_not_found():
             mech.utils.build_mechfile_entry(location='file:/tmp/one.box')
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 def test_build_mechfile_entry_file_location_external_good(mock_requests_get,
                                                           catalog_as_json):
     """Test if location talks to Hashicorp."""
@@ -866,6 +887,7 @@ versions/aaa/providers/vmware_desktop.box'
     }
     mock_requests_get.return_value.status_code = 200
     mock_requests_get.return_value.json.return_value = catalog_as_json
+    mock_requests_get.return_value.headers = {}
     actual = mech.utils.build_mechfile_entry(location='bento/ubuntu-18.04')
     mock_requests_get.assert_called()
     assert expected == actual
@@ -1076,6 +1098,363 @@ def test_provision_shell(mock_create_tempfile, mock_isfile,
     assert re.search(r'Executing program', out, re.MULTILINE)
 
 
+@patch('mech.utils.ssh', return_value=(0, 'hello', ''))
+@patch('mech.utils.scp')
+@patch('mech.utils.create_tempfile_in_guest')
+def test_provision_shell_over_stdin(mock_create_tempfile, mock_scp, mock_ssh,
+                                    mechfile_one_entry_with_auth_and_mech_use):
+    """Test provision_shell sending the script over stdin."""
+    inst = mech.mech_instance.MechInstance('first',
+                                           mechfile_one_entry_with_auth_and_mech_use)
+    inst.created = True
+    got = mech.utils.provision_shell(inst, inline='echo hello', script_path=None,
+                                     args=['a=1', None], stdin=True)
+    assert got == (0, 'hello', '')
+    mock_ssh.assert_called_once_with(instance=inst, command='bash -s --', command_args='a=1',
+                                     stdin='echo hello')
+    # nothing is copied to (or created in) the guest
+    mock_create_tempfile.assert_not_called()
+    mock_scp.assert_not_called()
+
+
+@patch('mech.utils.ssh', return_value=(0, '', ''))
+@patch('mech.utils.scp', return_value=(0, '', ''))
+@patch('mech.utils.create_tempfile_in_guest', return_value='/tmp/foo')
+def test_provision_shell_over_stdin_not_shell(mock_create_tempfile, mock_scp, mock_ssh,
+                                              mechfile_one_entry_with_auth_and_mech_use):
+    """Test a script for another interpreter is still copied to the guest."""
+    inst = mech.mech_instance.MechInstance('first',
+                                           mechfile_one_entry_with_auth_and_mech_use)
+    inst.created = True
+    mech.utils.provision_shell(inst, inline='#!/usr/bin/env python3\nprint(1)',
+                               script_path=None, stdin=True)
+    mock_create_tempfile.assert_called()
+    mock_scp.assert_called()
+
+
+def test_runs_in_shell():
+    """Test runs_in_shell."""
+    assert mech.utils.runs_in_shell('echo hello')
+    assert mech.utils.runs_in_shell('#!/bin/bash\necho hello')
+    assert mech.utils.runs_in_shell('#!/usr/bin/env sh\necho hello')
+    assert not mech.utils.runs_in_shell('#!/usr/bin/python3\nprint(1)')
+    assert mech.utils.runs_in_shell('#!\necho hello')
+    assert mech.utils.runs_in_shell('#!  \necho hello')
+
+
+def test_stream_to_command():
+    """Test writing the standard input of a command while it runs."""
+    got = mech.utils.stream_to_command(['sh', '-c', 'wc -c; echo oops >&2'],
+                                       lambda stream: stream.write(b'x' * 100000))
+    assert got == (0, '100000', 'oops')
+    # the command does not read everything
+    got = mech.utils.stream_to_command(['sh', '-c', 'exit 3'],
+                                       lambda stream: stream.write(b'x' * 10000000))
+    assert got[0] == 3
+
+
+def test_guest_path():
+    """Test guest_path."""
+    assert mech.utils.guest_path('/tmp/file1.txt') == ('/', 'tmp/file1.txt')
+    assert mech.utils.guest_path('~/file1.txt') == ('', 'file1.txt')
+    assert mech.utils.guest_path('conf/file1.txt') == ('', 'conf/file1.txt')
+
+
+@patch('mech.utils.ssh')
+def test_tar_to_guest(mock_ssh, tmp_path):
+    """Test copying files with a tar stream (zstd is only used if the guest has it)."""
+    source = tmp_path / 'file1.txt'
+    source.write_text('hello' * 100)
+    members = [(str(source), 'tmp/file1.txt')]
+    mock_inst = MagicMock()
+    mock_inst.name = 'tar-to-guest'
+    mock_ssh.side_effect = [(1, '', ''), (0, '', ''), (0, '', '')]
+    with patch('mech.tar_stream.zstd_available', return_value=True):
+        assert mech.utils.tar_to_guest(mock_inst, members, '/') == (0, '', '')
+        mech.utils.tar_to_guest(mock_inst, members, '/')
+    assert mock_ssh.call_args_list[0][0] == (mock_inst, 'command -v zstd')
+    assert mock_ssh.call_args_list[1][0] == (mock_inst, 'mkdir -p / && tar -xz -f - -C /')
+    # the guest is only checked once
+    assert mock_ssh.call_count == 3
+
+
+@patch('mech.utils.tar_to_guest', return_value=(0, '', ''))
+@patch('mech.utils.scp', return_value=(0, '', ''))
+def test_provision_files(mock_scp, mock_tar_to_guest, tmp_path):
+    """Test consecutive file provisioners are copied with one tar stream per directory."""
+    for name in ('file1.txt', 'file2.txt', 'file3.txt'):
+        (tmp_path / name).write_text(name)
+    mock_inst = MagicMock()
+    mock_inst.windows = False
+    files = [(str(tmp_path / 'file1.txt'), '/tmp/file1.txt'),
+             (str(tmp_path / 'file2.txt'), '/etc/file2.txt'),
+             (str(tmp_path / 'file*.txt'), 'conf')]
+    assert mech.utils.provision_files(mock_inst, files) == (0, '', '')
+    mock_scp.assert_not_called()
+    assert mock_tar_to_guest.call_args_list == [
+        call(mock_inst, [(str(tmp_path / 'file1.txt'), 'tmp/file1.txt'),
+                         (str(tmp_path / 'file2.txt'), 'etc/file2.txt')], '/'),
+        call(mock_inst, [(str(tmp_path / 'file1.txt'), 'conf/file1.txt'),
+                         (str(tmp_path / 'file2.txt'), 'conf/file2.txt'),
+                         (str(tmp_path / 'file3.txt'), 'conf/file3.txt')], '')]
+    # like scp, into a destination ending with '/'
+    (tmp_path / 'dir').mkdir()
+    mock_tar_to_guest.reset_mock()
+    mech.utils.provision_files(mock_inst, [(str(tmp_path / 'file1.txt'), '/etc/app/'),
+                                           (str(tmp_path / 'dir'), '~/'),
+                                           (str(tmp_path / 'file2.txt'), 'conf/')])
+    assert mock_tar_to_guest.call_args_list == [
+        call(mock_inst, [(str(tmp_path / 'file1.txt'), 'etc/app/file1.txt')], '/'),
+        call(mock_inst, [(str(tmp_path / 'dir'), 'dir'),
+                         (str(tmp_path / 'file2.txt'), 'conf/file2.txt')], '')]
+    # a single file is still copied with scp
+    mech.utils.provision_files(mock_inst, files[:1])
+    mock_scp.assert_called_once()
+    # failures
+    assert mech.utils.provision_files(mock_inst, [(str(tmp_path / 'missing'), '/tmp/')] * 2) \
+        is None
+    mock_tar_to_guest.return_value = (2, '', 'tar: Cannot open')
+    assert mech.utils.provision_files(mock_inst, files) is None
+
+
+def test_log_file(tmp_path, monkeypatch):
+    """Test log_file."""
+    monkeypatch.chdir(tmp_path)
+    assert mech.utils.log_file('first', 'provision') is None
+    os.makedirs(os.path.join('.mech', 'first'))
+    got = mech.utils.log_file('first', 'provision')
+    assert re.search(r'first/logs/provision-[0-9-]+\.log$', got)
+    assert os.path.isdir(os.path.dirname(got))
+
+
+def test_provision_fingerprint(tmp_path):
+    """Test the fingerprints of provisioner entries."""
+    script = tmp_path / 'file1.sh'
+    script.write_text('echo one')
+    entry = {'type': 'shell', 'path': str(script), 'args': ['a=1']}
+    first = mech.utils.provision_fingerprint(entry)
+    assert first == mech.utils.provision_fingerprint(dict(entry))
+    assert first != mech.utils.provision_fingerprint(dict(entry, args=['a=2']))
+    script.write_text('echo two')
+    assert first != mech.utils.provision_fingerprint(entry)
+    assert mech.utils.provision_fingerprint({'type': 'file', 'source': str(tmp_path / 'no'),
+                                             'destination': '/tmp/no'}) is None
+    remote = {'type': 'shell', 'path': 'https://example.com/install.sh'}
+    with patch('mech.utils.provision_artifact', return_value='echo one') as mock_artifact:
+        content = mech.utils.provision_fingerprint(remote)
+        mock_artifact.return_value = 'echo two'
+        assert mech.utils.provision_fingerprint(remote) != content
+        mock_artifact.return_value = None
+        assert mech.utils.provision_fingerprint(remote) is None
+
+
+def test_provision_artifact(provision_cache, capfd):
+    """Test remote provisioning scripts are cached and revalidated."""
+    url = 'https://example.com/install.sh'
+    with patch('requests.Session.get') as mock_get:
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.content = b'echo one'
+        mock_get.return_value.headers = {'etag': '"v1"'}
+        assert mech.utils.provision_artifact(url) == 'echo one'
+        # validated once per run
+        assert mech.utils.provision_artifact(url) == 'echo one'
+        assert mock_get.call_count == 1
+        assert 'Downloading' in capfd.readouterr()[0]
+        assert len(os.listdir(provision_cache)) == 2
+
+        # next run: not modified
+        mech.utils._ARTIFACTS.clear()
+        mock_get.return_value.status_code = 304
+        mock_get.return_value.content = b''
+        assert mech.utils.provision_artifact(url) == 'echo one'
+        assert mock_get.call_args[1]['headers'] == {'If-None-Match': '"v1"'}
+        assert 'Downloading' not in capfd.readouterr()[0]
+
+        # server cannot be reached: the cached copy is used
+        mech.utils._ARTIFACTS.clear()
+        mock_get.side_effect = requests.ConnectionError()
+        assert mech.utils.provision_artifact(url) == 'echo one'
+        assert mech.utils.provision_artifact('https://example.com/other.sh') is None
+
+
+def test_provision_artifact_offline(monkeypatch, capfd):
+    """Test only cached provisioning scripts are used when offline."""
+    monkeypatch.setenv('MECH_OFFLINE', '1')
+    with patch('requests.Session.get') as mock_get:
+        assert mech.utils.provision_artifact('https://example.com/install.sh') is None
+        mock_get.assert_not_called()
+    assert 'Offline' in capfd.readouterr()[0]
+
+
+@patch('mech.utils.provision_artifact')
+def test_prefetch_provision_artifacts(mock_artifact):
+    """Test remote provisioning scripts are fetched in the background."""
+    first = MagicMock()
+    first.provision = [{'type': 'shell', 'path': 'https://example.com/a.sh'},
+                       {'type': 'shell', 'path': 'local.sh'},
+                       {'type': 'file', 'source': 'https://example.com/b.txt'}]
+    second = MagicMock()
+    second.provision = [{'type': 'pyinfra', 'path': 'https://example.com/a.sh'},
+                        {'type': 'ps', 'path': 'https://example.com/c.ps1'}]
+    for thread in mech.utils.prefetch_provision_artifacts([first, second]):
+        thread.join()
+    assert sorted(c[0][0] for c in mock_artifact.call_args_list) == \
+        ['https://example.com/a.sh', 'https://example.com/c.ps1']
+
+
+@patch('mech.utils.provision_shell', return_value=(0, '', ''))
+def test_provision_incremental(mock_provision_shell, tmp_path, capfd):
+    """Test unchanged provisioner entries are skipped."""
+    mock_inst = MagicMock()
+    mock_inst.path = str(tmp_path)
+    mock_inst.provider = 'vmware'
+    mock_inst.provision = [{'type': 'shell', 'inline': 'echo {}'.format(i)} for i in range(3)]
+    mech.utils.provision(mock_inst)
+    assert mock_provision_shell.call_count == 3
+    state = mech.utils.load_provision_state(mock_inst)
+    assert len(state) == 3
+    # again, nothing changed
+    mock_provision_shell.reset_mock()
+    mech.utils.provision(mock_inst)
+    mock_provision_shell.assert_not_called()
+    out, _ = capfd.readouterr()
+    assert re.search(r'Nothing to provision \(unchanged', out)
+    # the second entry (and the ones after it) are run again
+    mock_inst.provision[1]['inline'] = 'echo changed'
+    mech.utils.provision(mock_inst)
+    assert [c[0][1] for c in mock_provision_shell.call_args_list] == ['echo changed', 'echo 2']
+    # forced
+    mock_provision_shell.reset_mock()
+    mech.utils.provision(mock_inst, force=True)
+    assert mock_provision_shell.call_count == 3
+    mock_provision_shell.reset_mock()
+    mech.utils.provision(mock_inst, only=2)
+    assert [c[0][1] for c in mock_provision_shell.call_args_list] == ['echo changed']
+    mock_provision_shell.reset_mock()
+    mech.utils.provision(mock_inst, start=3)
+    assert [c[0][1] for c in mock_provision_shell.call_args_list] == ['echo 2']
+    with raises(SystemExit, match=r'No provisioner entry 4'):
+        mech.utils.provision(mock_inst, only=4)
+    # a failed entry is run again the next time
+    mock_inst.provision[2]['inline'] = 'exit 1'
+    mock_provision_shell.return_value = (1, '', '')
+    mech.utils.provision(mock_inst)
+    mock_provision_shell.reset_mock()
+    mech.utils.provision(mock_inst)
+    assert [c[0][1] for c in mock_provision_shell.call_args_list] == ['exit 1']
+
+
+@patch('mech.utils.scp', return_value=(0, '', ''))
+@patch('mech.utils.create_tempfile_in_guest', return_value='/tmp/foo')
+def test_provision_failing_script_not_recorded(mock_create_tempfile, mock_scp, tmp_path):
+    """Test a failing inline script (copied to the guest) is not recorded as done."""
+    mock_inst = MagicMock()
+    mock_inst.path = str(tmp_path)
+    mock_inst.provider = 'vmware'
+    mock_inst.provision = [{'type': 'shell', 'inline': 'exit 1'}]
+
+    def ssh(instance, command, command_args=None, **kwargs):
+        return (1, '', 'failed') if command == '/tmp/foo' else (0, '', '')
+
+    with patch('mech.utils.ssh', side_effect=ssh) as mock_ssh:
+        assert mech.utils.provision(mock_inst) is False
+        # the script is removed from the guest anyway
+        assert mock_ssh.call_args[0][1] == 'rm -f "/tmp/foo"'
+    assert not any(mech.utils.load_provision_state(mock_inst))
+
+
+def test_provision_dependencies():
+    """Test the dependencies between provisioner entries."""
+    entries = [{'type': 'shell', 'inline': 'one', 'id': 'packages'},
+               {'type': 'file', 'source': 'a', 'destination': 'a', 'id': 'conf', 'after': []},
+               {'type': 'shell', 'inline': 'three'},
+               {'type': 'shell', 'inline': 'four', 'after': ['packages', 'conf']}]
+    assert mech.utils.provision_dependencies(entries) == [[], [], [1], [0, 1]]
+    entries[0]['after'] = 'missing'
+    with raises(SystemExit, match=r"Unknown provisioner id\(s\) in 'after' of entry 1"):
+        mech.utils.provision_dependencies(entries)
+    entries[0]['after'] = 'conf'
+    entries[1]['after'] = 'packages'
+    with raises(SystemExit, match=r"Circular 'after'"):
+        mech.utils.provision_dependencies(entries)
+    entries[2]['id'] = 'conf'
+    with raises(SystemExit, match=r"Duplicate provisioner id 'conf'"):
+        mech.utils.provision_dependencies(entries)
+
+
+def test_provision_tasks():
+    """Test consecutive file entries are grouped."""
+    entries = [{'type': 'file'}, {'type': 'file'}, {'type': 'file', 'after': []},
+               {'type': 'shell'}, {'type': 'file'}, {'type': 'file'}]
+    assert mech.utils.provision_tasks(entries, range(6)) == [[0, 1], [2], [3], [4, 5]]
+    assert mech.utils.provision_tasks(entries, [0, 4, 5]) == [[0], [4, 5]]
+
+
+@patch('mech.utils.provision_files', return_value=(0, '', ''))
+@patch('mech.utils.provision_shell')
+def test_provision_graph(mock_provision_shell, mock_provision_files, tmp_path):
+    """Test independent provisioner entries run at the same time."""
+    both_running = threading.Barrier(2, timeout=5)
+
+    def provision_shell(instance, inline, path, args, stdin=False):
+        if inline == 'install packages':
+            both_running.wait()
+        return 0, '', ''
+
+    def provision_files(instance, files):
+        both_running.wait()
+        return 0, '', ''
+    mock_provision_shell.side_effect = provision_shell
+    mock_provision_files.side_effect = provision_files
+    (tmp_path / 'a.conf').write_text('a')
+    (tmp_path / 'b.conf').write_text('b')
+    mock_inst = MagicMock()
+    mock_inst.path = str(tmp_path)
+    mock_inst.provider = 'vmware'
+    mock_inst.provision_parallel = 4
+    mock_inst.provision = [
+        {'type': 'shell', 'inline': 'install packages', 'id': 'packages'},
+        {'type': 'file', 'source': str(tmp_path / 'a.conf'), 'destination': '/etc/a.conf',
+         'id': 'conf', 'after': []},
+        {'type': 'file', 'source': str(tmp_path / 'b.conf'), 'destination': '/etc/b.conf'},
+        {'type': 'shell', 'inline': 'start app', 'after': ['packages', 'conf']},
+    ]
+    assert mech.utils.provision(mock_inst)
+    # both files were copied together
+    mock_provision_files.assert_called_once()
+    assert mock_provision_shell.call_args[0][1] == 'start app'
+    # only the changed entry and the ones depending on it are run again
+    mock_provision_shell.reset_mock()
+    mock_inst.provision[0]['inline'] = 'install more packages'
+    assert mech.utils.provision(mock_inst)
+    assert [c[0][1] for c in mock_provision_shell.call_args_list] == [
+        'install more packages', 'start app']
+    mock_provision_files.assert_called_once()
+
+
+@patch('mech.utils.provision_shell')
+def test_provision_after_failed_entry(mock_provision_shell, capfd, tmp_path):
+    """Test the entries after a failed entry are skipped, the independent ones are run."""
+    mock_provision_shell.side_effect = lambda instance, inline, path, args, stdin=False: (
+        (1, '', 'failed') if inline == 'install packages' else (0, '', ''))
+    mock_inst = MagicMock()
+    mock_inst.path = str(tmp_path)
+    mock_inst.provider = 'vmware'
+    mock_inst.provision_parallel = 1
+    mock_inst.provision = [
+        {'type': 'shell', 'inline': 'install packages', 'id': 'packages'},
+        {'type': 'shell', 'inline': 'start app', 'id': 'app', 'after': ['packages']},
+        {'type': 'shell', 'inline': 'check app', 'after': ['app']},
+        {'type': 'shell', 'inline': 'set motd', 'after': []},
+    ]
+    assert mech.utils.provision(mock_inst) is False
+    assert [c[0][1] for c in mock_provision_shell.call_args_list] == [
+        'install packages', 'set motd']
+    out, _ = capfd.readouterr()
+    assert 'Failed entries: 1' in out
+    assert 'Skipped entries (after a failed entry): 2, 3' in out
+
+
 @patch('mech.utils.winrm_execute_ps', return_value=(0, '', ''))
 @patch('os.path.isfile', return_value=True)
 def test_provision_ps_file(mock_isfile, mock_winrm, capfd, mechfile_one_entry_windows):
@@ -1167,7 +1546,7 @@ def test_provision_ps_none(capfd, mechfile_one_entry_windows):
     assert re.search(r'Need to provide', out, re.MULTILINE)
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 @patch('mech.utils.winrm_execute_ps', return_value=(0, '', ''))
 @patch('os.path.isfile', return_value=False)
 def test_provision_ps_http(mock_isfile, mock_winrm, mock_requests_get,
@@ -1179,7 +1558,8 @@ def test_provision_ps_http(mock_isfile, mock_winrm, mock_requests_get,
     inst.created = True
     mock_requests_get.return_value.status_code = 200
     mock_requests_get.return_value.raise_for_status.return_value = None
-    mock_requests_get.return_value.read.return_value = 'echo hello'
+    mock_requests_get.return_value.content = b'echo hello'
+    mock_requests_get.return_value.headers = {}
     mech.utils.provision_ps(inst, inline=False, script_path='http://example.com/file1.ps')
     out, _ = capfd.readouterr()
     mock_isfile.assert_called()
@@ -1244,7 +1624,7 @@ def test_provision_shell_make_executable_fails(mock_create_tempfile, mock_isfile
     assert re.search(r'Warning: Could not configure script', out, re.MULTILINE)
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 @patch('mech.utils.ssh', return_value=[True, True, True])
 @patch('mech.utils.scp', return_value=True)
 @patch('os.path.isfile', return_value=False)
@@ -1261,7 +1641,8 @@ def test_provision_shell_from_http(mock_create_tempfile, mock_isfile,
     inst.created = True
     mock_requests_get.return_value.status_code = 200
     mock_requests_get.return_value.raise_for_status.return_value = None
-    mock_requests_get.return_value.read.return_value = 'echo hello'
+    mock_requests_get.return_value.content = b'echo hello'
+    mock_requests_get.return_value.headers = {}
     mech.utils.provision_shell(inst, inline=False, script_path='http://example.com/file1.sh',
                                args=None)
     out, _ = capfd.readouterr()
@@ -1275,7 +1656,7 @@ def test_provision_shell_from_http(mock_create_tempfile, mock_isfile,
     assert re.search(r'Executing program', out, re.MULTILINE)
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 @patch('os.path.isfile', return_value=False)
 @patch('mech.utils.create_tempfile_in_guest', return_value='/tmp/foo')
 def test_provision_shell_from_http_response_none(mock_create_tempfile, mock_isfile,
@@ -1289,7 +1670,8 @@ def test_provision_shell_from_http_response_none(mock_create_tempfile, mock_isfi
     inst.vmx = some_vmx
     inst.created = True
     mock_requests_get.return_value.raise_for_status.return_value = None
-    mock_requests_get.return_value.read.return_value = None
+    mock_requests_get.return_value.content = b''
+    mock_requests_get.return_value.headers = {}
     mech.utils.provision_shell(inst, inline=False, script_path='http://example.com/file1.sh',
                                args=None)
     out, _ = capfd.readouterr()
@@ -1299,7 +1681,7 @@ def test_provision_shell_from_http_response_none(mock_create_tempfile, mock_isfi
     assert re.search(r'No script to execute', out, re.MULTILINE)
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 @patch('os.path.isfile', return_value=False)
 @patch('mech.utils.create_tempfile_in_guest', return_value='/tmp/foo')
 def test_provision_shell_from_http_connection_error(mock_create_tempfile, mock_isfile,
@@ -1319,7 +1701,7 @@ def test_provision_shell_from_http_connection_error(mock_create_tempfile, mock_i
     mock_requests_get.assert_called()
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 @patch('os.path.isfile', return_value=False)
 @patch('mech.utils.create_tempfile_in_guest', return_value='/tmp/foo')
 def test_provision_shell_from_http_error(mock_create_tempfile, mock_isfile,
@@ -1485,7 +1867,7 @@ def test_provision_pyinfra(mock_os_path_isfile, mock_run_pyinfra_script, mechfil
     mock_run_pyinfra_script.assert_called()
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 @patch('mech.utils.run_pyinfra_script')
 @patch('os.path.isfile')
 def test_provision_pyinfra_script_is_http(mock_os_path_isfile, mock_run_pyinfra_script,
@@ -1494,15 +1876,15 @@ def test_provision_pyinfra_script_is_http(mock_os_path_isfile, mock_run_pyinfra_
     mock_os_path_isfile.return_value = False
     mock_requests_get.return_value.status_code = 200
     mock_requests_get.return_value.raise_for_status.return_value = None
-    mock_requests_get.return_value.read.return_value = 'some pyinfra script'
-    mock_requests_get.return_value.text = 'some pyinfra script'
+    mock_requests_get.return_value.content = b'some pyinfra script'
+    mock_requests_get.return_value.headers = {}
     inst = mech.mech_instance.MechInstance('first', mechfile_one_entry)
     mech.utils.provision_pyinfra(inst, 'http://example.com/foo')
     mock_os_path_isfile.assert_called()
     mock_run_pyinfra_script.assert_called()
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 @patch('os.path.isfile')
 def test_provision_pyinfra_script_is_http_connection_error(mock_os_path_isfile,
                                                            mock_requests_get,
@@ -1516,7 +1898,7 @@ def test_provision_pyinfra_script_is_http_connection_error(mock_os_path_isfile,
     mock_requests_get.assert_called()
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 @patch('os.path.isfile')
 def test_provision_pyinfra_script_is_http_error(mock_os_path_isfile,
                                                 mock_requests_get,
@@ -1543,6 +1925,95 @@ def test_provision_pyinfra_script_cannot_find(mock_os_path_isfile,
     assert re.search(r'Cannot open', out, re.MULTILINE)
 
 
+def test_split_pyinfra_output():
+    """Test splitting the output of pyinfra per host."""
+    hosts = {'first': '192.168.1.100', 'second': '192.168.1.101'}
+    stdout = ('--> Loading config...\n'
+              '[192.168.1.100] Success\n'
+              '[192.168.1.101] Error: apt-get failed\n')
+    got = mech.utils.split_pyinfra_output(1, stdout, '', hosts)
+    assert got['first'] == (0, '--> Loading config...\n[192.168.1.100] Success', '')
+    assert got['second'][0] == 1
+    assert got['second'][1].endswith('apt-get failed')
+    # failed, but not on a host in particular
+    got = mech.utils.split_pyinfra_output(2, '--> Loading config...', 'oops', hosts)
+    assert got['first'][0] == 2
+    assert got['second'][0] == 2
+    # a host which is not known to have succeeded failed
+    hosts['third'] = '192.168.1.102'
+    stdout = ('[192.168.1.100] Success\n'
+              '[192.168.1.101] Error: apt-get failed\n'
+              '[192.168.1.102] Connected\n')
+    got = mech.utils.split_pyinfra_output(1, stdout, '', hosts)
+    assert [got[name][0] for name in ('first', 'second', 'third')] == [0, 1, 1]
+    # a success does not hide a later error
+    stdout = '[192.168.1.100] Success\n[192.168.1.100] Error: failed\n'
+    assert mech.utils.split_pyinfra_output(1, stdout, '', hosts)['first'][0] == 1
+
+
+@patch('mech.utils.pyinfra_installed', return_value=True)
+@patch('subprocess.run')
+def test_run_pyinfra_inventory(mock_subprocess_run, mock_pyinfra_installed):
+    """Test running pyinfra once on several instances."""
+    inventories = []
+
+    def run(command, capture_output):
+        with open(command[3]) as the_file:
+            inventories.append(the_file.read())
+        return subprocess.CompletedProcess(args=command, returncode=0,
+                                           stdout=b'[10.0.0.1] Success\n[10.0.0.2] Success\n',
+                                           stderr=b'')
+    mock_subprocess_run.side_effect = run
+    insts = []
+    for name, host in (('first', '10.0.0.1'), ('second', '10.0.0.2')):
+        inst = MagicMock()
+        inst.name = name
+        inst.user = 'vagrant'
+        inst.password = 'secret'
+        inst.get_ip.return_value = host
+        insts.append(inst)
+    got = mech.utils.run_pyinfra_inventory(insts, 'deploy.py')
+    assert got == {'first': (0, '[10.0.0.1] Success', ''),
+                   'second': (0, '[10.0.0.2] Success', '')}
+    command = mock_subprocess_run.call_args[0][0]
+    assert command[:3] == ['pyinfra', '--parallel', '2']
+    assert command[4] == 'deploy.py'
+    assert "('10.0.0.2', {'ssh_user': 'vagrant', 'mech_name': 'second', " \
+        "'ssh_password': 'secret'})" in inventories[0]
+    assert not os.path.exists(command[3])
+    assert mech.utils.run_pyinfra_inventory(insts, 'deploy.sh') == {}
+
+
+@patch('mech.utils.run_pyinfra_inventory')
+@patch('os.path.isfile', return_value=True)
+def test_pyinfra_batcher(mock_isfile, mock_run_pyinfra_inventory):
+    """Test pyinfra entries shared by instances are run once."""
+    mock_run_pyinfra_inventory.return_value = {'first': (0, 'done', ''),
+                                               'second': (0, 'done', '')}
+    insts = {}
+    for name in ('first', 'second', 'third'):
+        insts[name] = MagicMock()
+        insts[name].name = name
+        insts[name].provision = [{'type': 'pyinfra', 'path': 'deploy.py', 'args': ['a=1']}]
+    insts['third'].provision[0]['args'] = ['a=2']
+    batcher = mech.utils.pyinfra_batcher(insts.values())
+    key = ('deploy.py', '["a=1"]')
+    assert batcher.candidates == {key: {'first', 'second'}}
+    for name in ('first', 'second'):
+        batcher.start(name)
+    results = {}
+
+    def work(name):
+        results[name] = mech.utils.provision_task(insts[name], insts[name].provision, batcher)
+    threads = [threading.Thread(target=work, args=(name,)) for name in ('first', 'second')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    mock_run_pyinfra_inventory.assert_called_once()
+    assert results == {'first': (0, 'done', ''), 'second': (0, 'done', '')}
+
+
 def test_pyinfra_installed():
     """Test pyinfra_installed"""
     mock_subprocess = MagicMock()
@@ -1627,11 +2098,16 @@ def test_init_box_cannot_find_valid_box(mock_locate):
         mech.utils.init_box(name='first')
 
 
+@patch('mech.utils.create_instance_files')
+@patch('mech.utils.box_digest', return_value='abcd')
 @patch('mech.utils.makedirs', return_value=True)
 @patch('mech.utils.add_box')
 @patch('mech.utils.locate')
-def test_init_box_cannot_extract_box(mock_locate, mock_add_box, mock_makedirs):
+def test_init_box_cannot_extract_box(mock_locate, mock_add_box, mock_makedirs,
+                                     mock_box_digest, mock_create_instance_files,
+                                     tmp_path, monkeypatch):
     """Test init_box."""
+    monkeypatch.chdir(tmp_path)
     a_mock = MagicMock()
     another_mock = MagicMock()
     yet_another_mock = MagicMock()
@@ -1649,13 +2125,18 @@ def test_init_box_cannot_extract_box(mock_locate, mock_add_box, mock_makedirs):
             mech.utils.init_box(name='first', box='bento/ubuntu', box_version='1.23')
 
 
+@patch('mech.utils.create_instance_files')
+@patch('mech.utils.box_digest', return_value='abcd')
 @patch('tarfile.open')
 @patch('mech.utils.makedirs', return_value=True)
 @patch('mech.utils.add_box')
 @patch('mech.utils.locate')
 def test_init_box_when_no_vmx_after_extraction(mock_locate, mock_add_box,
-                                               mock_makedirs, mock_tarfile_open):
+                                               mock_makedirs, mock_tarfile_open,
+                                               mock_box_digest, mock_create_instance_files,
+                                               tmp_path, monkeypatch):
     """Test init_box."""
+    monkeypatch.chdir(tmp_path)
     mock_subprocess_popen = MagicMock()
     mock_tarfile_open = MagicMock()
     yet_another_mock = MagicMock()
@@ -1673,14 +2154,19 @@ def test_init_box_when_no_vmx_after_extraction(mock_locate, mock_add_box,
             mock_tarfile_open.assert_called()
 
 
+@patch('mech.utils.create_instance_files')
+@patch('mech.utils.box_digest', return_value='abcd')
 @patch('mech.utils.update_vmx', return_value='/tmp/first/some.vmx')
 @patch('tarfile.open')
 @patch('mech.utils.makedirs', return_value=True)
 @patch('mech.utils.add_box')
 @patch('mech.utils.locate')
 def test_init_box_success_vmware(mock_locate, mock_add_box, mock_makedirs,
-                                 mock_tarfile_open, mock_update_vmx):
+                                 mock_tarfile_open, mock_update_vmx,
+                                 mock_box_digest, mock_create_instance_files,
+                                 tmp_path, monkeypatch):
     """Test init_box."""
+    monkeypatch.chdir(tmp_path)
     mock_subprocess_popen = MagicMock()
     mock_tarfile_open = MagicMock()
     mock_tarfile_open.returncode = 0
@@ -1698,81 +2184,92 @@ def test_init_box_success_vmware(mock_locate, mock_add_box, mock_makedirs,
         mech.utils.init_box(name='first', box='bento/ubuntu', box_version='1.23')
         mock_locate.assert_called()
         mock_add_box.assert_called()
-        mock_makedirs.assert_called()
+        mock_create_instance_files.assert_called()
         mock_update_vmx.assert_called()
 
 
-@patch('subprocess.Popen')
-@patch('tarfile.open')
-@patch('mech.utils.makedirs', return_value=True)
+@patch.object(mech.vbm.VBoxManage, 'clonevm', return_value='')
+@patch.object(mech.vbm.VBoxManage, 'snapshot', return_value='')
+@patch.object(mech.vbm.VBoxManage, 'hide', return_value='')
+@patch.object(mech.vbm.VBoxManage, 'importvm', return_value='')
+@patch('mech.utils.extract_box', return_value='/tmp/extracted/abcd')
 @patch('mech.utils.add_box')
 @patch('mech.utils.locate')
-def test_init_box_success_virtualbox(mock_locate, mock_add_box, mock_makedirs,
-                                     mock_tarfile_open, mock_popen):
+def test_init_box_success_virtualbox(mock_locate, mock_add_box, mock_extract_box, mock_import,
+                                     mock_hide, mock_snapshot, mock_clonevm):
     """Test init_box."""
-    process_mock = MagicMock()
-    attrs = {'communicate.return_value': ('output', 'error')}
-    process_mock.configure_mock(**attrs)
-    mock_popen.return_value = process_mock
-    mock_tarfile_open = MagicMock()
-    mock_tarfile_open.returncode = 0
-    mock_locate.side_effect = [None, None, '/tmp/boxes/some.box',
-                               '/tmp/first/some.ovf', '/tmp/first/some.vbox']
+    mock_locate.side_effect = ['/tmp/boxes/some.box', None, '/tmp/extracted/abcd/some.ovf',
+                               '/tmp/templates/mech-template-abcd/mech-template-abcd.vbox',
+                               '/tmp/first/first.vbox']
     mock_add_box.return_value = 'bento', '1.23', 'ubuntu'
-    expected = '/tmp/first/some.vbox'
-    with patch.object(mech.vbm.VBoxManage, 'importvm') as mock_import:
-        with patch('mech.utils.rmtree') as mock_rmtree:
-            got = mech.utils.init_box(name='first', box='bento/ubuntu',
-                                      box_version='1.23', provider='virtualbox',
-                                      instance_path='/tmp/first', save=False)
-            mock_locate.assert_called()
-            mock_add_box.assert_called()
-            mock_makedirs.assert_called()
-            mock_popen.assert_called()
-            mock_rmtree.assert_called()
-            mock_import.assert_called()
-            assert got == expected
-
-
-@patch('subprocess.Popen')
-@patch('tarfile.open')
-@patch('mech.utils.makedirs', return_value=True)
+    got = mech.utils.init_box(name='first', box='bento/ubuntu',
+                              box_version='1.23', provider='virtualbox',
+                              instance_path='/tmp/first')
+    assert got == '/tmp/first/first.vbox'
+    mock_extract_box.assert_called_once_with('/tmp/boxes/some.box')
+    # the box is imported (once) as a template VM, the instance is a linked clone of it
+    mock_import.assert_called_once()
+    assert mock_import.call_args[1]['name'] == 'mech-template-abcd'
+    mock_hide.assert_called_once_with('mech-template-abcd', quiet=True)
+    mock_snapshot.assert_called_once_with('mech-template-abcd', 'mech-template', quiet=True)
+    mock_clonevm.assert_called_once()
+    assert mock_clonevm.call_args[0] == ('mech-template-abcd', 'first')
+    assert mock_clonevm.call_args[1]['linked']
+    with mech.utils.template_records() as records:
+        assert records == {'mech-template-abcd': {'clones': ['/tmp/first']}}
+
+
+@patch.object(mech.vbm.VBoxManage, 'unregister')
+def test_template_clones(mock_unregister, templates_dir):
+    """Test a template VM is only deleted once its box is removed and it has no clone."""
+    mech.utils.add_template_clone('mech-template-abcdef012345', '/tmp/one/.mech/first')
+    mech.utils.add_template_clone('mech-template-abcdef012345', '/tmp/two/.mech/first')
+    mech.utils.remove_box_templates(mech.vbm.VBoxManage(), ['abcdef0123456789'])
+    mock_unregister.assert_not_called()
+    mech.utils.remove_template_clone(mech.vbm.VBoxManage(), '/tmp/one/.mech/first')
+    mock_unregister.assert_not_called()
+    mech.utils.remove_template_clone(mech.vbm.VBoxManage(), '/tmp/two/.mech/first')
+    mock_unregister.assert_called_once_with('mech-template-abcdef012345', delete=True,
+                                            quiet=True)
+    with mech.utils.template_records() as records:
+        assert records == {}
+    # a template VM without clone is deleted with its box
+    mock_unregister.reset_mock()
+    mech.utils.add_template_clone('mech-template-abcdef012345', '/tmp/one/.mech/first')
+    mech.utils.remove_template_clone(mech.vbm.VBoxManage(), '/tmp/one/.mech/first')
+    mock_unregister.assert_not_called()
+    mech.utils.remove_box_templates(mech.vbm.VBoxManage(), ['abcdef0123456789'])
+    mock_unregister.assert_called_once_with('mech-template-abcdef012345', delete=True,
+                                            quiet=True)
+
+
+@patch.object(mech.vbm.VBoxManage, 'clonevm', return_value='')
+@patch.object(mech.vbm.VBoxManage, 'importvm')
+@patch('mech.utils.extract_box', return_value='/tmp/extracted/abcd')
 @patch('mech.utils.add_box')
 @patch('mech.utils.locate')
-def test_init_box_virtualbox_no_vbox(mock_locate, mock_add_box, mock_makedirs,
-                                     mock_tarfile_open, mock_popen):
+def test_init_box_virtualbox_no_vbox(mock_locate, mock_add_box, mock_extract_box, mock_import,
+                                     mock_clonevm):
     """Test init_box."""
-    process_mock = MagicMock()
-    attrs = {'communicate.return_value': ('output', 'error')}
-    process_mock.configure_mock(**attrs)
-    mock_popen.return_value = process_mock
-    mock_tarfile_open = MagicMock()
-    mock_tarfile_open.returncode = 0
-    mock_locate.side_effect = [None, None, '/tmp/boxes/some.box',
-                               '/tmp/first/some.ovf', None]
+    mock_locate.side_effect = ['/tmp/boxes/some.box',
+                               '/tmp/templates/mech-template-abcd/mech-template-abcd.vbox',
+                               None]
     mock_add_box.return_value = 'bento', '1.23', 'ubuntu'
     with raises(SystemExit, match=r"Cannot locate a vbox file"):
-        with patch.object(mech.vbm.VBoxManage, 'importvm'):
-            mech.utils.init_box(name='first', box='bento/ubuntu',
-                                box_version='1.23', provider='virtualbox',
-                                instance_path='/tmp/first', save=False)
+        mech.utils.init_box(name='first', box='bento/ubuntu',
+                            box_version='1.23', provider='virtualbox',
+                            instance_path='/tmp/first', save=False)
+    # the template VM already exists
+    mock_import.assert_not_called()
+    mock_clonevm.assert_called()
 
 
-@patch('subprocess.Popen')
-@patch('tarfile.open')
-@patch('mech.utils.makedirs', return_value=True)
+@patch('mech.utils.extract_box', return_value='/tmp/extracted/abcd')
 @patch('mech.utils.add_box')
 @patch('mech.utils.locate')
-def test_init_box_virtualbox_no_ovf(mock_locate, mock_add_box, mock_makedirs,
-                                    mock_tarfile_open, mock_popen):
+def test_init_box_virtualbox_no_ovf(mock_locate, mock_add_box, mock_extract_box):
     """Test init_box."""
-    process_mock = MagicMock()
-    attrs = {'communicate.return_value': ('output', 'error')}
-    process_mock.configure_mock(**attrs)
-    mock_popen.return_value = process_mock
-    mock_tarfile_open = MagicMock()
-    mock_tarfile_open.returncode = 0
-    mock_locate.side_effect = [None, None, '/tmp/boxes/some.box', None]
+    mock_locate.side_effect = ['/tmp/boxes/some.box', None, None]
     mock_add_box.return_value = 'bento', '1.23', 'ubuntu'
     with raises(SystemExit, match=r"Cannot locate an OVF file"):
         mech.utils.init_box(name='first', box='bento/ubuntu',
@@ -1845,13 +2342,14 @@ def test_add_mechfile_with_boxfile(mock_add_box_file, mechfile_one_entry_with_fi
     mock_add_box_file.assert_called()
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 @patch('mech.utils.locate')
 def test_add_box_url(mock_locate, mock_requests_get, catalog_as_json):
     """Test init_box."""
     mock_locate.return_value = False
     mock_requests_get.return_value.status_code = 200
     mock_requests_get.return_value.json.return_value = catalog_as_json
+    mock_requests_get.return_value.headers = {}
     got = mech.utils.add_box_url(name='first', box='abox', box_version='aver', url='')
     assert got is None
 
@@ -1937,6 +2435,35 @@ def test_ssh(mock_ready_based_on_state, mechfile_one_entry, ssh_config):
             mock_config_ssh.assert_called()
 
 
+def test_ssh_config_shares_connection(mechfile_one_entry, ssh_config):
+    """Test all ssh/scp commands to an instance share one master connection."""
+    inst = mech.mech_instance.MechInstance('first', mechfile_one_entry)
+    with patch.object(inst, 'config_ssh', return_value=ssh_config):
+        got = mech.utils.ssh_config(inst)
+    assert got['ControlMaster'] == 'auto'
+    assert got['ControlPath'] == os.path.join(inst.path, 'ssh-control')
+    assert got['ControlPersist'] == mech.utils.SSH_CONTROL_PERSIST
+    assert 'ControlPath' not in ssh_config
+    # a path that is too long for a unix socket
+    inst.path = '/tmp/' + 'x' * 100
+    assert len(mech.utils.ssh_control_path(inst)) < mech.utils.SSH_CONTROL_PATH_MAX
+
+
+@patch('subprocess.run')
+def test_close_ssh_control(mock_subprocess_run, mechfile_one_entry, tmp_path):
+    """Test closing the master connection (when there is one)."""
+    inst = mech.mech_instance.MechInstance('first', mechfile_one_entry)
+    inst.path = str(tmp_path)
+    mech.utils.close_ssh_control(inst)
+    mock_subprocess_run.assert_not_called()
+    control_path = os.path.join(str(tmp_path), 'ssh-control')
+    open(control_path, 'w').close()
+    mech.utils.close_ssh_control(inst)
+    mock_subprocess_run.assert_called_once()
+    assert mock_subprocess_run.call_args[0][0] == [
+        'ssh', '-o', 'ControlPath={}'.format(control_path), '-O', 'exit', 'first']
+
+
 def test_scp_vm_not_ready(mechfile_one_entry):
     """Test scp."""
     inst = mech.mech_instance.MechInstance('first', mechfile_one_entry)
@@ -2251,3 +2778,337 @@ def test_load_mechcloudfile_file_not_present_but_should_be(mock_os_getcwd,
     mock_os_path_isfile.return_value = False
     with raises(SystemExit, match=r"Could not find a Mechcloudfile"):
         mech.utils.load_mechcloudfile(True)
+
+
+def test_host_cache_set_and_get(host_cache):
+    """Test host_cache_set() and host_cache_get()."""
+    mech.utils.host_cache_set('foo', 'bar', stamp=['/bin/foo', 1, 2])
+    assert os.path.exists(host_cache)
+    assert mech.utils.host_cache_get('foo', stamp=['/bin/foo', 1, 2]) == 'bar'
+    # a different build of the executable invalidates the value
+    assert mech.utils.host_cache_get('foo', stamp=['/bin/foo', 3, 2]) is None
+    # value is re-loaded from disk in a new process
+    mech.utils._HOST_CACHE = None
+    assert mech.utils.host_cache_get('foo', stamp=['/bin/foo', 1, 2]) == 'bar'
+    mech.utils.host_cache_set('foo', None)
+    assert mech.utils.host_cache_get('foo') is None
+
+
+@patch('time.time')
+def test_host_cache_get_expired(mock_time):
+    """Test host_cache_get() with a ttl."""
+    mock_time.return_value = 1000
+    mech.utils.host_cache_set('foo', 'bar')
+    mock_time.return_value = 1100
+    assert mech.utils.host_cache_get('foo', ttl=200) == 'bar'
+    assert mech.utils.host_cache_get('foo', ttl=50) is None
+
+
+def test_executable_stamp(tmp_path):
+    """Test executable_stamp()."""
+    exe = tmp_path / 'vmrun'
+    exe.write_text('#!/bin/sh\n')
+    stamp = mech.utils.executable_stamp(str(exe))
+    assert stamp[0] == str(exe)
+    assert stamp[2] == len('#!/bin/sh\n')
+    assert mech.utils.executable_stamp(str(tmp_path / 'nope')) is None
+    assert mech.utils.executable_stamp(None) is None
+
+
+@patch('sys.platform', return_value='atari')
+def test_get_provider_uses_host_cache(mock_sys_platform, tmp_path):
+    """Test get_provider only probes vmrun once."""
+    exe = tmp_path / 'vmrun'
+    exe.write_text('')
+    a_mock = MagicMock()
+    a_mock.return_value.returncode = 0
+    with patch('subprocess.Popen', a_mock):
+        assert mech.utils.get_provider(str(exe)) == 'ws'
+        assert mech.utils.get_provider(str(exe)) == 'ws'
+    assert a_mock.call_count == 1
+
+
+def test_tar_cmd_uses_host_cache():
+    """Test tar_cmd only runs 'tar --help' once."""
+    a_mock = MagicMock()
+    a_mock.return_value.returncode = 0
+    a_mock.return_value.communicate.return_value = ('--wildcards --force-local', None)
+    with patch('mech.utils.which', return_value='/bin/sh'):
+        with patch('subprocess.Popen', a_mock):
+            first = mech.utils.tar_cmd('-xf', 'a.box', wildcards=True)
+            second = mech.utils.tar_cmd('-xf', 'a.box', wildcards=True)
+    assert first == second == ['tar', '--wildcards', '-xf', 'a.box']
+    assert a_mock.call_count == 1
+
+
+@patch('mech.utils.probe_interfaces', return_value=['lo', 'eth0'])
+def test_get_interfaces_uses_host_cache(mock_probe_interfaces):
+    """Test get_interfaces only probes once."""
+    assert mech.utils.get_interfaces() == ['lo', 'eth0']
+    assert mech.utils.preferred_interface() == 'eth0'
+    mock_probe_interfaces.assert_called_once()
+
+
+@patch('mech.vbm.VBoxManage.list_vm_states',
+       return_value={'first': 'powered off', 'other': 'running'})
+@patch('mech.utils.locate', return_value='/tmp/first/some.vbox')
+def test_fleet_state_skips_ip_when_not_running(mock_locate, mock_list_vm_states,
+                                               mechfile_one_entry_virtualbox):
+    """Test fleet_state() only queries the ip of running VMs."""
+    inst = mech.mech_instance.MechInstance('first', mechfile_one_entry_virtualbox)
+    with patch.object(inst, 'get_ip') as mock_get_ip:
+        got = list(mech.utils.fleet_state([inst]))
+    assert got == [(inst, None, 'powered off')]
+    mock_get_ip.assert_not_called()
+    mock_list_vm_states.assert_called_once()
+
+
+@patch('mech.vmrun.VMrun.list_running', return_value=['/tmp/first/some.vmx'])
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_fleet_state_vmware(mock_locate, mock_list_running, mechfile_two_entries):
+    """Test fleet_state() with a running and a stopped VMware VM."""
+    first = mech.mech_instance.MechInstance('first', mechfile_two_entries)
+    second = mech.mech_instance.MechInstance('second', mechfile_two_entries)
+    second.vmx = '/tmp/second/some.vmx'
+    with patch.object(mech.mech_instance.MechInstance, 'get_ip',
+                      return_value='192.168.1.100') as mock_get_ip:
+        with patch.object(mech.mech_instance.MechInstance, 'get_vm_state',
+                          return_value='started'):
+            got = {inst.name: ip for inst, ip, _ in mech.utils.fleet_state([first, second])}
+    assert got == {'first': '192.168.1.100', 'second': None}
+    mock_get_ip.assert_called_once()
+    mock_list_running.assert_called_once()
+
+
+def make_box(names):
+    """Return the bytes of a (gzipped) box containing files with names."""
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as tar:
+        for name in names:
+            info = tarfile.TarInfo(name)
+            info.size = 5
+            tar.addfile(info, io.BytesIO(b'hello'))
+    return data.getvalue()
+
+
+def mock_box_response(mock_requests_get, body):
+    """Make requests.get() return body as a streamed box."""
+    mock_requests_get.return_value.status_code = 200
+    mock_requests_get.return_value.headers = {'content-length': str(len(body))}
+    mock_requests_get.return_value.iter_content.return_value = [body[:100], body[100:]]
+
+
+@patch('requests.Session.get')
+def test_stream_box(mock_requests_get, tmp_path, monkeypatch):
+    """Test extracting a box as it is downloaded."""
+    monkeypatch.chdir(tmp_path)
+    body = make_box(['some.vmx', 'disk.vmdk'])
+    mock_box_response(mock_requests_get, body)
+    url = 'https://example.com/some.box'
+    extracted = mech.utils.stream_box(url, 'bento/ubuntu', '1.23')
+    assert sorted(os.listdir(extracted)) == ['disk.vmdk', 'some.vmx']
+    cached = os.path.join(mech.utils.box_cache_dir('bento/ubuntu', '1.23'), 'some.box')
+    with open(cached, 'rb') as the_file:
+        assert the_file.read() == body
+    # the box is now in the cache, so it is not streamed again
+    assert not mech.utils.stream_box(url, 'bento/ubuntu', '1.23')
+    mock_requests_get.assert_called_once()
+
+
+@patch('requests.Session.get')
+def test_stream_box_unsafe(mock_requests_get, tmp_path, monkeypatch):
+    """Test a box with unsafe filenames is rejected."""
+    monkeypatch.chdir(tmp_path)
+    mock_box_response(mock_requests_get, make_box(['some.vmx', '../evil']))
+    with raises(SystemExit, match=r"Exiting for the safety"):
+        mech.utils.stream_box('https://example.com/some.box', 'bento/ubuntu', '1.23')
+    assert os.listdir(mech.utils.extracted_box_dir()) == []
+    assert not os.path.exists(tmp_path / 'evil')
+
+
+@patch('requests.Session.get')
+def test_stream_box_without_vmx(mock_requests_get, tmp_path, monkeypatch):
+    """Test a box without a vmx."""
+    monkeypatch.chdir(tmp_path)
+    mock_box_response(mock_requests_get, make_box(['disk.vmdk']))
+    with raises(SystemExit, match=r"Cannot find a valid box"):
+        mech.utils.stream_box('https://example.com/some.box', 'bento/ubuntu', '1.23')
+
+
+def test_catalog_to_mechfile_with_checksum(catalog_as_json):
+    """Test the checksum of the catalog ends up in the Mechfile entry."""
+    provider = catalog_as_json['versions'][0]['providers'][0]
+    provider['checksum'] = 'abcd'
+    provider['checksum_type'] = 'sha256'
+    got = mech.utils.catalog_to_mechfile(catalog_as_json)
+    assert got['box_checksum'] == 'sha256:abcd'
+
+
+def test_verify_box(tmp_path):
+    """Test verifying a cached box (only once)."""
+    box_file = str(tmp_path / 'some.box')
+    with open(box_file, 'wb') as the_file:
+        the_file.write(b'box')
+    checksum = 'sha1:' + hashlib.sha1(b'box').hexdigest()
+    mech.utils.verify_box(box_file, checksum)
+    with open(box_file + '.checksum') as the_file:
+        assert the_file.read().split() == [checksum]
+    # the stored checksum is trusted, the box is not read again
+    with patch('builtins.open', side_effect=[open(box_file + '.checksum')]):
+        mech.utils.verify_box(box_file, checksum)
+    with raises(SystemExit, match=r"Box is corrupt"):
+        mech.utils.verify_box(box_file, 'sha1:' + hashlib.sha1(b'other').hexdigest())
+    with raises(SystemExit, match=r"Invalid checksum"):
+        mech.utils.verify_box(box_file, 'bad:1234')
+
+
+@patch('requests.Session.get')
+def test_stream_box_with_checksum(mock_requests_get, tmp_path, monkeypatch):
+    """Test a box is verified as it streams in."""
+    monkeypatch.chdir(tmp_path)
+    body = make_box(['some.vmx'])
+    mock_box_response(mock_requests_get, body)
+    url = 'https://example.com/some.box'
+    checksum = 'sha256:' + hashlib.sha256(body).hexdigest()
+    assert mech.utils.stream_box(url, 'bento/ubuntu', '1.23', checksum=checksum)
+    cached = os.path.join(mech.utils.box_cache_dir('bento/ubuntu', '1.23'), 'some.box')
+    with open(cached + '.checksum') as the_file:
+        assert the_file.read().split() == [checksum]
+
+
+@patch('requests.Session.get')
+def test_stream_box_with_bad_checksum(mock_requests_get, tmp_path, monkeypatch):
+    """Test a corrupt box is not kept."""
+    monkeypatch.chdir(tmp_path)
+    mock_box_response(mock_requests_get, make_box(['some.vmx']))
+    with raises(SystemExit, match=r"Box is corrupt"):
+        mech.utils.stream_box('https://example.com/some.box', 'bento/ubuntu', '1.23',
+                              checksum='sha256:' + '0' * 64)
+    assert os.listdir(mech.utils.extracted_box_dir()) == []
+    assert not mech.utils.locate(str(tmp_path), '*.box')
+
+
+@patch('requests.Session.get')
+def test_get_catalog(mock_requests_get, catalog_as_json, monkeypatch):
+    """Test catalogs are cached and revalidated."""
+    url = 'https://app.vagrantup.com/bento/boxes/ubuntu-18.04'
+    mock_requests_get.return_value.status_code = 200
+    mock_requests_get.return_value.headers = {'etag': '"v1"'}
+    mock_requests_get.return_value.json.return_value = catalog_as_json
+    assert mech.utils.get_catalog(url) == catalog_as_json
+    # fresh, so the network is not used
+    assert mech.utils.get_catalog(url) == catalog_as_json
+    assert mock_requests_get.call_count == 1
+    # stale, so it is revalidated
+    monkeypatch.setattr(mech.utils, 'CATALOG_CACHE_TTL', 0)
+    mock_requests_get.return_value.status_code = 304
+    mock_requests_get.return_value.json.side_effect = ValueError
+    assert mech.utils.get_catalog(url) == catalog_as_json
+    assert mock_requests_get.call_args[1]['headers'] == {'If-None-Match': '"v1"'}
+
+
+@patch('requests.Session.get')
+def test_get_catalog_offline(mock_requests_get, catalog_as_json, monkeypatch):
+    """Test only cached catalogs are used when offline."""
+    url = 'https://app.vagrantup.com/bento/boxes/ubuntu-18.04'
+    monkeypatch.setenv('MECH_OFFLINE', '1')
+    with raises(SystemExit, match=r"no cached catalog"):
+        mech.utils.get_catalog(url)
+    monkeypatch.delenv('MECH_OFFLINE')
+    mock_requests_get.return_value.status_code = 200
+    mock_requests_get.return_value.headers = {}
+    mock_requests_get.return_value.json.return_value = catalog_as_json
+    mech.utils.get_catalog(url)
+    monkeypatch.setenv('MECH_OFFLINE', '1')
+    monkeypatch.setattr(mech.utils, 'CATALOG_CACHE_TTL', 0)
+    assert mech.utils.get_catalog(url) == catalog_as_json
+    assert mock_requests_get.call_count == 1
+
+
+def test_box_digest(tmp_path):
+    """Test the digest of a box is only computed once."""
+    box_file = str(tmp_path / 'some.box')
+    with open(box_file, 'wb') as the_file:
+        the_file.write(b'box')
+    mech.utils.store_box_checksum(box_file, 'sha1:1234')
+    expected = hashlib.sha256(b'box').hexdigest()
+    assert mech.utils.box_digest(box_file) == expected
+    assert mech.utils.box_checksums(box_file) == ['sha1:1234', 'sha256:' + expected]
+    with patch('builtins.open', side_effect=[open(box_file + '.checksum')]):
+        assert mech.utils.box_digest(box_file) == expected
+
+
+def test_extract_box(tmp_path, monkeypatch):
+    """Test a box is extracted once, then instances are created from the extracted box."""
+    monkeypatch.chdir(tmp_path)
+    box_file = str(tmp_path / 'some.box')
+    with open(box_file, 'wb') as the_file:
+        the_file.write(make_box(['some.vmx', 'disk.vmdk']))
+    extracted = mech.utils.extract_box(box_file)
+    assert extracted == mech.utils.extracted_box_dir(mech.utils.box_digest(box_file))
+    assert sorted(os.listdir(extracted)) == ['disk.vmdk', 'some.vmx']
+    assert os.listdir(mech.utils.extracted_box_dir()) == [os.path.basename(extracted)]
+    with patch('subprocess.Popen') as mock_popen:
+        assert mech.utils.extract_box(box_file) == extracted
+        mock_popen.assert_not_called()
+    mech.utils.create_instance_files(extracted, str(tmp_path / 'first'))
+    mech.utils.create_instance_files(extracted, str(tmp_path / 'second'))
+    with open(str(tmp_path / 'second' / 'some.vmx'), 'rb') as the_file:
+        assert the_file.read() == b'hello'
+
+
+@patch('requests.Session.get')
+def test_stream_box_extracts_into_store(mock_requests_get, tmp_path, monkeypatch):
+    """Test a streamed box ends up in the store of extracted boxes."""
+    monkeypatch.chdir(tmp_path)
+    body = make_box(['some.vmx'])
+    mock_box_response(mock_requests_get, body)
+    extracted = mech.utils.stream_box('https://example.com/some.box', 'bento/ubuntu', '1.23')
+    digest = hashlib.sha256(body).hexdigest()
+    assert extracted == mech.utils.extracted_box_dir(digest)
+    assert os.listdir(mech.utils.extracted_box_dir()) == [digest]
+    cached = os.path.join(mech.utils.box_cache_dir('bento/ubuntu', '1.23'), 'some.box')
+    assert mech.utils.box_digest(cached) == digest
+
+
+def test_remove_extracted_boxes(tmp_path, monkeypatch):
+    """Test removing the extracted boxes of cached boxes."""
+    monkeypatch.chdir(tmp_path)
+    box_dir = mech.utils.box_cache_dir('bento/ubuntu', '1.23')
+    os.makedirs(box_dir)
+    box_file = os.path.join(box_dir, 'some.box')
+    with open(box_file, 'wb') as the_file:
+        the_file.write(make_box(['some.vmx']))
+    extracted = mech.utils.extract_box(box_file)
+    mech.utils.remove_extracted_boxes(box_dir)
+    assert not os.path.exists(extracted)
+
+
+@patch('mech.utils.update_vmx')
+@patch('mech.vmrun.VMrun.clone', return_value='')
+@patch('mech.vmrun.VMrun.snapshot', return_value='')
+@patch('mech.vmrun.VMrun.list_snapshots')
+def test_clone_instance(mock_list_snapshots, mock_snapshot, mock_clone, mock_update_vmx,
+                        mechfile_two_entries, tmp_path, monkeypatch):
+    """Test creating a linked clone (the snapshot is only taken once)."""
+    monkeypatch.chdir(tmp_path)
+    source = mech.mech_instance.MechInstance('first', mechfile_two_entries)
+    source.vmx = '/tmp/first/one.vmx'
+    source.created = True
+    inst = mech.mech_instance.MechInstance('second', mechfile_two_entries)
+    mock_list_snapshots.return_value = 'Total snapshots: 0'
+    got = mech.utils.clone_instance(inst, source, memsize=1024)
+    assert got == os.path.join(inst.path, 'second.vmx')
+    mock_snapshot.assert_called_once_with('mech-template')
+    mock_clone.assert_called_once_with(got, 'linked', snap_name='mech-template',
+                                       clone_name='second')
+    mock_update_vmx.assert_called_once_with(got, numvcpus=None, memsize=1024, no_nat=False)
+    mock_list_snapshots.return_value = 'Total snapshots: 1\nmech-template'
+    mech.utils.clone_instance(inst, source)
+    mock_snapshot.assert_called_once()
+    mock_clone.return_value = None
+    with raises(SystemExit, match=r"Cannot clone 'first'"):
+        mech.utils.clone_instance(inst, source)
+    source.created = False
+    with raises(SystemExit, match=r"has not been created"):
+        mech.utils.clone_instance(inst, source)
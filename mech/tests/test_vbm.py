@@ -46,6 +46,31 @@ def test_vbm_importvm():
     assert got == expected
 
 
+def test_vbm_clonevm():
+    """Test clonevm method."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    expected = ['/bin/VBoxManage', 'clonevm', 'mech-template-abcd', '--name', 'first',
+                '--basefolder', '/tmp', '--register', '--snapshot', 'mech-template',
+                '--options', 'link']
+    got = vbm.clonevm('mech-template-abcd', 'first', '/tmp', snapshot='mech-template',
+                      linked=True)
+    assert got == expected
+
+
+def test_vbm_snapshot():
+    """Test snapshot method."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    expected = ['/bin/VBoxManage', 'snapshot', 'first', 'take', 'mech-template']
+    assert vbm.snapshot('first', 'mech-template') == expected
+
+
+def test_vbm_hide():
+    """Test hide method."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    expected = ['/bin/VBoxManage', 'setextradata', 'first', 'GUI/HideFromManager', '1']
+    assert vbm.hide('first') == expected
+
+
 def test_vbm_start_headless():
     """Test start method."""
     vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
@@ -81,6 +106,44 @@ def test_vbm_ip_with_wait():
         assert got == expected
 
 
+def test_vbm_ip_with_wait_for_property():
+    """Test ip method waits for the IP property to change."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    with patch.object(mech.vbm.VBoxManage, '_ip', side_effect=[None, '192.168.56.195']), \
+            patch.object(mech.vbm.VBoxManage, 'guestproperty_wait') as mock_wait:
+        assert vbm.ip(vmname='first', wait=True, timeout=30) == '192.168.56.195'
+    args = mock_wait.call_args[0]
+    assert args[:2] == ('first', mech.vbm.IP_PROPERTY)
+    assert 0 < args[2] <= 30
+
+
+def test_vbm_ip_with_wait_timeout():
+    """Test ip method gives up after the timeout."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    with patch.object(mech.vbm.VBoxManage, '_ip', return_value=None), \
+            patch.object(mech.vbm.VBoxManage, 'guestproperty_wait'):
+        assert vbm.ip(vmname='first', wait=True, timeout=0.01) is None
+
+
+def test_vbm_guestproperty_wait():
+    """Test guestproperty_wait method."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    expected = ['/bin/VBoxManage', 'guestproperty', 'wait', 'first', '/a/b',
+                '--timeout', '2500']
+    assert vbm.guestproperty_wait('first', '/a/b', 2.5) == expected
+
+
+def test_vbm_mac_address():
+    """Test mac_address method."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    vm_info = 'name="first"\nmacaddress1="0800279D5E2F"\nmacaddress2="080027000002"'
+    with patch.object(mech.vbm.VBoxManage, 'run', return_value=vm_info) as mock_run:
+        assert vbm.mac_address('first') == '0800279D5E2F'
+        assert vbm.mac_address('first', nic=2) == '080027000002'
+        assert vbm.mac_address('first', nic=3) is None
+    mock_run.assert_called_with('showvminfo', 'first', '--machinereadable', quiet=False)
+
+
 def test_vbm_ip_with_no_wait():
     """Test ip method."""
     vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
@@ -112,6 +175,7 @@ def test_vbm_unregister():
     expected = ['/bin/VBoxManage', 'unregistervm', 'first']
     got = vbm.unregister('first')
     assert got == expected
+    assert vbm.unregister('first', delete=True) == expected + ['--delete']
 
 
 def test_vbm_stop():
@@ -234,6 +298,52 @@ def test_vbm_add_hostonly_dhcp():
     assert got == expected
 
 
+def test_vbm_add_hostonly_dhcp_subnet():
+    """Test add_hostonly_dhcp method with a larger subnet."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    expected = ['/bin/VBoxManage', 'dhcpserver', 'add', '--ifname', 'vboxnet0',
+                '--enable', '--ip', '10.1.0.1', '--netmask', '255.255.252.0',
+                '--lower-ip', '10.1.0.100', '--upper-ip', '10.1.0.200']
+    assert vbm.add_hostonly_dhcp(subnet='10.1.0.0/22') == expected
+
+
+@patch('mech.utils.executable_stamp', return_value=['/bin/VBoxManage', 1, 2])
+def test_vbm_configure_hostonly(mock_stamp):
+    """Test configure_hostonly method (only done once per subnet)."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage')
+    with patch.object(mech.vbm.VBoxManage, 'run') as mock_run:
+        vbm.configure_hostonly('10.1.0.0/22')
+        vbm.configure_hostonly('10.1.0.0/22')
+        assert mock_run.call_count == 2
+        assert mock_run.call_args_list[0][0] == ('hostonlyif', 'ipconfig', 'vboxnet0',
+                                                 '--ip', '10.1.0.1', '--netmask', '255.255.252.0')
+        vbm.configure_hostonly('10.2.0.0/24')
+        assert mock_run.call_count == 4
+
+
+def test_vbm_dhcp_fixed_address():
+    """Test dhcp_fixed_address method."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    expected = ['/bin/VBoxManage', 'dhcpserver', 'modify', '--ifname', 'vboxnet0',
+                '--vm', 'first', '--nic', '1', '--fixed-address', '192.168.56.2']
+    assert vbm.dhcp_fixed_address('first', '192.168.56.2') == expected
+
+
+def test_vbm_dhcp_remove_fixed_address():
+    """Test dhcp_remove_fixed_address method."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    expected = ['/bin/VBoxManage', 'dhcpserver', 'modify', '--ifname', 'vboxnet0',
+                '--vm', 'first', '--nic', '1', '--remove-config']
+    assert vbm.dhcp_remove_fixed_address('first') == expected
+
+
+def test_vbm_guestproperty_set():
+    """Test guestproperty_set method."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    expected = ['/bin/VBoxManage', 'guestproperty', 'set', 'first', '/mech/ip', '192.168.56.2']
+    assert vbm.guestproperty_set('first', '/mech/ip', '192.168.56.2') == expected
+
+
 def test_vbm_remove_hostonly_dhcp():
     """Test remove_hostonly_dhcp method."""
     vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
@@ -339,3 +449,36 @@ def test_vbm_list_running():
     with patch.object(mech.vbm.VBoxManage, 'run', return_value=output):
         got = vbm.list_running()
         assert got == expected
+    with patch.object(mech.vbm.VBoxManage, 'run', return_value=None):
+        assert vbm.list_running() is None
+
+
+@patch('mech.utils.executable_stamp', return_value=['/bin/VBoxManage', 1, 1])
+def test_vbm_create_hostonly_uses_host_cache(mock_stamp):
+    """Test create_hostonly only lists interfaces/dhcp servers once."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage')
+    with patch.object(mech.vbm.VBoxManage, 'list_hostonly_ifs',
+                      return_value='Name: vboxnet0') as mock_ifs:
+        with patch.object(mech.vbm.VBoxManage, 'list_dhcpservers',
+                          return_value='NetworkName: HostInterfaceNetworking-vboxnet0'):
+            vbm.create_hostonly()
+            vbm.create_hostonly()
+            mock_ifs.assert_called_once()
+            vbm.create_hostonly(refresh=True)
+            assert mock_ifs.call_count == 2
+
+
+@patch('os.path.exists', return_value=True)
+def test_vbm_list_vm_states(mock_path_exists):
+    """Test list_vm_states method."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage')
+    output = """Name:                        first
+Groups:                      /
+State:                       running (since 2020-03-02T21:21:46.164000000)
+Name: 'mech', Host path: '/tmp' (machine mapping), writable
+Name:                        second
+State:                       powered off (since 2020-03-02T21:21:46.164000000)
+"""
+    with patch.object(mech.vbm.VBoxManage, 'run', return_value=output):
+        got = vbm.list_vm_states()
+    assert got == {'first': 'running', 'second': 'powered off'}
@@ -461,11 +461,33 @@ def test_vmrun_get_guest_ip_address_no_lookup_unknown(mock_vmrun):
     """Test get_guest_ip_address method without lookup."""
     vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx',
                              executable='/tmp/vmrun', provider='ws')
-    got = vmrun.get_guest_ip_address()
+    got = vmrun.get_guest_ip_address(wait=False)
     assert got == ''
     mock_vmrun.assert_called()
 
 
+@patch('mech.vmrun.VMrun.vmrun', side_effect=[None, 'unknown', '192.168.1.200'])
+def test_vmrun_get_guest_ip_address_wait(mock_vmrun):
+    """Test get_guest_ip_address retries until there is an IP address."""
+    vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx',
+                             executable='/tmp/vmrun', provider='ws')
+    with patch('mech.readiness.time.sleep') as mock_sleep:
+        assert vmrun.get_guest_ip_address(timeout=60) == '192.168.1.200'
+    assert [c[0][0] for c in mock_sleep.call_args_list] == [0.5, 1]
+    args, kwargs = mock_vmrun.call_args
+    assert args == ('getGuestIPAddress', '/tmp/first/some.vmx', '-wait')
+    assert 0 < kwargs['timeout'] <= 60
+
+
+@patch('mech.vmrun.VMrun.vmrun', return_value='unknown')
+def test_vmrun_get_guest_ip_address_timeout(mock_vmrun):
+    """Test get_guest_ip_address gives up after the timeout."""
+    vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx',
+                             executable='/tmp/vmrun', provider='ws')
+    assert vmrun.get_guest_ip_address(timeout=0.01) is None
+    mock_vmrun.assert_called()
+
+
 @patch('mech.vmrun.VMrun.copy_file_from_guest_to_host', return_value='')
 @patch('mech.vmrun.VMrun.run_script_in_guest', return_value='')
 def test_vmrun_get_guest_ip_address_lookup(mock_run_script_in_guest,
@@ -565,6 +587,16 @@ def test_vmrun_clone():
     assert got == expected
 
 
+def test_vmrun_clone_linked():
+    """Test clone method with a snapshot."""
+    vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx', executable='/tmp/vmrun',
+                             provider='ws', test_mode=True)
+    expected = ['/tmp/vmrun', '-T', 'ws', 'clone', '/tmp/first/some.vmx',
+                '/tmp/second/second.vmx', 'linked', '-snapshot=base', '-cloneName=second']
+    got = vmrun.clone('/tmp/second/second.vmx', 'linked', snap_name='base', clone_name='second')
+    assert got == expected
+
+
 def test_vmrun_begin_recording():
     """Test begin_recording method."""
     vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx', executable='/tmp/vmrun',
@@ -680,49 +712,92 @@ def test_installed_tools(mock_tools_state):
     mock_tools_state.assert_called()
 
 
-@patch('os.path.isfile', return_value=True)
-def test_vm_state_started(mock_isfile):
+def test_vm_state_started(tmp_path):
     """Test vm_state."""
-    vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx', executable='/bin/vmrun',
+    (tmp_path / 'vmware.log').write_text(
+        'blah\nReporting power state change (opcode=2, err=0)\nblah')
+    vmrun = mech.vmrun.VMrun(str(tmp_path / 'some.vmx'), executable='/bin/vmrun',
                              user='admin', password='1234', provider='ws', test_mode=True)
-    a_mock = mock_open()
-    a_mock = mock_open(read_data='blah\nReporting power state change (opcode=2, err=0)\nblah')
-    with patch('builtins.open', a_mock, create=True):
-        assert vmrun.vm_state() == "started"
-        mock_isfile.assert_called()
+    assert vmrun.vm_state() == "started"
 
 
-@patch('os.path.isfile', return_value=True)
-def test_vm_state_stopped(mock_isfile):
+def test_vm_state_stopped(tmp_path):
     """Test vm_state."""
-    vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx', executable='/bin/vmrun',
+    (tmp_path / 'vmware.log').write_text('blah\nVMX exit (0)\nblah')
+    vmrun = mech.vmrun.VMrun(str(tmp_path / 'some.vmx'), executable='/bin/vmrun',
                              user='admin', password='1234', provider='ws', test_mode=True)
-    a_mock = mock_open()
-    a_mock = mock_open(read_data='blah\nVMX exit (0)\nblah')
-    with patch('builtins.open', a_mock, create=True):
-        assert vmrun.vm_state() == "stopped"
-        mock_isfile.assert_called()
+    assert vmrun.vm_state() == "stopped"
 
 
-@patch('os.path.isfile', return_value=True)
-def test_vm_state_unpaused(mock_isfile):
+def test_vm_state_unpaused(tmp_path):
     """Test vm_state."""
-    vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx', executable='/bin/vmrun',
+    (tmp_path / 'vmware.log').write_text('blah\nVMAutomation_Pause: pause = FALSE\nblah')
+    vmrun = mech.vmrun.VMrun(str(tmp_path / 'some.vmx'), executable='/bin/vmrun',
                              user='admin', password='1234', provider='ws', test_mode=True)
-    a_mock = mock_open()
-    a_mock = mock_open(read_data='blah\nVMAutomation_Pause: pause = FALSE\nblah')
-    with patch('builtins.open', a_mock, create=True):
-        assert vmrun.vm_state() == "unpaused"
-        mock_isfile.assert_called()
+    assert vmrun.vm_state() == "unpaused"
 
 
-@patch('os.path.isfile', return_value=True)
-def test_vm_state_paused(mock_isfile):
+def test_vm_state_paused(tmp_path):
     """Test vm_state."""
-    vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx', executable='/bin/vmrun',
+    (tmp_path / 'vmware.log').write_text('blah\nVMAutomation_Pause: pause = TRUE\nblah')
+    vmrun = mech.vmrun.VMrun(str(tmp_path / 'some.vmx'), executable='/bin/vmrun',
                              user='admin', password='1234', provider='ws', test_mode=True)
-    a_mock = mock_open()
-    a_mock = mock_open(read_data='blah\nVMAutomation_Pause: pause = TRUE\nblah')
-    with patch('builtins.open', a_mock, create=True):
-        assert vmrun.vm_state() == "paused"
-        mock_isfile.assert_called()
+    assert vmrun.vm_state() == "paused"
+
+
+def test_vm_state_unknown(tmp_path):
+    """Test vm_state without (a known line in) vmware.log."""
+    vmrun = mech.vmrun.VMrun(str(tmp_path / 'some.vmx'), executable='/bin/vmrun',
+                             user='admin', password='1234', provider='ws', test_mode=True)
+    assert vmrun.vm_state() == "unknown"
+    (tmp_path / 'vmware.log').write_text('blah\nblah')
+    assert vmrun.vm_state() == "unknown"
+
+
+def test_last_match(tmp_path):
+    """Test the last match is found reading backwards, with lines across blocks."""
+    lines = ['line {} VMAutomation_Pause: pause = {}'.format(i, ['TRUE', 'FALSE'][i % 2])
+             for i in range(1000)] + ['x' * 300] * 50
+    path = tmp_path / 'vmware.log'
+    path.write_text('\n'.join(lines) + '\n')
+    pattern = mech.vmrun.VM_STATE_LINES
+    for block_size in (7, 64, 1000, 1 << 20):
+        match = mech.vmrun.last_match(str(path), pattern, block_size=block_size)
+        assert match.lastgroup == 'unpaused'
+        assert match.group(0) == b'VMAutomation_Pause: pause = FALSE'
+    path.write_text('')
+    assert mech.vmrun.last_match(str(path), pattern) is None
+
+
+def test_vmware_log_state_cached(tmp_path, monkeypatch):
+    """Test the log is only read again when it changes."""
+    monkeypatch.setattr(mech.vmrun, '_VM_STATES', {})
+    path = tmp_path / 'vmware.log'
+    path.write_text('VMX exit (0)\n')
+    assert mech.vmrun.vmware_log_state(str(path)) == 'stopped'
+    with patch('mech.vmrun.last_match') as mock_last_match:
+        assert mech.vmrun.vmware_log_state(str(path)) == 'stopped'
+        # another command: from the state file
+        monkeypatch.setattr(mech.vmrun, '_VM_STATES', {})
+        assert mech.vmrun.vmware_log_state(str(path)) == 'stopped'
+        mock_last_match.assert_not_called()
+    with open(str(path), 'a') as the_file:
+        the_file.write('Reporting power state change (opcode=2, err=0)\n')
+    assert mech.vmrun.vmware_log_state(str(path)) == 'started'
+
+
+@patch('os.path.exists', return_value=True)
+def test_vmrun_list_running(mock_path_exists):
+    """Test list_running method."""
+    vmrun = mech.vmrun.VMrun(executable='/tmp/vmrun', provider='ws')
+    output = 'Total running VMs: 2\n/tmp/first/some.vmx\n/tmp/second/other.vmx'
+    with patch.object(mech.vmrun.VMrun, 'vmrun', return_value=output):
+        got = vmrun.list_running()
+    assert got == ['/tmp/first/some.vmx', '/tmp/second/other.vmx']
+
+
+@patch('os.path.exists', return_value=False)
+def test_vmrun_list_running_not_installed(mock_path_exists):
+    """Test list_running method when vmrun is not installed."""
+    vmrun = mech.vmrun.VMrun(executable='/tmp/vmrun', provider='ws')
+    assert vmrun.list_running() is None
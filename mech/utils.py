@@ -35,11 +35,16 @@ import sys
 import json
 import tarfile
 import fnmatch
+import hashlib
 import logging
 import tempfile
+import threading
 import subprocess
 import collections
-from shutil import copyfile, rmtree
+import contextlib
+import concurrent.futures
+import time
+from shutil import copyfile, rmtree, which
 
 import requests
 import click
@@ -47,10 +52,42 @@ from pypsrp.client import Client
 
 from .vmrun import VMrun
 import mech.vbm
+import mech.download
+import mech.executor
+import mech.box_store
+import mech.ssh_pool
+import mech.tar_stream
+import mech.ip_pool
 from .mech_cloud_instance import MechCloudInstance
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (windows)
+    fcntl = None
+
 LOGGER = logging.getLogger('mech')
 
+# How long (in seconds) a cached catalog is used without checking if it changed.
+CATALOG_CACHE_TTL = 10 * 60
+
+# How long (in seconds) host capabilities that are not tied to an
+# executable (like the list of network interfaces) are trusted.
+HOST_CACHE_TTL = 60 * 60
+
+_HOST_CACHE = None
+_HOST_CACHE_LOCK = threading.Lock()
+
+# How long an idle ssh master connection to an instance is kept (see ssh_config())
+SSH_CONTROL_PERSIST = '10m'
+# Max length of the path of a unix socket (104 on macOS)
+SSH_CONTROL_PATH_MAX = 100
+
+# Name of the snapshot linked clones are created from
+TEMPLATE_SNAPSHOT = 'mech-template'
+_TEMPLATE_LOCK = threading.Lock()
+
+_GUEST_ZSTD = {}
+
 
 def main_dir():
     """Return the main directory."""
@@ -62,6 +99,23 @@ def mech_dir():
     return os.path.join(main_dir(), '.mech')
 
 
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on path (a lock file shared with the other mech processes).
+
+       Where there is no fcntl (windows), nothing is locked.
+    """
+    makedirs(os.path.dirname(path))
+    with open(path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
 def makedirs(name, mode=0o777):
     """Make directories with mode supplied."""
     try:
@@ -73,6 +127,7 @@ def makedirs(name, mode=0o777):
 def start_vm(inst):
     """Start VM.
        inst is a MechInstance
+       Returns True if the VM was started.
     """
     LOGGER.debug('inst:%s', inst)
     started = None
@@ -89,15 +144,21 @@ def start_vm(inst):
             vbm.bridged(inst.name, bridge_adapter=bridge_adapter, quiet=False)
         else:
             vbm.create_hostonly(quiet=True)
-            vbm.hostonly(inst.name, quiet=True)
+            if vbm.hostonly(inst.name, quiet=True) is None:
+                # the cached host-only network state may be stale
+                vbm.create_hostonly(quiet=True, refresh=True)
+                vbm.hostonly(inst.name, quiet=True)
+            if inst.static_ip and mech.ip_pool.address(inst.name) is None:
+                assign_static_ip(inst, vbm)
         vbm.start(vmname=inst.name, gui=inst.gui, quiet=True)
         running_vms = vbm.list_running()
         started = None
-        if inst.name in running_vms:
+        if inst.name in (running_vms or []):
             started = True
 
     if started is None:
         click.secho("VM not started", fg="red")
+        return False
     else:
         click.secho("Getting IP address...", fg="blue")
         ip_address = inst.get_ip(wait=True)
@@ -128,6 +189,22 @@ def start_vm(inst):
 
         if not inst.disable_provisioning:
             provision(inst, show=False)
+    return True
+
+
+def assign_static_ip(inst, vbm):
+    """Give the instance a fixed address from the IP pool (at its first boot).
+
+       The dhcp server of the host-only network hands it out to the instance,
+       which can also read it from the guest property /mech/ip.
+    """
+    wanted = None if inst.static_ip is True else inst.static_ip
+    address = mech.ip_pool.allocate(inst.name, inst.ip_subnet, wanted)
+    vbm.configure_hostonly(mech.ip_pool.subnet(), quiet=True)
+    vbm.dhcp_fixed_address(inst.name, address, quiet=True)
+    vbm.guestproperty_set(inst.name, '/mech/ip', address, quiet=True)
+    click.secho("Using IP address {}...".format(address), fg="blue")
+    return address
 
 
 def confirm(prompt, default='y'):
@@ -376,9 +453,7 @@ def build_mechfile_entry(location, box=None, name=None, box_version=None,
             click.secho("Loading metadata for box '{}'{}".format(
                 location, " ({})".format(box_version) if box_version else ""), fg="blue")
             url = 'https://app.vagrantup.com/{}/boxes/{}'.format(account, box)
-            response = requests.get(url)
-            response.raise_for_status()
-            catalog = response.json()
+            catalog = get_catalog(url)
         except (requests.HTTPError, ValueError) as exc:
             sys.exit(click.style("Bad response from HashiCorp's Vagrant "
                                  "Cloud API: %s" % exc), fg="red")
@@ -390,6 +465,71 @@ def build_mechfile_entry(location, box=None, name=None, box_version=None,
                                box_version=box_version, provider=provider)
 
 
+def catalog_cache_dir():
+    """Return the directory Vagrant Cloud catalogs are cached in."""
+    return os.path.join(os.path.expanduser('~'), '.mech', 'catalogs')
+
+
+def get_catalog(url):
+    """Return the catalog (json) at url.
+
+       Catalogs are cached on disk. A cached catalog is used as is for
+       CATALOG_CACHE_TTL seconds, then revalidated using ETag/Last-Modified
+       (which costs one small round-trip if it did not change).
+       When offline (MECH_OFFLINE is set), only the cached catalog is used.
+    """
+    cache_file = os.path.join(catalog_cache_dir(),
+                              hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+    cached = None
+    try:
+        with open(cache_file) as the_file:
+            cached = json.load(the_file)
+    except (IOError, OSError, ValueError):
+        pass
+    if cached and cached.get('url') != url:
+        cached = None
+
+    if mech.download.offline():
+        if cached is None:
+            sys.exit(click.style("Offline and there is no cached catalog for {}".format(url),
+                                 fg="red"))
+        return cached['catalog']
+    if cached and time.time() - cached.get('fetched', 0) < CATALOG_CACHE_TTL:
+        LOGGER.debug('using cached catalog for url:%s', url)
+        return cached['catalog']
+
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+    response = mech.download.get(url, headers=headers)
+    if cached and response.status_code == 304:
+        LOGGER.debug('cached catalog for url:%s is still valid', url)
+        catalog = cached['catalog']
+    else:
+        response.raise_for_status()
+        catalog = response.json()
+
+    cached = {
+        'url': url,
+        'fetched': time.time(),
+        'etag': response.headers.get('etag'),
+        'last_modified': response.headers.get('last-modified'),
+        'catalog': catalog,
+    }
+    try:
+        os.makedirs(catalog_cache_dir(), exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'w') as the_file:
+            json.dump(cached, the_file)
+        os.replace(tmp_file, cache_file)
+    except (IOError, OSError) as exc:
+        # the cache is only an optimization
+        LOGGER.debug('could not save catalog cache: %s', exc)
+    return catalog
+
+
 def catalog_to_mechfile(catalog, name=None, box=None, box_version=None, provider=None):
     """Convert the Hashicorp cloud catalog entry to Mechfile entry."""
     LOGGER.debug('catalog:%s name:%s box:%s box_version:%s', catalog, name, box, box_version)
@@ -407,14 +547,24 @@ def catalog_to_mechfile(catalog, name=None, box=None, box_version=None, provider
                     mechfile['box'] = catalog['name']
                     mechfile['box_version'] = current_version
                     mechfile['url'] = a_provider['url']
+                    if a_provider.get('checksum') and a_provider.get('checksum_type'):
+                        mechfile['box_checksum'] = '{}:{}'.format(
+                            a_provider['checksum_type'], a_provider['checksum'])
                     mechfile['shared_folders'] = default_shared_folders()
                     return mechfile
     sys.exit(click.style("Couldn't find a compatible VM using "
                          "catalog:{}".format(catalog), fg="red"))
 
 
-def tar_cmd(*args, **kwargs):
-    """Build the tar command to be used to extract the box."""
+def tar_capabilities():
+    """Return a dict of the (optional) options the 'tar' command supports
+       or None if 'tar' cannot be run. The result is kept in the host cache.
+    """
+    stamp = executable_stamp(which('tar'))
+    if stamp:
+        capabilities = host_cache_get('tar_capabilities', stamp=stamp)
+        if capabilities:
+            return capabilities
     try:
         startupinfo = None
         if os.name == "nt":
@@ -428,12 +578,26 @@ def tar_cmd(*args, **kwargs):
     if proc.returncode:
         return None
     stdoutdata, _ = proc.communicate()
+    capabilities = {
+        'wildcards': bool(re.search(r'--wildcards\b', stdoutdata)),
+        'force_local': bool(re.search(r'--force-local\b', stdoutdata)),
+    }
+    if stamp:
+        host_cache_set('tar_capabilities', capabilities, stamp=stamp)
+    return capabilities
+
+
+def tar_cmd(*args, **kwargs):
+    """Build the tar command to be used to extract the box."""
+    capabilities = tar_capabilities()
+    if capabilities is None:
+        return None
     tar = ['tar']
     # if the tar_cmd has the option enabled *and* the capability was in the 'tar --help'
     # then append that option to the tar command (which is a list of strings)
-    if kwargs.get('wildcards') and re.search(r'--wildcards\b', stdoutdata):
+    if kwargs.get('wildcards') and capabilities.get('wildcards'):
         tar.append('--wildcards')
-    if kwargs.get('force_local') and re.search(r'--force-local\b', stdoutdata):
+    if kwargs.get('force_local') and capabilities.get('force_local'):
         tar.append('--force-local')
     if kwargs.get('fast_read') and sys.platform.startswith('darwin'):
         tar.append('--fast-read')
@@ -443,35 +607,36 @@ def tar_cmd(*args, **kwargs):
 
 def init_box(name, box=None, box_version=None, location=None, force=False, save=True,
              instance_path=None, numvcpus=None, memsize=None, no_nat=False, provider=None,
-             windows=None):
+             windows=None, box_checksum=None):
     """Initialize the box. This includes uncompressing the files
        from the box file and updating the vmx file with
        desired settings (if vmware).
 
        Return the full path to the vmx or vbox file.
 
-       VMware will just use the files as extracted.
-       VirtualBox needs to "import" the ovf. It creates a .vbox file.
+       If box_checksum is given, the box is verified against it.
+
+       The box is only extracted once (see extract_box()).
+
+       VMware uses files created from the extracted box.
+       VirtualBox needs to "import" the ovf. The box is imported once as a
+       template VM, the instance is a linked clone of it (see box_template()).
     """
-    LOGGER.debug("name:%s box:%s box_version:%s location:%s provider:%s windows:%s",
-                 name, box, box_version, location, provider, windows)
+    LOGGER.debug("name:%s box:%s box_version:%s location:%s provider:%s windows:%s "
+                 "box_checksum:%s", name, box, box_version, location, provider, windows,
+                 box_checksum)
     if provider is None:
         provider = 'vmware'
 
-    look_for = '*.vmx'
-    vbox_path = None
-    instance_path_save = instance_path
-    if provider == 'virtualbox':
-        look_for = '*.ovf'
-        vbox_path = locate(instance_path, '*.vbox')
-        # need to extract the files somewhere, then we will
-        # remove them after importing to virtualbox
-        if vbox_path != '':
-            instance_path += '_tmp'
-
-    # if we do not find the vmx file nor is the already imported files in place
-    found_vmx_or_ovf = locate(instance_path, look_for)
-    if not found_vmx_or_ovf and vbox_path != '':
+    # if we do not find the vmx file (virtualbox always needs the extracted box)
+    found_vmx = provider == 'vmware' and locate(instance_path, '*.vmx')
+    extracted = None
+    is_url = location and any(location.startswith(s) for s in ('https://', 'http://'))
+    if not found_vmx and is_url and box and box_version:
+        # cold cache: extract the box as it is downloaded
+        extracted = stream_box(location, box, box_version, save=save, provider=provider,
+                               checksum=box_checksum)
+    if not found_vmx and not extracted:
         name_version_box = add_box(
             name=name,
             box=box,
@@ -480,7 +645,8 @@ def init_box(name, box=None, box_version=None, location=None, force=False, save=
             force=force,
             save=save,
             provider=provider,
-            windows=windows)
+            windows=windows,
+            checksum=box_checksum)
         if not name_version_box:
             sys.exit(click.style("Cannot find a valid box with a VMX/OVF "
                                  "file in boxfile", fg="red"))
@@ -489,9 +655,283 @@ def init_box(name, box=None, box_version=None, location=None, force=False, save=
         box_dir = os.path.join(*filter(None, (mech_dir(), 'boxes', provider,
                                               box_parts[0], box_parts[1], box_version)))
         box_file = locate(box_dir, '*.box')
+        if box_checksum:
+            verify_box(box_file, box_checksum)
+        extracted = extract_box(box_file)
+
+        if not save and box.startswith(tempfile.gettempdir()):
+            os.unlink(box)
 
-        click.secho("Extracting box '{}'...".format(box_file), fg="blue")
-        makedirs(instance_path)
+    if provider == 'vmware':
+        if extracted:
+            click.secho("Creating instance files from box '{}'...".format(box), fg="blue")
+            create_instance_files(extracted, instance_path)
+        vmx_path = locate(instance_path, '*.vmx')
+        if not vmx_path:
+            sys.exit(click.style("Cannot locate a VMX file", fg="red"))
+        update_vmx(vmx_path, numvcpus=numvcpus, memsize=memsize, no_nat=no_nat)
+        return vmx_path
+    else:
+        vbm = mech.vbm.VBoxManage()
+        template = box_template(vbm, extracted)
+        click.secho("Creating '{}' as a linked clone of '{}'...".format(name, template),
+                    fg="blue")
+        clone_results = vbm.clonevm(template, name, base_folder=mech_dir(),
+                                    snapshot=TEMPLATE_SNAPSHOT, linked=True, quiet=True)
+        LOGGER.debug('clone_results:%s', clone_results)
+        vbox_path = locate(instance_path, '*.vbox')
+        if not vbox_path:
+            sys.exit(click.style("Cannot locate a vbox file", fg="red"))
+        add_template_clone(template, instance_path)
+        return vbox_path
+
+
+def templates_dir():
+    """Return the directory the template VMs (virtualbox) are in.
+
+       The template VMs are registered in VirtualBox, which is the same for
+       every Mechfile, so they are kept in the user's home directory.
+    """
+    return os.path.join(os.path.expanduser('~'), '.mech', 'templates')
+
+
+def templates_file():
+    """Return the full path of the file the linked clones of the template VMs are saved in."""
+    return os.path.join(templates_dir(), 'templates.json')
+
+
+@contextlib.contextmanager
+def template_records():
+    """Yield the records of the template VMs ({template: {'clones': [instance path]}})
+       and save them afterwards, holding the lock on them.
+    """
+    path = templates_file()
+    with _TEMPLATE_LOCK, file_lock(path + '.lock'):
+        try:
+            with open(path) as the_file:
+                records = json.load(the_file)
+        except (IOError, OSError, ValueError):
+            records = {}
+        if not isinstance(records, dict):
+            records = {}
+        yield records
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as the_file:
+            json.dump(records, the_file, sort_keys=True, indent=2)
+        os.replace(tmp_path, path)
+
+
+def add_template_clone(template, instance_path):
+    """Record that the instance is a linked clone of the template VM."""
+    with template_records() as records:
+        clones = records.setdefault(template, {}).setdefault('clones', [])
+        if os.path.abspath(instance_path) not in clones:
+            clones.append(os.path.abspath(instance_path))
+
+
+def delete_template(vbm, template):
+    """Unregister the template VM and delete its files."""
+    click.secho("Deleting template VM '{}'...".format(template), fg="blue")
+    vbm.unregister(template, delete=True, quiet=True)
+    rmtree(os.path.join(templates_dir(), template), ignore_errors=True)
+
+
+def remove_template_clone(vbm, instance_path):
+    """Forget the instance (destroyed) and delete the template VM it was a
+       linked clone of, if its box was removed and it has no clone left.
+    """
+    with template_records() as records:
+        for template, record in list(records.items()):
+            if os.path.abspath(instance_path) not in record.get('clones', []):
+                continue
+            record['clones'].remove(os.path.abspath(instance_path))
+            if record.get('removed') and not record['clones']:
+                delete_template(vbm, template)
+                del records[template]
+
+
+def remove_box_templates(vbm, digests):
+    """Delete the template VMs of the (removed) boxes with digests.
+
+       A template VM which still has linked clones is kept until they are
+       destroyed.
+    """
+    with template_records() as records:
+        for digest in digests:
+            template = 'mech-template-{}'.format(digest[:12])
+            record = records.get(template, {})
+            if record.get('clones'):
+                click.secho("Keeping template VM '{}' until its linked clones are "
+                            "destroyed".format(template), fg="blue")
+                record['removed'] = True
+            elif record or locate(os.path.join(templates_dir(), template), '*.vbox'):
+                delete_template(vbm, template)
+                records.pop(template, None)
+
+
+def box_template(vbm, extracted):
+    """Return the name of the template VM of the extracted box (virtualbox).
+
+       The first time, the box is imported as a (hidden) template VM and a
+       snapshot is taken, so instances can be created as linked clones of it.
+    """
+    template = 'mech-template-{}'.format(os.path.basename(extracted)[:12])
+    with _TEMPLATE_LOCK:
+        if locate(os.path.join(templates_dir(), template), '*.vbox'):
+            return template
+        ovf_path = locate(extracted, '*.ovf')
+        if not ovf_path:
+            sys.exit(click.style("Cannot locate an OVF file", fg="red"))
+        LOGGER.debug('ovf_path:%s', ovf_path)
+        click.secho("Importing box as template VM '{}'...".format(template), fg="blue")
+        import_results = vbm.importvm(path_to_ovf=ovf_path, name=template,
+                                      base_folder=templates_dir(), quiet=True)
+        LOGGER.debug('import_results:%s', import_results)
+        if not locate(os.path.join(templates_dir(), template), '*.vbox'):
+            sys.exit(click.style("Cannot import box as template VM", fg="red"))
+        vbm.hide(template, quiet=True)
+        if vbm.snapshot(template, TEMPLATE_SNAPSHOT, quiet=True) is None:
+            sys.exit(click.style("Cannot take snapshot of '{}'".format(template), fg="red"))
+    return template
+
+
+def template_snapshot(vmrun):
+    """Take the snapshot linked clones are created from (unless the VM already has it)."""
+    with _TEMPLATE_LOCK:
+        snapshots = vmrun.list_snapshots(quiet=True) or ''
+        if TEMPLATE_SNAPSHOT in [line.strip() for line in snapshots.splitlines()[1:]]:
+            return
+        click.secho("Taking snapshot '{}' of '{}'...".format(
+            TEMPLATE_SNAPSHOT, vmrun.vmx_file), fg="blue")
+        if vmrun.snapshot(TEMPLATE_SNAPSHOT) is None:
+            sys.exit(click.style("Cannot take snapshot of '{}'".format(vmrun.vmx_file), fg="red"))
+
+
+def clone_instance(inst, source, numvcpus=None, memsize=None, no_nat=False):
+    """Create the instance as a linked clone of the source instance (vmware only).
+
+       The clone only stores its changes, the rest is read from a snapshot
+       of the source. Return the full path to the vmx file of the clone.
+    """
+    LOGGER.debug('inst:%s source:%s', inst.name, source.name)
+    if inst.provider != 'vmware' or source.provider != 'vmware':
+        sys.exit(click.style("Linked clones ('clone_from') are only supported "
+                             "with the 'vmware' provider.", fg="red"))
+    if not source.created:
+        sys.exit(click.style("Instance '{}' (to clone from) has not been created, "
+                             "run 'mech up {}' first.".format(source.name, source.name),
+                             fg="red"))
+    vmrun = VMrun(source.vmx)
+    template_snapshot(vmrun)
+    makedirs(inst.path)
+    vmx_path = os.path.join(inst.path, '{}.vmx'.format(inst.name))
+    click.secho("Creating '{}' as a linked clone of '{}'...".format(inst.name, source.name),
+                fg="blue")
+    if vmrun.clone(vmx_path, 'linked', snap_name=TEMPLATE_SNAPSHOT,
+                   clone_name=inst.name) is None:
+        sys.exit(click.style("Cannot clone '{}'".format(source.name), fg="red"))
+    update_vmx(vmx_path, numvcpus=numvcpus, memsize=memsize, no_nat=no_nat)
+    return vmx_path
+
+
+def box_cache_dir(box, box_version, provider=None):
+    """Return the directory the box is cached in."""
+    box_parts = box.split('/')
+    first_box_part = box_parts[0]
+    second_box_part = ''
+    if len(box_parts) > 1:
+        second_box_part = box_parts[1]
+    if provider is None:
+        provider = 'vmware'
+    return os.path.join(*filter(None, (mech_dir(), 'boxes', provider,
+                                       first_box_part, second_box_part, box_version)))
+
+
+def download_path(url):
+    """Return the path a url is downloaded to (stable, so a download can be resumed)."""
+    return os.path.join(mech_dir(), 'downloads', hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+
+def extract_box_stream(stream, instance_path, provider=None):
+    """Extract the box read from stream (a file-like object) into instance_path.
+
+       The members are validated as they go by. Returns True if the box
+       has a VMX (or OVF for virtualbox) file.
+    """
+    valid_endswith = 'ovf' if provider == 'virtualbox' else 'vmx'
+    extract_args = {}
+    if hasattr(tarfile, 'data_filter'):
+        extract_args['filter'] = 'data'
+    found = False
+    with tarfile.open(fileobj=stream, mode='r|*') as tar:
+        for member in tar:
+            if member.name.startswith('/') or '..' in member.name.split('/'):
+                sys.exit(click.style("This box is comprised of filenames "
+                                     "starting with '/' or '..' \n"
+                                     "Exiting for the safety of your files.", fg="red"))
+            if member.name.endswith(valid_endswith):
+                found = True
+            tar.extract(member, instance_path, **extract_args)
+    return found
+
+
+def box_checksum_file(box_file):
+    """Return the file the verified checksums of a cached box are stored in."""
+    return box_file + '.checksum'
+
+
+def box_checksums(box_file):
+    """Return the verified checksums (ex: ['sha256:abcd...']) of a cached box."""
+    try:
+        with open(box_checksum_file(box_file)) as the_file:
+            return the_file.read().split()
+    except (IOError, OSError):
+        return []
+
+
+def store_box_checksum(box_file, checksum):
+    """Store the verified checksum next to the cached box."""
+    checksums = box_checksums(box_file)
+    if str(checksum) not in checksums:
+        checksums.append(str(checksum))
+        with open(box_checksum_file(box_file), 'w') as the_file:
+            the_file.write('\n'.join(checksums) + '\n')
+
+
+def box_digest(box_file):
+    """Return the sha256 digest of a cached box (only computed the first time)."""
+    for checksum in box_checksums(box_file):
+        checksum_type, _, digest = checksum.partition(':')
+        if checksum_type == 'sha256':
+            return digest
+    LOGGER.debug('computing the digest of %s', box_file)
+    hasher = hashlib.sha256()
+    with open(box_file, 'rb') as the_file:
+        for data in iter(lambda: the_file.read(mech.download.DOWNLOAD_CHUNK_SIZE), b''):
+            hasher.update(data)
+    store_box_checksum(box_file, 'sha256:' + hasher.hexdigest())
+    return hasher.hexdigest()
+
+
+def extracted_box_dir(digest=None):
+    """Return the directory of the store of extracted boxes (or of the box with digest)."""
+    return os.path.join(*filter(None, (mech_dir(), 'extracted', digest)))
+
+
+def extract_box(box_file):
+    """Extract the box into the store of extracted boxes (unless it already is there).
+
+       The boxes are stored by digest, so a box is only ever extracted once.
+       Return the directory the box is extracted in.
+    """
+    path = extracted_box_dir(box_digest(box_file))
+    if os.path.isdir(path):
+        LOGGER.debug('box %s is already extracted in %s', box_file, path)
+        return path
+    click.secho("Extracting box '{}'...".format(box_file), fg="blue")
+    os.makedirs(extracted_box_dir(), exist_ok=True)
+    extracted = tempfile.mkdtemp(prefix='.tmp-', dir=extracted_box_dir())
+    try:
         if sys.platform == 'win32':
             cmd = tar_cmd('-xf', box_file, force_local=True)
         else:
@@ -501,41 +941,131 @@ def init_box(name, box=None, box_version=None, location=None, force=False, save=
             if os.name == "nt":
                 startupinfo = subprocess.STARTUPINFO()
                 startupinfo.dwFlags |= subprocess.SW_HIDE | subprocess.STARTF_USESHOWWINDOW
-            proc = subprocess.Popen(cmd, cwd=instance_path, startupinfo=startupinfo)
+            proc = subprocess.Popen(cmd, cwd=extracted, startupinfo=startupinfo)
             if proc.wait():
                 sys.exit(click.style("Cannot extract box", fg="red"))
         else:
             tar = tarfile.open(box_file, 'r')
-            tar.extractall(instance_path)
+            tar.extractall(extracted)
+    except BaseException:
+        rmtree(extracted, ignore_errors=True)
+        raise
+    return mech.box_store.add(extracted, path)
 
-        if not save and box.startswith(tempfile.gettempdir()):
-            os.unlink(box)
 
-    if provider == 'vmware':
-        vmx_path = locate(instance_path, '*.vmx')
-        if not vmx_path:
-            sys.exit(click.style("Cannot locate a VMX file", fg="red"))
-        update_vmx(vmx_path, numvcpus=numvcpus, memsize=memsize, no_nat=no_nat)
-        return vmx_path
-    else:
-        ovf_path = locate(instance_path, '*.ovf')
-        if not ovf_path:
-            sys.exit(click.style("Cannot locate an OVF file", fg="red"))
-        LOGGER.debug('ovf_path:%s', ovf_path)
-        vbm = mech.vbm.VBoxManage()
-        import_results = vbm.importvm(path_to_ovf=ovf_path, name=name,
-                                      base_folder=mech_dir(), quiet=True)
-        LOGGER.debug('import_results:%s', import_results)
-        vbox_path = locate(instance_path_save, '*.vbox')
-        if not vbox_path:
-            sys.exit(click.style("Cannot locate a vbox file", fg="red"))
-        # remove the extracted files
-        rmtree(instance_path)
-        return vbox_path
+def remove_extracted_boxes(box_dir):
+    """Remove the extracted boxes of the boxes cached in box_dir.
+       Return their digests.
+    """
+    digests = []
+    for root, _, filenames in os.walk(box_dir):
+        for filename in fnmatch.filter(filenames, '*.box'):
+            for checksum in box_checksums(os.path.join(root, filename)):
+                checksum_type, _, digest = checksum.partition(':')
+                if checksum_type == 'sha256':
+                    rmtree(extracted_box_dir(digest), ignore_errors=True)
+                    digests.append(digest)
+    return digests
+
+
+def create_instance_files(extracted, instance_path):
+    """Create the files of the instance from the extracted box (see mech.box_store)."""
+    mech.box_store.materialize(extracted, instance_path)
+
+
+def valid_checksum(checksum):
+    """Return a mech.download.Checksum for checksum (exit if it is not valid)."""
+    try:
+        return mech.download.Checksum(checksum)
+    except ValueError as exc:
+        sys.exit(click.style(str(exc), fg="red"))
+
+
+def verify_box(box_file, checksum):
+    """Verify the box file against the checksum (ex: 'sha256:abcd...').
+
+       The verified checksum is stored next to the box, so the box is only
+       read again for a different checksum.
+    """
+    expected = valid_checksum(checksum)
+    if str(expected) in box_checksums(box_file):
+        return
+    click.secho("Verifying {} checksum of box '{}'...".format(
+        expected.checksum_type, box_file), fg="blue")
+    with open(box_file, 'rb') as the_file:
+        expected.update_from_file(the_file, os.path.getsize(box_file))
+    try:
+        expected.verify(box_file)
+    except mech.download.ChecksumError as exc:
+        sys.exit(click.style("Box is corrupt: {}".format(exc), fg="red"))
+    store_box_checksum(box_file, expected)
+
+
+def stream_box(url, box, box_version, save=True, provider=None, checksum=None):
+    """Download the box from url, extracting it as it streams in.
+
+       The box is extracted into the store of extracted boxes.
+       Unless save is False, the box is also written to the box cache.
+       If checksum is given, the box is verified as it streams in.
+       Returns the directory the box was extracted in, or None if it was not
+       (in which case the box should be added the usual way).
+    """
+    box_dir = box_cache_dir(box, box_version, provider)
+    if mech.download.offline() or locate(box_dir, '*.box'):
+        return None
+    path = download_path(url)
+    makedirs(os.path.dirname(path))
+    if checksum:
+        valid_checksum(checksum)
+    the_download = mech.download.Download(url, path, checksum=checksum)
+    extracted = None
+    try:
+        reader = the_download.open_stream(save=save)
+        if reader is None:
+            return None
+        click.secho("Downloading and extracting box '{}'...".format(box), fg="blue")
+        click.secho("URL: {}".format(url), fg="blue")
+        os.makedirs(extracted_box_dir(), exist_ok=True)
+        extracted = tempfile.mkdtemp(prefix='.tmp-', dir=extracted_box_dir())
+        with click.progressbar(length=reader.length or 0, label="Downloading") as the_download.bar:
+            try:
+                found = extract_box_stream(reader, extracted, provider=provider)
+                reader.finish()
+            except BaseException:
+                reader.abort()
+                raise
+        if not found:
+            if save:
+                os.unlink(path)
+            sys.exit(click.style("Cannot find a valid box with a VMX/OVF "
+                                 "file in boxfile", fg="red"))
+        digest = reader.sha256.hexdigest()
+        extracted = mech.box_store.add(extracted, extracted_box_dir(digest))
+    except requests.HTTPError as exc:
+        sys.exit(click.style(("Bad response: %s" % exc), fg="red"))
+    except requests.ConnectionError:
+        sys.exit(click.style(("Couldn't connect to '%s'" % url), fg="red"))
+    except requests.RequestException as exc:
+        sys.exit(click.style(("Download failed (run again to resume): %s" % exc), fg="red"))
+    except tarfile.TarError as exc:
+        sys.exit(click.style(("Cannot extract box: %s" % exc), fg="red"))
+    except mech.download.ChecksumError as exc:
+        sys.exit(click.style(("Box is corrupt: %s" % exc), fg="red"))
+    finally:
+        if extracted is not None and os.path.basename(extracted).startswith('.tmp-'):
+            rmtree(extracted, ignore_errors=True)
+    if save:
+        makedirs(box_dir)
+        box_file = os.path.join(box_dir, os.path.basename(url))
+        os.replace(path, box_file)
+        store_box_checksum(box_file, 'sha256:' + digest)
+        if checksum:
+            store_box_checksum(box_file, the_download.checksum)
+    return extracted
 
 
 def add_box(name=None, box=None, box_version=None, location=None,
-            force=False, save=True, provider=None, windows=None):
+            force=False, save=True, provider=None, windows=None, checksum=None):
     """Add a box."""
     # build the dict
     LOGGER.debug('name:%s box:%s box_version:%s location:%s provider:%s windows:%s',
@@ -549,6 +1079,9 @@ def add_box(name=None, box=None, box_version=None, location=None,
         provider=provider,
         windows=windows)
 
+    if checksum:
+        mechfile_entry['box_checksum'] = checksum
+
     return add_mechfile(
         mechfile_entry,
         name=name,
@@ -577,6 +1110,7 @@ def add_mechfile(mechfile_entry, name=None, box=None, box_version=None,
 
     url = mechfile_entry.get('url')
     box_file = mechfile_entry.get('file')
+    checksum = mechfile_entry.get('box_checksum')
 
     if box_file:
         return add_box_file(box=box, box_version=box_version, filename=box_file,
@@ -586,25 +1120,25 @@ def add_mechfile(mechfile_entry, name=None, box=None, box_version=None,
     if url:
         return add_box_url(name=name, box=box, box_version=box_version,
                            url=url, force=force, save=save,
-                           provider=provider, windows=windows)
+                           provider=provider, windows=windows, checksum=checksum)
     click.secho("Could not find a VMWare compatible VM for '{}'{}".format(
         name, " ({})".format(box_version) if box_version else ""), fg="red")
 
 
-def add_box_url(name, box, box_version, url, force=False, save=True, provider=None, windows=None):
-    """Add a box using the URL."""
+def add_box_url(name, box, box_version, url, force=False, save=True, provider=None, windows=None,
+                checksum=None):
+    """Add a box using the URL (verified against checksum, if given)."""
     LOGGER.debug('name:%s box:%s box_version:%s url:%s provider:%s windows:%s',
                  name, box, box_version, url, provider, windows)
-    box_parts = box.split('/')
-    first_box_part = box_parts[0]
-    second_box_part = ''
-    if len(box_parts) > 1:
-        second_box_part = box_parts[1]
     if provider is None:
         provider = 'vmware'
-    box_dir = os.path.join(*filter(None, (mech_dir(), 'boxes', provider,
-                                          first_box_part, second_box_part, box_version)))
+    box_dir = box_cache_dir(box, box_version, provider)
     exists = os.path.exists(box_dir)
+    if checksum:
+        valid_checksum(checksum)
+    if (not exists or force) and mech.download.offline():
+        sys.exit(click.style("Offline and box '{}' is not in the box cache".format(box),
+                             fg="red"))
     if not exists or force:
         if exists:
             click.secho("Attempting to download provider:{} "
@@ -614,40 +1148,40 @@ def add_box_url(name, box, box_version, url, force=False, save=True, provider=No
                         "Attempting to download...".format(provider, box), fg="blue")
         try:
             click.secho("URL: {}".format(url), fg="blue")
-            response = requests.get(url, stream=True)
-            response.raise_for_status()
-            length = int(response.headers['content-length'])
-            chunk_size = 1024 * 1024
-            with click.progressbar(length=length, label="Downloading") as bar:
-                the_file = tempfile.NamedTemporaryFile(delete=False)
-                try:
-                    for chunk in response.iter_content(chunk_size=chunk_size):
-                        if chunk:
-                            the_file.write(chunk)
-                            bar.update(chunk_size)
-                    the_file.close()
-                    if response.headers.get('content-type') == 'application/json':
-                        # Downloaded URL might be a Vagrant catalog if it's json:
-                        catalog = json.load(the_file.name)
-                        mechfile = catalog_to_mechfile(catalog, name, box, box_version)
-                        return add_mechfile(
-                            mechfile,
-                            name=name,
-                            box_version=box_version,
-                            force=force,
-                            save=save,
-                            windows=windows)
-                    else:
-                        # Otherwise it must be a valid box:
-                        return add_box_file(box=box, box_version=box_version,
-                                            filename=the_file.name, url=url, force=force,
-                                            save=save, provider=provider, windows=windows)
-                finally:
-                    os.unlink(the_file.name)
+            the_download_path = download_path(url)
+            content_type = mech.download.download(url, the_download_path, checksum=checksum)
+            try:
+                if content_type == 'application/json':
+                    # Downloaded URL might be a Vagrant catalog if it's json:
+                    with open(the_download_path) as the_file:
+                        catalog = json.load(the_file)
+                    mechfile = catalog_to_mechfile(catalog, name, box, box_version)
+                    return add_mechfile(
+                        mechfile,
+                        name=name,
+                        box_version=box_version,
+                        force=force,
+                        save=save,
+                        windows=windows)
+                else:
+                    # Otherwise it must be a valid box:
+                    added = add_box_file(box=box, box_version=box_version,
+                                         filename=the_download_path, url=url, force=force,
+                                         save=save, provider=provider, windows=windows)
+                    if added and save and checksum:
+                        store_box_checksum(added[0], valid_checksum(checksum))
+                    return added
+            finally:
+                if os.path.exists(the_download_path):
+                    os.unlink(the_download_path)
         except requests.HTTPError as exc:
             sys.exit(click.style(("Bad response: %s" % exc), fg="red"))
         except requests.ConnectionError:
             sys.exit(click.style(("Couldn't connect to '%s'" % url), fg="red"))
+        except requests.RequestException as exc:
+            sys.exit(click.style(("Download failed (run again to resume): %s" % exc), fg="red"))
+        except mech.download.ChecksumError as exc:
+            sys.exit(click.style(("Box is corrupt: %s" % exc), fg="red"))
     return name, box_version, box
 
 
@@ -832,7 +1366,47 @@ def vm_ready_based_on_state(state):
     return False
 
 
-def ssh(instance, command, plain=None, extra=None, command_args=None):
+def ssh_control_path(instance):
+    """Return the path of the socket of the ssh master connection to the instance."""
+    path = os.path.join(instance.path, 'ssh-control')
+    if len(path) > SSH_CONTROL_PATH_MAX:
+        # too long for a unix socket, use a short (but stable) path instead
+        path = os.path.join(tempfile.gettempdir(), 'mech-ssh-{}'.format(
+            hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]))
+    return path
+
+
+def ssh_config(instance):
+    """Return the ssh config (dict) to use for the instance.
+
+       All ssh/scp commands to an instance share one connection (the first one
+       becomes the master, it is kept for SSH_CONTROL_PERSIST after the last use).
+    """
+    config_ssh = dict(instance.config_ssh())
+    if sys.platform != 'win32':
+        control_path = ssh_control_path(instance)
+        if ' ' in control_path:
+            control_path = '"{}"'.format(control_path)
+        config_ssh.update({
+            'ControlMaster': 'auto',
+            'ControlPath': control_path,
+            'ControlPersist': SSH_CONTROL_PERSIST,
+        })
+    return config_ssh
+
+
+def close_ssh_control(instance):
+    """Close the ssh master connection to the instance (if there is one)."""
+    mech.ssh_pool.close(instance.name)
+    control_path = ssh_control_path(instance)
+    if sys.platform == 'win32' or not os.path.exists(control_path):
+        return
+    LOGGER.debug('closing ssh master connection %s', control_path)
+    subprocess.run(['ssh', '-o', 'ControlPath={}'.format(control_path), '-O', 'exit',
+                    instance.name], capture_output=True)
+
+
+def ssh(instance, command, plain=None, extra=None, command_args=None, stdin=None):
     """Run ssh command.
 
        Parameters:
@@ -841,6 +1415,8 @@ def ssh(instance, command, plain=None, extra=None, command_args=None):
           plain(bool): use user/pass auth
           extra(str): arguments to pass to ssh
           command_args(str): arguments for command
+          stdin(str): data to send to the command (on its standard input), or a
+                      function writing it to a stream (ex: tar_stream.writer())
 
        Returns:
           return_code(int): 0=success
@@ -851,13 +1427,20 @@ def ssh(instance, command, plain=None, extra=None, command_args=None):
              Using the tempfile, there are options to not add host to the known_hosts files
              which is useful, but could be MITM attacks. Not likely locally, but still
              could be an issue.
+             With the 'paramiko' ssh transport, commands are run without starting
+             an ssh process (see mech.ssh_pool).
     """
-    LOGGER.debug('command:%s plain:%s extra:%s command_args:%s',
-                 command, plain, extra, command_args)
+    LOGGER.debug('command:%s plain:%s extra:%s command_args:%s stdin:%s',
+                 command, plain, extra, command_args, stdin is not None)
     if instance.created:
         state = instance.get_vm_state()
         if vm_ready_based_on_state(state):
-            config_ssh = instance.config_ssh()
+            if command and not plain and not extra and mech.ssh_pool.enabled():
+                if command_args:
+                    command = '{} {}'.format(command, command_args)
+                return mech.ssh_pool.run(instance.name, instance.config_ssh(), command,
+                                         stdin=stdin)
+            config_ssh = ssh_config(instance)
             temp_file = tempfile.NamedTemporaryFile(delete=False)
             try:
                 temp_file.write(config_ssh_string(config_ssh).encode('utf-8'))
@@ -878,8 +1461,11 @@ def ssh(instance, command, plain=None, extra=None, command_args=None):
                 LOGGER.debug('cmds:%s', cmds)
 
                 # if running a script
+                if command and callable(stdin):
+                    return stream_to_command(cmds, stdin)
                 if command:
-                    result = subprocess.run(cmds, capture_output=True)
+                    result = subprocess.run(cmds, capture_output=True, input=(
+                        stdin.encode('utf-8') if stdin is not None else None))
                     stdout = result.stdout.decode('utf-8').strip()
                     stderr = result.stderr.decode('utf-8').strip()
                     return result.returncode, stdout, stderr
@@ -892,6 +1478,74 @@ def ssh(instance, command, plain=None, extra=None, command_args=None):
             return 1, '', 'VM not ready({})'.format(state)
 
 
+def stream_to_command(cmds, writer):
+    """Run cmds, writer(stream) writes its standard input (while it runs).
+
+       Return (return_code, stdout, stderr) like ssh().
+    """
+    with tempfile.TemporaryFile() as output, tempfile.TemporaryFile() as errors:
+        proc = subprocess.Popen(cmds, stdin=subprocess.PIPE, stdout=output, stderr=errors)
+        try:
+            writer(proc.stdin)
+            proc.stdin.close()
+        except BrokenPipeError:
+            # the command stopped reading, its return code and stderr say why
+            LOGGER.debug('cmds:%s stopped reading', cmds)
+        return_code = proc.wait()
+        output.seek(0)
+        errors.seek(0)
+        return (return_code, output.read().decode('utf-8', 'replace').strip(),
+                errors.read().decode('utf-8', 'replace').strip())
+
+
+def guest_has_zstd(instance):
+    """Return True if zstd is installed in the guest (checked once per instance)."""
+    if instance.name not in _GUEST_ZSTD:
+        return_code, _, _ = ssh(instance, 'command -v zstd')
+        _GUEST_ZSTD[instance.name] = return_code == 0
+    return _GUEST_ZSTD[instance.name]
+
+
+def guest_path(path):
+    """Return (directory, relative path) of a path in the guest.
+
+       The directory is '/' for absolute paths and '' (the home directory) otherwise.
+    """
+    if path.startswith('/'):
+        return '/', path.lstrip('/')
+    if path == '~' or path.startswith('~/'):
+        return '', path[2:]
+    return '', path
+
+
+def tar_to_guest(instance, members, directory=''):
+    """Copy members (see tar_stream.expand()) into directory of the guest with one tar stream.
+
+       The stream is compressed (zstd if the host and guest have it, else gzip)
+       unless most of the content is already compressed.
+       Return (return_code, stdout, stderr) like scp().
+    """
+    compression = mech.tar_stream.choose_compression(members, zstd=True)
+    if compression == 'zstd' and not guest_has_zstd(instance):
+        compression = 'gzip'
+    LOGGER.debug('members:%d directory:%s compression:%s', len(members), directory, compression)
+    return ssh(instance, mech.tar_stream.extract_command(directory, compression),
+               stdin=mech.tar_stream.writer(members, compression))
+
+
+def copy_to_guest(instance, sources, destination):
+    """Copy sources (files, directories or globs) into the destination directory of the guest.
+
+       Return (return_code, stdout, stderr) like scp().
+    """
+    directory, relative = guest_path(destination)
+    try:
+        members = mech.tar_stream.expand(sources, relative)
+    except OSError as exc:
+        return 1, '', str(exc)
+    return tar_to_guest(instance, members, directory)
+
+
 def scp(instance, src, dst, dst_is_host, extra=None):
     """Run scp command.
        Note: May not really need the tempfile if self.use_psk==True.
@@ -902,7 +1556,10 @@ def scp(instance, src, dst, dst_is_host, extra=None):
     if instance.created:
         state = instance.get_vm_state()
         if vm_ready_based_on_state(state):
-            config_ssh = instance.config_ssh()
+            if not extra and mech.ssh_pool.enabled():
+                return mech.ssh_pool.copy(instance.name, instance.config_ssh(), src, dst,
+                                          dst_is_host)
+            config_ssh = ssh_config(instance)
             temp_file = tempfile.NamedTemporaryFile(delete=False)
 
             try:
@@ -959,18 +1616,356 @@ def del_user(instance, username):
     ssh(instance=instance, command=cmd)
 
 
-def provision(instance, show=False):
+def log_file(name, operation):
+    """Return a new log file for an operation on the instance (None if it does not exist)."""
+    instance_path = os.path.join(mech_dir(), name)
+    if not os.path.isdir(instance_path):
+        return None
+    logs_dir = os.path.join(instance_path, 'logs')
+    makedirs(logs_dir)
+    return os.path.join(logs_dir, '{}-{}.log'.format(operation, time.strftime('%Y%m%d-%H%M%S')))
+
+
+def provision_state_file(instance):
+    """Return the file with the fingerprints of the provisioner entries run on the instance."""
+    return os.path.join(instance.path, 'provision-state.json')
+
+
+def load_provision_state(instance):
+    """Return the fingerprints of the provisioner entries (successfully) run on the instance."""
+    try:
+        with open(provision_state_file(instance)) as the_file:
+            fingerprints = json.load(the_file).get('fingerprints', [])
+    except (OSError, ValueError, AttributeError):
+        return []
+    return fingerprints if isinstance(fingerprints, list) else []
+
+
+def save_provision_state(instance, fingerprints):
+    """Save the fingerprints of the provisioner entries run on the instance."""
+    state_file = provision_state_file(instance)
+    if not os.path.isdir(os.path.dirname(state_file)):
+        return
+    temp_file = '{}.tmp'.format(state_file)
+    with open(temp_file, 'w') as the_file:
+        json.dump({'fingerprints': fingerprints}, the_file, indent=2)
+    os.replace(temp_file, state_file)
+
+
+def provision_cache_dir():
+    """Return the directory remote provisioning scripts are cached in."""
+    return os.path.join(mech_dir(), 'cache', 'provision')
+
+
+def is_remote(location):
+    """Return True if location is a url (not a local path)."""
+    return any(location.startswith(s) for s in ('https://', 'http://', 'ftp://'))
+
+
+_ARTIFACTS_LOCK = threading.Lock()
+_ARTIFACTS = {}
+
+
+def provision_artifact(url):
+    """Return the content (str) of a remote provisioning script, None if it cannot be had.
+
+       Scripts are cached in provision_cache_dir() and revalidated using
+       ETag/Last-Modified, once per run (prefetch_provision_artifacts() can do it
+       ahead of time). The cached copy is used when offline or if the server
+       cannot be reached.
+    """
+    with _ARTIFACTS_LOCK:
+        entry = _ARTIFACTS.setdefault(url, {'lock': threading.Lock(), 'validated': False})
+    cache_file = os.path.join(provision_cache_dir(), hashlib.sha1(url.encode('utf-8')).hexdigest())
+    with entry['lock']:
+        cached = None
+        try:
+            with open(cache_file + '.json') as the_file:
+                cached = json.load(the_file)
+            with open(cache_file, 'rb') as the_file:
+                content = the_file.read()
+        except (IOError, OSError, ValueError):
+            cached = None
+        if cached and cached.get('url') != url:
+            cached = None
+        if cached and (entry['validated'] or mech.download.offline()):
+            return content.decode('utf-8', 'replace')
+        if mech.download.offline():
+            click.secho("Offline and there is no cached copy of {}".format(url), fg="red")
+            return None
+
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+        try:
+            response = mech.download.get(url, headers=headers)
+            if cached and response.status_code == 304:
+                LOGGER.debug('cached copy of url:%s is still valid', url)
+            else:
+                response.raise_for_status()
+                click.secho("Downloading {}...".format(url), fg="blue")
+                content = response.content
+                cached = {'url': url,
+                          'etag': response.headers.get('etag'),
+                          'last_modified': response.headers.get('last-modified')}
+                save_provision_artifact(cache_file, cached, content)
+        except requests.RequestException:
+            LOGGER.debug('url:%s', url, exc_info=True)
+            if cached is None:
+                return None
+            click.secho("Could not download {}, using the cached copy.".format(url), fg="yellow")
+        entry['validated'] = True
+        return content.decode('utf-8', 'replace')
+
+
+def save_provision_artifact(cache_file, cached, content):
+    """Save a downloaded provisioning script (and its ETag/Last-Modified) in the cache."""
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        for path, data in ((cache_file, content),
+                           (cache_file + '.json', json.dumps(cached).encode('utf-8'))):
+            tmp_file = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_file, 'wb') as the_file:
+                the_file.write(data)
+            os.replace(tmp_file, path)
+    except (IOError, OSError) as exc:
+        # the cache is only an optimization
+        LOGGER.debug('could not save provisioning cache: %s', exc)
+
+
+def prefetch_provision_artifacts(insts):
+    """Start fetching the remote provisioning scripts of the instances in the background.
+
+       So they are (re)validated while the boxes are extracted and the instances boot.
+       Return the threads.
+    """
+    urls = []
+    for inst in insts:
+        for pro in inst.provision or []:
+            path = pro.get('path')
+            if pro.get('type') in ('shell', 'ps', 'pyinfra') and path and is_remote(path) \
+                    and not path.startswith('ftp://') and path not in urls:
+                urls.append(path)
+    threads = []
+    for url in urls:
+        LOGGER.debug('prefetching url:%s', url)
+        thread = threading.Thread(target=provision_artifact, args=(url,), daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def provision_fingerprint(pro):
+    """Return the fingerprint of a provisioner entry, None if it cannot be computed.
+
+       It covers the entry itself (inline, args, ...), the content of its local
+       source/path (files, directories or globs) and the content of a remote path.
+    """
+    digest = hashlib.sha256(json.dumps(pro, sort_keys=True).encode('utf-8'))
+    for key in ('source', 'path'):
+        location = pro.get(key)
+        if not location:
+            continue
+        if is_remote(location):
+            content = provision_artifact(location) if not location.startswith('ftp://') else None
+            if content is None:
+                return None
+            digest.update(content.encode('utf-8'))
+            continue
+        try:
+            files = list(mech.tar_stream.walk(mech.tar_stream.expand([location], '')))
+        except OSError:
+            return None
+        for path, _ in sorted(files):
+            digest.update(path.encode('utf-8'))
+            with open(path, 'rb') as the_file:
+                for chunk in iter(lambda: the_file.read(1024 * 1024), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def provision_dependencies(entries):
+    """Return the indexes of the provisioner entries each entry depends on.
+
+       An entry depends on the previous one, unless it lists the ids of the
+       entries it depends on in 'after' (an empty list for none).
+    """
+    ids = {}
+    for i, pro in enumerate(entries):
+        if pro.get('id') is not None:
+            if str(pro['id']) in ids:
+                sys.exit(click.style("Duplicate provisioner id '{}'.".format(pro['id']),
+                                     fg="red"))
+            ids[str(pro['id'])] = i
+    dependencies = []
+    for i, pro in enumerate(entries):
+        after = pro.get('after')
+        if after is None:
+            dependencies.append([i - 1] if i else [])
+            continue
+        if not isinstance(after, list):
+            after = [after]
+        unknown = [str(name) for name in after if str(name) not in ids]
+        if unknown:
+            sys.exit(click.style("Unknown provisioner id(s) in 'after' of entry {}: {}".format(
+                i + 1, ', '.join(unknown)), fg="red"))
+        dependencies.append([ids[str(name)] for name in after])
+    mech.executor.dependency_order(
+        list(range(len(entries))), dict(enumerate(dependencies)),
+        circular="Circular 'after' between provisioner entries (indexes)")
+    return dependencies
+
+
+def provision_plan(instance, force=False, only=None, start=None, dependencies=None):
+    """Return (fingerprints, indexes) of the provisioner entries of the instance to run.
+
+       Without force/only/start, the entries whose fingerprint changed since the
+       last successful run are run, with the entries depending on them (by default
+       each entry depends on the previous one, so also all the entries after it).
+       only and start are positions in the provision list (starting at 1).
+    """
+    fingerprints = [provision_fingerprint(pro) for pro in instance.provision]
+    count = len(fingerprints)
+    for position in (only, start):
+        if position is not None and not 1 <= position <= count:
+            sys.exit(click.style("No provisioner entry {} (there are {}).".format(
+                position, count), fg="red"))
+    if only is not None:
+        return fingerprints, [only - 1]
+    if start is not None:
+        return fingerprints, list(range(start - 1, count))
+    if force:
+        return fingerprints, list(range(count))
+    if dependencies is None:
+        dependencies = provision_dependencies(instance.provision)
+    recorded = load_provision_state(instance)
+    selected = set(i for i, fingerprint in enumerate(fingerprints)
+                   if fingerprint is None or recorded[i:i + 1] != [fingerprint])
+    # and the entries depending on them (until there are no more)
+    dependents = selected
+    while dependents:
+        dependents = set(i for i in range(count)
+                         if selected.intersection(dependencies[i])) - selected
+        selected.update(dependents)
+    return fingerprints, sorted(selected)
+
+
+def provision_tasks(entries, selected):
+    """Return the selected provisioner entries grouped in tasks (lists of indexes).
+
+       Consecutive file entries (without 'after') are one task (copied together).
+    """
+    tasks = []
+    for i in selected:
+        pro = entries[i]
+        if tasks and pro.get('type') == 'file' and pro.get('after') is None and \
+                tasks[-1][-1] == i - 1 and entries[i - 1].get('type') == 'file':
+            tasks[-1].append(i)
+        else:
+            tasks.append([i])
+    return tasks
+
+
+def provision_show(instance, pro):
+    """Print a provisioner entry."""
+    provision_type = pro.get('type')
+    args = pro.get('args')
+    if not isinstance(args, list):
+        args = [args]
+    if provision_type == 'file':
+        click.secho(" instance.name:{} provision_type:{} source:{} "
+                    "destination:{}".format(instance.name, provision_type,
+                                            pro.get('source'), pro.get('destination')),
+                    fg="green")
+    elif provision_type in ('shell', 'ps'):
+        click.secho(" instance.name:{} provision_type:{} inline:{} path:{} "
+                    "args:{}".format(instance.name, provision_type,
+                                     pro.get('inline'), pro.get('path'), args), fg="green")
+    else:
+        click.secho(" instance.name:{} provision_type:{} path:{} "
+                    "args:{}".format(instance.name, provision_type,
+                                     pro.get('path'), args), fg="green")
+
+
+def provision_task(instance, entries, batcher=None):
+    """Run provisioner entries (one entry, or consecutive file entries).
+
+       pyinfra entries are run with the same entries of other instances when
+       there is a batcher (see pyinfra_batcher()).
+       Return (return_code, stdout, stderr), None if they could not be run.
+    """
+    pro = entries[0]
+    provision_type = pro.get('type')
+    inline = pro.get('inline')
+    path = pro.get('path')
+    args = pro.get('args')
+    if not isinstance(args, list):
+        args = [args]
+
+    if provision_type == 'file':
+        for entry in entries:
+            click.secho("File provisioning (source:{} destination:{})".format(
+                entry.get('source'), entry.get('destination')), fg="green")
+        results = provision_files(instance, [(entry.get('source'), entry.get('destination'))
+                                             for entry in entries])
+        LOGGER.debug('results:%s', results)
+        return results
+
+    if provision_type == 'shell':
+        click.secho("Inline shell provisioining (inline:{} path:{} args:{}".format(
+                    inline, path, args), fg="green")
+        results = provision_shell(instance, inline, path, args, stdin=pro.get('stdin', False))
+        echo_results(results)
+        return results
+
+    if provision_type == 'ps':
+        click.secho("Inline ps provisioining (inline:{} path:{} args:{}".format(
+                    inline, path, args), fg="green")
+        return provision_ps(instance, inline, path)
+
+    click.secho("pyinfra provisioining (path:{} args:{}".format(
+                path, args), fg="green")
+    if batcher is not None:
+        results = batcher.run(pyinfra_key(pro), instance.name, instance)
+    else:
+        results = provision_pyinfra(instance, path, args)
+    if results is None or results[0] is None:
+        return None
+    return_code, stdout, stderr = results
+    echo_results((return_code, stdout, ''))
+    LOGGER.debug('return_code:%d stdout:%s stderr:%s', return_code, stdout, stderr)
+    return return_code, stdout, stderr
+
+
+def provision(instance, show=False, force=False, only=None, start=None, batcher=None):
     """Provision an instance.
 
     Args:
         instance (MechInstance): an instance
         show (bool): just print the provisioning
+        force (bool): run all entries (even the unchanged ones)
+        only (int): only run this entry (starting at 1)
+        start (int): run this entry and the ones after it (starting at 1)
+        batcher (Batcher): to run pyinfra entries together with other instances
+
+    Returns:
+        False if an entry failed
 
     Notes:
         Valid provision types are:
            file: copies files to instances
            shell: executes scripts
 
+        The fingerprints of the entries run are saved in provision-state.json
+        (in the instance directory), unchanged entries are skipped the next time.
+
+        Entries are run in order. An entry with 'after' (a list of the 'id' of
+        other entries) only waits for those, so independent entries run at the
+        same time (up to provision_parallel of the instance). The entries
+        depending on a failed entry are skipped.
+
     """
 
     if not instance:
@@ -987,94 +1982,91 @@ def provision(instance, show=False):
 
     click.secho('Provisioning instance:{}'.format(instance.name), fg="green")
 
-    provisioned = 0
-    if instance.provision:
-        for i, pro in enumerate(instance.provision):
-            provision_type = pro.get('type')
-            if provision_type == 'file':
-                source = pro.get('source')
-                destination = pro.get('destination')
-                if show:
-                    click.secho(" instance.name:{} provision_type:{} source:{} "
-                                "destination:{}".format(instance.name, provision_type,
-                                                        source, destination), fg="green")
-                else:
-                    click.secho("File provisioning (source:{} destination:{})".format(
-                        source, destination), fg="green")
-                    results = provision_file(instance, source, destination)
-                    LOGGER.debug('results:%s', results)
-                    if results is None:
-                        click.secho("Not Provisioned", fg="red")
-                        return
-                provisioned += 1
-
-            elif provision_type == 'shell':
-                inline = pro.get('inline')
-                path = pro.get('path')
-
-                args = pro.get('args')
-                if not isinstance(args, list):
-                    args = [args]
-                if show:
-                    click.secho(" instance.name:{} provision_type:{} inline:{} path:{} "
-                                "args:{}".format(instance.name, provision_type,
-                                                 inline, path, args), fg="green")
-                else:
-                    click.secho("Inline shell provisioining (inline:{} path:{} args:{}".format(
-                                inline, path, args), fg="green")
-                    if provision_shell(instance, inline, path, args) is None:
-                        click.secho("Not Provisioned", fg="red")
-                        return
-                provisioned += 1
-
-            elif provision_type == 'ps':
-                inline = pro.get('inline')
-                path = pro.get('path')
-
-                args = pro.get('args')
-                if not isinstance(args, list):
-                    args = [args]
-                if show:
-                    click.secho(" instance.name:{} provision_type:{} inline:{} path:{} "
-                                "args:{}".format(instance.name, provision_type,
-                                                 inline, path, args), fg="green")
-                else:
-                    click.secho("Inline ps provisioining (inline:{} path:{} args:{}".format(
-                                inline, path, args), fg="green")
-                    if provision_ps(instance, inline, path) is None:
-                        click.secho("Not Provisioned", fg="red")
-                        return
-                provisioned += 1
-
-            elif provision_type == 'pyinfra':
-                path = pro.get('path')
-
-                args = pro.get('args')
-                if not isinstance(args, list):
-                    args = [args]
-                if show:
-                    click.secho(" instance.name:{} provision_type:{} path:{} "
-                                "args:{}".format(instance.name, provision_type,
-                                                 path, args), fg="green")
-                else:
-                    click.secho("pyinfra provisioining (path:{} args:{}".format(
-                                path, args), fg="green")
-                    return_code, stdout, stderr = provision_pyinfra(instance, path, args)
-                    if return_code is None:
-                        click.secho("Not Provisioned", fg="red")
-                        return
-                    LOGGER.debug('return_code:%d stdout:%s stderr:%s', return_code, stdout, stderr)
-                provisioned += 1
-
-            else:
-                click.secho("Not Provisioned - unknown provision type ({}) "
-                            "(entries:{})".format(provision_type, i), fg="red")
-                return
-        else:
-            click.secho("VM ({}) Provision {} "
-                        "entries".format(instance.name, provisioned), fg="green")
-    else:
+    if not instance.provision:
         click.secho("Nothing to provision", fg="blue")
+        return True
+
+    for i, pro in enumerate(instance.provision):
+        if pro.get('type') not in ('file', 'shell', 'ps', 'pyinfra'):
+            click.secho("Not Provisioned - unknown provision type ({}) "
+                        "(entries:{})".format(pro.get('type'), i), fg="red")
+            return False
+
+    if show:
+        for pro in instance.provision:
+            provision_show(instance, pro)
+        click.secho("VM ({}) Provision {} "
+                    "entries".format(instance.name, len(instance.provision)), fg="green")
+        return True
+
+    dependencies = provision_dependencies(instance.provision)
+    fingerprints, selected = provision_plan(instance, force=force, only=only, start=start,
+                                            dependencies=dependencies)
+    if not selected:
+        click.secho("Nothing to provision (unchanged since the last run, "
+                    "use --force to run it again)", fg="blue")
+        return True
+    if len(selected) < len(instance.provision):
+        click.secho("Skipping {} unchanged entries".format(
+            len(instance.provision) - len(selected)), fg="blue")
+
+    state = load_provision_state(instance)
+    state = (state + [None] * len(fingerprints))[:len(fingerprints)]
+    failed = []
+    lock = threading.Lock()
+
+    def run(task):
+        results = provision_task(instance, [instance.provision[i] for i in task], batcher)
+        if results is None:
+            click.secho("Not Provisioned", fg="red")
+            return False
+        if not isinstance(results, tuple):
+            return True
+        with lock:
+            if results[0] != 0:
+                failed.extend(task)
+                return False
+            for i in task:
+                state[i] = fingerprints[i]
+            save_provision_state(instance, state)
+        return True
+
+    # tasks are known by their first entry
+    tasks = {task[0]: task for task in provision_tasks(instance.provision, selected)}
+    task_of = {i: first for first, task in tasks.items() for i in task}
+    task_dependencies = {first: set(task_of.get(dependency, dependency)
+                                    for i in task for dependency in dependencies[i]) - {first}
+                         for first, task in tasks.items()}
+    declared = any(pro.get('after') is not None for pro in instance.provision)
+    results = mech.executor.run_graph(list(tasks), task_dependencies,
+                                      lambda first: run(tasks[first]),
+                                      instance.provision_parallel if declared else 1,
+                                      fail_fast=False)
+    if not failed and (len(results) < len(tasks) or False in results.values()):
+        return False
+
+    click.secho("VM ({}) Provision {} "
+                "entries".format(instance.name, len(selected)), fg="green")
+    if failed:
+        click.secho("Failed entries: {}".format(
+            ', '.join(str(index + 1) for index in sorted(failed))), fg="red")
+        skipped = [i for first, task in tasks.items() if first not in results for i in task]
+        if skipped:
+            click.secho("Skipped entries (after a failed entry): {}".format(
+                ', '.join(str(index + 1) for index in sorted(skipped))), fg="red")
+        return False
+    return True
+
+
+def echo_results(results):
+    """Echo the output of a provisioner entry (return_code, stdout, stderr)."""
+    if not isinstance(results, tuple) or len(results) != 3:
+        return
+    _, stdout, stderr = results
+    if stdout:
+        click.echo(stdout)
+    if stderr:
+        click.secho(stderr, fg="red")
 
 
 def winrm_copy(instance, local, remote):
@@ -1163,6 +2155,65 @@ def provision_file(instance, source, destination):
         return scp(instance, source, destination, True)
 
 
+def provision_files(instance, files):
+    """Provision from several files (consecutive file provisioners).
+
+    Args:
+        instance (MechInstance): instance of the MechInstance class
+        files (list): (source, destination) of each file provisioner
+
+    Returns:
+        return_code
+        stdout
+        stderr
+        (None if the files could not be copied)
+
+    Notes:
+       Sources can also be directories or globs (then destination is a directory).
+       Like scp, a source is copied into the destination when it ends with '/'.
+       Except on Windows, they are copied using one tar stream (per destination
+       directory: '/' or the home directory) instead of one scp per file.
+
+    """
+    single = len(files) == 1 and not os.path.isdir(files[0][0]) \
+        and not mech.tar_stream.has_glob(files[0][0])
+    if instance.windows is True or single:
+        results = None
+        for source, destination in files:
+            results = provision_file(instance, source, destination)
+        return results
+
+    groups = []
+    for source, destination in files:
+        directory, relative = guest_path(destination)
+        if mech.tar_stream.has_glob(source) or \
+                (destination.endswith('/') and os.path.exists(source)):
+            try:
+                members = mech.tar_stream.expand([source], relative)
+            except OSError as exc:
+                click.secho(str(exc), fg="red")
+                return None
+        elif os.path.exists(source):
+            members = [(source, relative)]
+        else:
+            click.secho("Cannot find ({})".format(source), fg="red")
+            return None
+        if groups and groups[-1][0] == directory:
+            groups[-1][1].extend(members)
+        else:
+            groups.append((directory, members))
+
+    results = None
+    for directory, members in groups:
+        click.secho("Copying {} files/directories to ({}) using tar".format(
+            len(members), directory or '~'), fg="blue")
+        results = tar_to_guest(instance, members, directory)
+        if results[0] != 0:
+            click.secho(results[2], fg="red")
+            return None
+    return results
+
+
 def create_tempfile_in_guest(instance):
     """Create a tempfile in the guest."""
     cmd = 'tmpfile=$(mktemp); echo $tmpfile'
@@ -1177,20 +2228,60 @@ def winrm_create_tempfile_in_guest(instance):
     return stdout
 
 
-def provision_shell(instance, inline, script_path, args=None):
+def read_shell_script(inline, script_path):
+    """Return the script to run (from script_path, a url or inline), None if there is none."""
+    if script_path and os.path.isfile(script_path):
+        with open(script_path) as the_file:
+            return the_file.read()
+    if script_path:
+        if is_remote(script_path):
+            return provision_artifact(script_path)
+        click.secho("Cannot open {}".format(script_path), fg="red")
+        return None
+    if not inline:
+        click.secho("No script to execute", fg="red")
+        return None
+    return inline
+
+
+def runs_in_shell(script):
+    """Return True if the script can be run with 'bash -s' (no other interpreter in '#!')."""
+    first_line = script.lstrip().split('\n', 1)[0]
+    if not first_line.startswith('#!'):
+        return True
+    words = first_line[2:].split()
+    # an empty '#!' runs with the shell too
+    return not words or os.path.basename(words[-1]) in ('sh', 'bash')
+
+
+def provision_shell(instance, inline, script_path, args=None, stdin=False):
     """Provision from shell.
 
        Note: The script must be copied to guest, then run from there.
+             Unless stdin is True, then the script is sent to 'bash -s' in the
+             guest (one ssh command, no temporary files), if it is a shell script.
 
     Args:
         instance (MechInstance): instance of the MechInstance class
         inline (bool): run the script inline
         script_path (str): path to the script to run
         args (list of str): arguments to the script
+        stdin (bool): send the script over stdin
 
     """
     if args is None:
         args = []
+    if stdin:
+        script = read_shell_script(inline, script_path)
+        if script is None:
+            return None
+        if runs_in_shell(script):
+            click.secho("Executing program (over stdin)...", fg="blue")
+            args_string = ' '.join([str(elem) for elem in args if elem is not None])
+            LOGGER.debug('args:%s args_string:%s', args, args_string)
+            return ssh(instance=instance, command='bash -s --', command_args=args_string,
+                       stdin=script)
+        LOGGER.debug('not a shell script, copying it to the guest')
     tmp_path = create_tempfile_in_guest(instance)
     LOGGER.debug('inline:%s script_path:%s args:%s tmp_path:%s',
                  inline, script_path, args, tmp_path)
@@ -1207,15 +2298,9 @@ def provision_shell(instance, inline, script_path, args=None):
                 return
         else:
             if script_path:
-                if any(script_path.startswith(s) for s in ('https://', 'http://', 'ftp://')):
-                    click.secho("Downloading {}...".format(script_path), fg="blue")
-                    try:
-                        response = requests.get(script_path)
-                        response.raise_for_status()
-                        inline = response.read()
-                    except requests.HTTPError:
-                        return
-                    except requests.ConnectionError:
+                if is_remote(script_path):
+                    inline = provision_artifact(script_path)
+                    if inline is None:
                         return
                 else:
                     click.secho("Cannot open {}".format(script_path), fg="red")
@@ -1247,7 +2332,7 @@ def provision_shell(instance, inline, script_path, args=None):
         return ssh(instance=instance, command=tmp_path, command_args=args_string)
 
     finally:
-        return ssh(instance, 'rm -f "{}"'.format(tmp_path))
+        ssh(instance, 'rm -f "{}"'.format(tmp_path))
 
 
 def provision_ps(instance, inline, script_path):
@@ -1279,16 +2364,10 @@ def provision_ps(instance, inline, script_path):
             ps = inline
         else:
             if script_path:
-                if any(script_path.startswith(s) for s in ('https://', 'http://', 'ftp://')):
+                if is_remote(script_path):
                     # looks like we need to download the powershell
-                    click.secho("Downloading {}...".format(script_path), fg="blue")
-                    try:
-                        response = requests.get(script_path)
-                        response.raise_for_status()
-                        ps = response.read()
-                    except requests.HTTPError:
-                        return
-                    except requests.ConnectionError:
+                    ps = provision_artifact(script_path)
+                    if ps is None:
                         return
                 else:
                     click.secho("Cannot open {}".format(script_path), fg="red")
@@ -1323,36 +2402,159 @@ def provision_pyinfra(instance, script_path, args=None):
 
     LOGGER.debug('instance.name:%s script_path:%s args:%s', instance.name, script_path, args)
 
-    if script_path and os.path.isfile(script_path):
-        return run_pyinfra_script(instance.get_ip(), instance.user,
+    with pyinfra_script(script_path) as path:
+        if path is None:
+            return
+        return run_pyinfra_script(host=instance.get_ip(), username=instance.user,
                                   password=instance.password,
-                                  script_path=script_path, args=args)
-    else:
-        if script_path:
-            if any(script_path.startswith(s) for s in ('https://', 'http://', 'ftp://')):
-                click.secho("Downloading {}...".format(script_path), fg="blue")
-                try:
-                    response = requests.get(script_path)
-                    response.raise_for_status()
-                    pyinfra_remote_contents = response.text
-                except requests.HTTPError:
-                    return
-                except requests.ConnectionError:
-                    return
-            else:
-                click.secho("Cannot open {}".format(script_path), fg="red")
-                return
+                                  script_path=path, args=args)
 
-        LOGGER.debug('pyinfra_remote_contents:%s', pyinfra_remote_contents)
-        the_file = tempfile.NamedTemporaryFile(delete=False, suffix='.py')
-        try:
-            the_file.write(str.encode(pyinfra_remote_contents))
-            the_file.close()
-            return run_pyinfra_script(host=instance.get_ip(), username=instance.user,
-                                      password=instance.password,
-                                      script_path=the_file.name, args=args)
-        finally:
-            os.unlink(the_file.name)
+
+@contextlib.contextmanager
+def pyinfra_script(script_path):
+    """Context manager giving the path of the pyinfra script (downloaded if it is a url).
+
+       Gives None if the script cannot be found.
+    """
+    if script_path and os.path.isfile(script_path):
+        yield script_path
+        return
+    if not script_path:
+        click.secho("Warning: A script is required for pyinfra provisioning.", fg="red")
+        yield None
+        return
+    if not is_remote(script_path):
+        click.secho("Cannot open {}".format(script_path), fg="red")
+        yield None
+        return
+
+    pyinfra_remote_contents = provision_artifact(script_path)
+    if pyinfra_remote_contents is None:
+        yield None
+        return
+
+    LOGGER.debug('pyinfra_remote_contents:%s', pyinfra_remote_contents)
+    the_file = tempfile.NamedTemporaryFile(delete=False, suffix='.py')
+    try:
+        the_file.write(str.encode(pyinfra_remote_contents))
+        the_file.close()
+        yield the_file.name
+    finally:
+        os.unlink(the_file.name)
+
+
+def pyinfra_key(pro):
+    """Return the key of a pyinfra provisioner entry (entries with the same key run together)."""
+    args = pro.get('args')
+    if not isinstance(args, list):
+        args = [args]
+    return pro.get('path'), json.dumps(args)
+
+
+def pyinfra_batcher(insts):
+    """Return a Batcher running pyinfra once for the instances sharing a script (and args).
+
+       (see executor.Batcher, the instances provisioned at the same time are grouped)
+    """
+    candidates = {}
+    for inst in insts:
+        for pro in inst.provision or []:
+            if pro.get('type') == 'pyinfra':
+                candidates.setdefault(pyinfra_key(pro), set()).add(inst.name)
+    return mech.executor.Batcher(run_pyinfra_batch, {
+        key: names for key, names in candidates.items() if len(names) > 1})
+
+
+def run_pyinfra_batch(key, insts):
+    """Run the pyinfra script of key on the instances (dict of name to MechInstance).
+
+       Return a dict of name to (return_code, stdout, stderr) (or None).
+    """
+    script_path, args = key[0], json.loads(key[1])
+    if len(insts) == 1:
+        return {name: provision_pyinfra(inst, script_path, args)
+                for name, inst in insts.items()}
+    with pyinfra_script(script_path) as path:
+        if path is None:
+            return {}
+        return run_pyinfra_inventory(list(insts.values()), path, args)
+
+
+def run_pyinfra_inventory(insts, script_path, args=None):
+    """Run a pyinfra script once on several instances (using an inventory of them).
+
+       Returns:
+         - a dict of the name of each instance to (return_code, stdout, stderr),
+           where stdout has the lines of the output about that instance
+           (or an empty dict if pyinfra could not be run)
+    """
+    LOGGER.debug("names:%s script_path:%s args:%s",
+                 [inst.name for inst in insts], script_path, args)
+    if not script_path.endswith('.py'):
+        click.secho("Warning: A pyinfra provisioning script must end with .py.", fg="red")
+        return {}
+
+    if not pyinfra_installed():
+        click.secho("Warning: pyinfra must be installed.", fg="red")
+        return {}
+
+    hosts = []
+    for inst in insts:
+        host = inst.get_ip()
+        if not host:
+            click.secho("Warning: A host is required for pyinfra provisioning "
+                        "({}).".format(inst.name), fg="red")
+            return {}
+        data = {'ssh_user': inst.user, 'mech_name': inst.name}
+        if inst.password is not None:
+            data['ssh_password'] = inst.password
+        hosts.append((host, data))
+
+    click.secho("Going to run ({}) using args({}) on hosts:{}".format(
+        script_path, args, ', '.join('{}({})'.format(data['mech_name'], host)
+                                     for host, data in hosts)), fg="green")
+
+    inventory = tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.py')
+    try:
+        inventory.write('hosts = {!r}\n'.format(hosts))
+        inventory.close()
+        command = ['pyinfra', '--parallel', str(len(hosts)), inventory.name, script_path]
+        LOGGER.debug('About to run this pyinfra command:%s', command)
+        results = subprocess.run(command, capture_output=True)
+    finally:
+        os.unlink(inventory.name)
+    stdout = results.stdout.decode('utf-8')
+    stderr = results.stderr.decode('utf-8')
+    return split_pyinfra_output(results.returncode, stdout, stderr,
+                                {data['mech_name']: host for host, data in hosts})
+
+
+def split_pyinfra_output(return_code, stdout, stderr, hosts):
+    """Split the output of a pyinfra run on several hosts (dict of name to host).
+
+       Lines starting with '[host]' go to that host, the others to all of them.
+       When pyinfra failed, every host gets its return code, except the hosts
+       known to have succeeded (a 'Success' or 'Errors: 0' line, and no error).
+    """
+    names = {host: name for name, host in hosts.items()}
+    lines = {name: [] for name in hosts}
+    failed = set()
+    succeeded = set()
+    for line in stdout.splitlines() + stderr.splitlines():
+        match = re.match(r'^\s*\[([^\]]+)\]', click.unstyle(line))
+        name = names.get(match.group(1)) if match else None
+        for other in [name] if name else hosts:
+            lines[other].append(line)
+        if not name:
+            continue
+        if re.search(r'\bsuccess\b|\berrors:\s*0\b', click.unstyle(line), re.IGNORECASE):
+            succeeded.add(name)
+        elif re.search(r'error|failed', line, re.IGNORECASE):
+            failed.add(name)
+    if return_code != 0:
+        failed = set(hosts) - (succeeded - failed)
+    return {name: (return_code if name in failed else 0, '\n'.join(lines[name]), '')
+            for name in hosts}
 
 
 def pyinfra_installed():
@@ -1476,6 +2678,87 @@ def virtualbox_share_folder_post_boot(inst):
         ssh(instance=inst, command=command)
 
 
+def host_cache_file():
+    """Return the full path of the host capability cache.
+
+       Host capabilities (which 'vmrun -T' host type works, what options
+       'tar' supports, the network interfaces, ...) are the same for every
+       Mechfile, so they are kept in the user's home directory.
+    """
+    return os.path.join(os.path.expanduser('~'), '.mech', 'host_capabilities.json')
+
+
+def load_host_cache():
+    """Load the host capability cache from disk (only once per process).
+       Note: Caller must hold _HOST_CACHE_LOCK.
+    """
+    global _HOST_CACHE
+    if _HOST_CACHE is None:
+        try:
+            with open(host_cache_file()) as the_file:
+                _HOST_CACHE = json.load(the_file)
+        except (IOError, ValueError):
+            _HOST_CACHE = {}
+        if not isinstance(_HOST_CACHE, dict):
+            _HOST_CACHE = {}
+    return _HOST_CACHE
+
+
+def executable_stamp(executable):
+    """Return a list identifying this build of an executable (full path,
+       modification time and size), or None if the executable cannot be found.
+
+       A cached capability is only used while the stamp is unchanged, so
+       moving or upgrading VMware, VirtualBox or tar invalidates it.
+    """
+    if not executable:
+        return None
+    try:
+        stat = os.stat(executable)
+    except (OSError, TypeError, ValueError):
+        return None
+    return [os.path.abspath(executable), stat.st_mtime_ns, stat.st_size]
+
+
+def host_cache_get(key, stamp=None, ttl=None):
+    """Return the cached value for key or None if it is missing or stale.
+
+       Parameters:
+          key(str): name of the capability (ex: 'vmrun_host_type')
+          stamp(list): if provided, must match the stamp saved with the value
+          ttl(int): if provided, max age (in seconds) of the value
+    """
+    with _HOST_CACHE_LOCK:
+        entry = load_host_cache().get(key)
+    if not isinstance(entry, dict):
+        return None
+    if stamp is not None and entry.get('stamp') != stamp:
+        return None
+    if ttl is not None and time.time() - entry.get('time', 0) > ttl:
+        return None
+    LOGGER.debug('host cache hit key:%s value:%s', key, entry.get('value'))
+    return entry.get('value')
+
+
+def host_cache_set(key, value, stamp=None):
+    """Save (or with a value of None, forget) a host capability."""
+    with _HOST_CACHE_LOCK:
+        cache = load_host_cache()
+        if value is None:
+            cache.pop(key, None)
+        else:
+            cache[key] = {'value': value, 'stamp': stamp, 'time': time.time()}
+        path = host_cache_file()
+        makedirs(os.path.dirname(path))
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as the_file:
+                json.dump(cache, the_file, sort_keys=True, indent=2, separators=(',', ': '))
+            os.replace(tmp_path, path)
+        except (IOError, OSError) as exc:
+            LOGGER.debug('could not save host cache:%s', exc)
+
+
 def get_fallback_executable(command_name='vmrun'):
     """Get a fallback executable for a command line tool."""
     if 'PATH' in os.environ:
@@ -1541,6 +2824,13 @@ def get_provider(vmrun_executable):
     if sys.platform == 'darwin':
         return 'fusion'
 
+    # probing forks up to three processes, so remember the answer
+    stamp = executable_stamp(vmrun_executable)
+    if stamp:
+        provider = host_cache_get('vmrun_host_type', stamp=stamp)
+        if provider:
+            return provider
+
     for provider in ['ws', 'player', 'fusion']:
         # To determine the provider, try
         # running the vmrun command to see which one works.
@@ -1557,10 +2847,12 @@ def get_provider(vmrun_executable):
                                     stderr=subprocess.PIPE,
                                     startupinfo=startupinfo)
         except OSError:
-            pass
+            continue
 
         proc.communicate()
         if proc.returncode == 0:
+            if stamp:
+                host_cache_set('vmrun_host_type', provider, stamp=stamp)
             return provider
 
 
@@ -1740,7 +3032,19 @@ def cleanup_dir_and_vms_from_dir(a_dir, names=None, all_vms=False):
 def get_interfaces():
     """Get the network interfaces.
        We may have 'ifconfig' or 'ip' installed.
+       The list is kept in the host cache for HOST_CACHE_TTL seconds.
     """
+    interfaces = host_cache_get('interfaces', ttl=HOST_CACHE_TTL)
+    if interfaces:
+        return interfaces
+    interfaces = probe_interfaces()
+    if interfaces:
+        host_cache_set('interfaces', interfaces)
+    return interfaces
+
+
+def probe_interfaces():
+    """Run 'ifconfig' (or 'ip addr') to find the network interfaces."""
     interfaces = []
 
     # first try "ifconfig"
@@ -1808,6 +3112,58 @@ def instances():
     return list(load_mechfile())
 
 
+def fleet_state(insts, max_workers=16):
+    """Get the ip address and state of many instances with as few provider calls
+       as possible, yielding (inst, ip_address, vm_state) as each one resolves.
+
+       One 'vmrun list' tells which VMware VMs are running and one
+       'VBoxManage list --long vms' gives the state of every VirtualBox VM.
+       Only the ip addresses of running VMs are then queried (concurrently).
+
+    Args:
+        insts (list of MechInstance): the instances
+        max_workers (int): max number of concurrent provider calls
+
+    Notes:
+        ip_address is None if the VM is not running, '' if it is running
+        but the ip address is unknown. Both are None if the VM is not created.
+    """
+    created = [inst for inst in insts if inst.created]
+    for inst in insts:
+        if not inst.created:
+            yield inst, None, None
+
+    if any(inst.provider == 'vmware' for inst in created):
+        running_vmx = VMrun().list_running()
+        if running_vmx is not None:
+            for inst in created:
+                if inst.provider == 'vmware' and inst.vmx:
+                    inst.running = os.path.abspath(inst.vmx) in running_vmx
+
+    if any(inst.provider == 'virtualbox' for inst in created):
+        states = mech.vbm.VBoxManage().list_vm_states()
+        if states is not None:
+            for inst in created:
+                if inst.provider == 'virtualbox':
+                    inst.known_state = states.get(inst.name)
+                    inst.running = inst.known_state in ('running', 'paused')
+
+    def query(inst):
+        """Get the ip and state of one instance."""
+        ip_address = None
+        if inst.running is not False:
+            ip_address = inst.get_ip()
+        return inst, ip_address, inst.get_vm_state()
+
+    if not created:
+        return
+    workers = max(1, min(max_workers, len(created)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(query, inst) for inst in created]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
 def cloud_instances():
     """Return list of cloud instances."""
     return list(load_mechcloudfile())
@@ -30,13 +30,16 @@ import sys
 import re
 import logging
 import subprocess
-import time
 
 from . import utils
+from . import readiness
+from . import ip_pool
 
 
 LOGGER = logging.getLogger('mech')
 
+IP_PROPERTY = '/VirtualBox/GuestInfo/Net/0/V4/IP'
+
 
 class VBoxManage():
     """Interface class for the 'VBoxManage' command.
@@ -82,6 +85,7 @@ class VBoxManage():
         """Execute a command."""
         quiet = kwargs.pop('quiet', False)
         arguments = kwargs.pop('arguments', ())
+        timeout = kwargs.pop('timeout', None)
 
         cmds = [self.executable]
         cmds.append(cmd)
@@ -108,7 +112,13 @@ class VBoxManage():
             stderr=subprocess.PIPE,
             startupinfo=startupinfo,
             text=True)
-        stdoutdata, stderrdata = proc.communicate()
+        try:
+            stdoutdata, stderrdata = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            LOGGER.debug('timed out after %ss', timeout)
+            return None
 
         if stderrdata and not quiet:
             LOGGER.error(stderrdata.strip())
@@ -152,36 +162,65 @@ class VBoxManage():
         return self.run('import', path_to_ovf, '--vsys', '0', '--vmname', name,
                         '--basefolder', base_folder, quiet=quiet)
 
+    def clonevm(self, vmname, name, base_folder, snapshot=None, linked=False, quiet=False):
+        '''Clone a VM (from the snapshot, if given) and register the clone.
+           With linked, the clone only stores its changes to the disks of the snapshot.
+        '''
+        arguments = ['--name', name, '--basefolder', base_folder, '--register']
+        if snapshot:
+            arguments.extend(['--snapshot', snapshot])
+        if linked:
+            arguments.extend(['--options', 'link'])
+        return self.run('clonevm', vmname, quiet=quiet, arguments=arguments)
+
+    def snapshot(self, vmname, snap_name, quiet=False):
+        '''Take a snapshot of a VM'''
+        return self.run('snapshot', vmname, 'take', snap_name, quiet=quiet)
+
+    def hide(self, vmname, quiet=False):
+        '''Hide a VM in the VirtualBox Manager (GUI)'''
+        return self.run('setextradata', vmname, 'GUI/HideFromManager', '1', quiet=quiet)
+
     def _ip(self, vmname, quiet=False):
         """Get ip address of VM."""
-        line = self.run('guestproperty', 'get', vmname,
-                        '/VirtualBox/GuestInfo/Net/0/V4/IP', quiet=quiet)
+        line = self.run('guestproperty', 'get', vmname, IP_PROPERTY, quiet=quiet)
         if line and line != 'No value set!':
             parts = line.split()
             if len(parts) > 1:
                 return parts[1]
 
-    def ip(self, vmname, wait=False, quiet=False):
+    def guestproperty_wait(self, vmname, pattern, timeout, quiet=False):
+        """Wait (at most timeout seconds) for a guest property matching pattern to change."""
+        return self.run('guestproperty', 'wait', vmname, pattern,
+                        '--timeout', '{}'.format(int(timeout * 1000)),
+                        quiet=quiet, timeout=timeout + 5)
+
+    def ip(self, vmname, wait=False, quiet=False, timeout=None):
         """Get ip address of VM.
+           With wait, wait for it (at most timeout seconds, see readiness.wait_until()).
         """
-        ip_address = self._ip(vmname, quiet=quiet)
-        if wait:
-            while True:
+        if not wait:
+            return self._ip(vmname, quiet=quiet)
+
+        def check(time_left):
+            ip_address = self._ip(vmname, quiet=quiet)
+            if not ip_address and time_left > 0:
+                self.guestproperty_wait(vmname, IP_PROPERTY, time_left, quiet=quiet)
                 ip_address = self._ip(vmname, quiet=quiet)
-                if ip_address:
-                    return ip_address
-                time.sleep(1)
-        else:
             return ip_address
 
+        return readiness.wait_until(check, timeout)
+
     def register(self, filename, quiet=False):
         '''Register a VM.
            Note: Probably want to use importvm().
         '''
         return self.run('registervm', filename, quiet=quiet)
 
-    def unregister(self, vmname, quiet=False):
-        '''Unregister a VM (similar to destroy)'''
+    def unregister(self, vmname, delete=False, quiet=False):
+        '''Unregister a VM (similar to destroy), with delete, also delete its files'''
+        if delete:
+            return self.run('unregistervm', vmname, '--delete', quiet=quiet)
         return self.run('unregistervm', vmname, quiet=quiet)
 
     # controlvm                 <uuid|vmname>
@@ -232,14 +271,22 @@ class VBoxManage():
         '''List hostonly interfaces.'''
         return self.run('list', 'hostonlyifs', quiet=quiet)
 
-    def create_hostonly(self, quiet=False):
-        '''Create the stuff needed for hostonly networking to work.'''
-        ifs = self.list_hostonly_ifs()
+    def create_hostonly(self, quiet=False, refresh=False):
+        '''Create the stuff needed for hostonly networking to work.
+           Once the interface and dhcp server exist, that is remembered in the
+           host cache (until VBoxManage changes), unless refresh is True.
+        '''
+        stamp = utils.executable_stamp(self.executable)
+        if stamp and not refresh and utils.host_cache_get('vbox_hostonly', stamp=stamp):
+            return
+        ifs = self.list_hostonly_ifs() or ''
         if re.search(r'vboxnet', ifs, re.MULTILINE) is None:
             self.create_hostonly_if(quiet=quiet)
-        ds = self.list_dhcpservers(quiet=quiet)
+        ds = self.list_dhcpservers(quiet=quiet) or ''
         if re.search(r'vboxnet', ds, re.MULTILINE) is None:
             self.add_hostonly_dhcp(quiet=quiet)
+        if stamp and not self.test_mode:
+            utils.host_cache_set('vbox_hostonly', True, stamp=stamp)
 
     def create_hostonly_if(self, quiet=False):
         '''Create hostonly interface (creates vboxnet0)'''
@@ -249,13 +296,50 @@ class VBoxManage():
         '''Remove hostonly interface (creates vboxnet0)'''
         return self.run('hostonlyif', 'remove', host_interface, quiet=quiet)
 
-    def add_hostonly_dhcp(self, host_interface='vboxnet0', quiet=False):
-        '''Create dhcp on host interface (ex: vboxnet0).'''
+    def add_hostonly_dhcp(self, host_interface='vboxnet0', quiet=False, subnet=None):
+        '''Create dhcp on host interface (ex: vboxnet0).
+           The subnet defaults to 192.168.56.0/24 (see ip_pool.dhcp_settings()).
+        '''
+        settings = ip_pool.dhcp_settings(subnet)
         return self.run('dhcpserver', 'add', '--ifname', host_interface,
-                        '--enable', '--ip', '192.168.56.1', '--netmask', '255.255.255.0',
-                        '--lower-ip', '192.168.56.100', '--upper-ip', '192.168.56.200',
+                        '--enable', '--ip', settings['ip'], '--netmask', settings['netmask'],
+                        '--lower-ip', settings['lower_ip'], '--upper-ip', settings['upper_ip'],
                         quiet=quiet)
 
+    def configure_hostonly(self, subnet, host_interface='vboxnet0', quiet=False):
+        '''Make the host interface (and its dhcp server) use the subnet.
+           Remembered in the host cache (until VBoxManage changes).
+        '''
+        stamp = utils.executable_stamp(self.executable)
+        if stamp and utils.host_cache_get('vbox_hostonly_subnet', stamp=stamp) == subnet:
+            return
+        settings = ip_pool.dhcp_settings(subnet)
+        self.run('hostonlyif', 'ipconfig', host_interface, '--ip', settings['ip'],
+                 '--netmask', settings['netmask'], quiet=quiet)
+        self.run('dhcpserver', 'modify', '--ifname', host_interface,
+                 '--enable', '--ip', settings['ip'], '--netmask', settings['netmask'],
+                 '--lower-ip', settings['lower_ip'], '--upper-ip', settings['upper_ip'],
+                 quiet=quiet)
+        if stamp and not self.test_mode:
+            utils.host_cache_set('vbox_hostonly_subnet', subnet, stamp=stamp)
+
+    def dhcp_fixed_address(self, vmname, address, nic=1, host_interface='vboxnet0',
+                           quiet=False):
+        '''Make the dhcp server of the host interface always give address to the VM.'''
+        return self.run('dhcpserver', 'modify', '--ifname', host_interface,
+                        '--vm', vmname, '--nic', '{}'.format(nic),
+                        '--fixed-address', address, quiet=quiet)
+
+    def dhcp_remove_fixed_address(self, vmname, nic=1, host_interface='vboxnet0', quiet=False):
+        '''Remove the fixed address of the VM from the dhcp server of the host interface.'''
+        return self.run('dhcpserver', 'modify', '--ifname', host_interface,
+                        '--vm', vmname, '--nic', '{}'.format(nic), '--remove-config',
+                        quiet=quiet)
+
+    def guestproperty_set(self, vmname, name, value, quiet=False):
+        '''Set a guest property (the guest can read it with VBoxControl).'''
+        return self.run('guestproperty', 'set', vmname, name, value, quiet=quiet)
+
     def remove_hostonly_dhcp(self, network_name='HostInterfaceNetworking-vboxnet0', quiet=False):
         '''Remove dhcp network.'''
         return self.run('dhcpserver', 'remove', '--network', network_name, quiet=quiet)
@@ -291,10 +375,43 @@ class VBoxManage():
         '''List all VMs'''
         return self.run('list', 'vms', quiet=quiet)
 
+    def list_vm_states(self, quiet=True):
+        '''Return a dict of vm name to state (ex: 'running', 'powered off') for all
+           VMs using a single 'list vms --long', or None if they could not be listed.
+        '''
+        if not self.installed():
+            return None
+        output = self.run('list', '--long', 'vms', quiet=quiet)
+        if output is None or not isinstance(output, str):
+            return None
+        states = {}
+        name = None
+        for line in output.split('\n'):
+            # Note: shared folders are also listed as "Name: 'share', Host path: ..."
+            matches = re.match(r"Name:\s+([^'].*?)\s*$", line)
+            if matches:
+                name = matches.group(1)
+                continue
+            matches = re.match(r'State:\s+(.*?)\s*\(', line)
+            if matches and name is not None:
+                states[name] = matches.group(1)
+                name = None
+        LOGGER.debug('states:%s', states)
+        return states
+
     def get_vm_info(self, vmname, quiet=False):
         '''Return the show VM info'''
         return self.run('showvminfo', vmname, quiet=quiet)
 
+    def mac_address(self, vmname, nic=1, quiet=False):
+        '''Return the MAC address of a network adapter of the VM (ex: '0800279D5E2F').'''
+        vm_info = self.run('showvminfo', vmname, '--machinereadable', quiet=quiet)
+        if vm_info:
+            matches = re.search(r'^macaddress{}="([0-9A-Fa-f]+)"'.format(nic), vm_info,
+                                re.MULTILINE)
+            if matches:
+                return matches.group(1)
+
     def vm_state(self, vmname, quiet=False):
         '''Return the first word from the showvminfo output line that starts with "State:".'''
         vm_info = self.get_vm_info(vmname, quiet=quiet)
@@ -304,9 +421,11 @@ class VBoxManage():
                 return matches.group(1).strip()
 
     def list_running(self, quiet=False):
-        '''List all running VMs'''
+        '''List all running VMs (None if VBoxManage failed)'''
         running_vms = []
         output = self.run('list', 'runningvms', quiet=quiet)
+        if output is None:
+            return None
         each_line = output.split('\n')
         LOGGER.debug('each_line:%s', each_line)
         for line in each_line:
@@ -28,15 +28,104 @@ from __future__ import absolute_import
 import os
 import sys
 import re
+import json
 import logging
 import subprocess
 import tempfile
+import threading
 
 from . import utils
+from . import readiness
 
 
 LOGGER = logging.getLogger('mech')
 
+# lines of vmware.log telling the state of the VM (the last one found wins)
+VM_STATE_LINES = re.compile(
+    br'(?P<started>Reporting power state change \(opcode=2, err=0\))'  # could also be "reset"
+    br'|(?P<stopped>VMX exit \(0\))'  # could also be "suspend"
+    br'|(?P<unpaused>VMAutomation_Pause: pause = FALSE)'
+    br'|(?P<paused>VMAutomation_Pause: pause = TRUE)')
+LOG_BLOCK_SIZE = 64 * 1024
+# saved next to vmware.log, so the log is only read again when it changes
+VM_STATE_FILE = 'mech-vm-state.json'
+
+_VM_STATES = {}
+_VM_STATES_LOCK = threading.Lock()
+
+
+def last_match(path, pattern, block_size=LOG_BLOCK_SIZE):
+    """Return the last match of pattern (bytes) in a file of lines, None if there is none.
+
+       The file is read backwards from the end, one block at a time.
+    """
+    with open(path, 'rb') as the_file:
+        end = the_file.seek(0, os.SEEK_END)
+        partial = b''
+        while end > 0:
+            start = max(end - block_size, 0)
+            the_file.seek(start)
+            block = the_file.read(end - start) + partial
+            end = start
+            partial = b''
+            if start > 0:
+                # the first line of the block may begin in the previous block
+                cut = block.find(b'\n')
+                if cut < 0:
+                    partial = block
+                    continue
+                partial, block = block[:cut], block[cut:]
+            match = None
+            for match in pattern.finditer(block):
+                pass
+            if match is not None:
+                return match
+    return None
+
+
+def vmware_log_state(vmware_log):
+    """Return the state of the VM found in its vmware.log ('unknown' if none is).
+
+       The state is cached (in memory and in VM_STATE_FILE) with the inode,
+       size and modification time of the log, so when it did not change it
+       costs one stat.
+    """
+    try:
+        stat = os.stat(vmware_log)
+    except OSError:
+        return 'unknown'
+    stamp = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+    with _VM_STATES_LOCK:
+        cached = _VM_STATES.get(vmware_log)
+    if cached is None:
+        try:
+            with open(os.path.join(os.path.dirname(vmware_log), VM_STATE_FILE)) as the_file:
+                cached = json.load(the_file)
+        except (OSError, ValueError):
+            cached = None
+    if isinstance(cached, dict) and cached.get('stamp') == stamp:
+        with _VM_STATES_LOCK:
+            _VM_STATES[vmware_log] = cached
+        return cached.get('state')
+
+    try:
+        match = last_match(vmware_log, VM_STATE_LINES)
+    except OSError:
+        return 'unknown'
+    state = match.lastgroup if match else 'unknown'
+    cached = {'stamp': stamp, 'state': state}
+    with _VM_STATES_LOCK:
+        _VM_STATES[vmware_log] = cached
+    state_file = os.path.join(os.path.dirname(vmware_log), VM_STATE_FILE)
+    try:
+        tmp_file = '{}.{}.tmp'.format(state_file, os.getpid())
+        with open(tmp_file, 'w') as the_file:
+            json.dump(cached, the_file)
+        os.replace(tmp_file, state_file)
+    except OSError as exc:
+        LOGGER.debug('could not save vm state: %s', exc)
+    return state
+
 
 class VMrun():  # pylint: disable=too-many-public-methods
     """Interface class for the 'vmrun' command.
@@ -86,6 +175,7 @@ class VMrun():  # pylint: disable=too-many-public-methods
         """Execute a 'vmrun' command."""
         quiet = kwargs.pop('quiet', False)
         arguments = kwargs.pop('arguments', ())
+        timeout = kwargs.pop('timeout', None)
 
         cmds = [self.executable]
         cmds.append('-T')
@@ -120,7 +210,13 @@ class VMrun():  # pylint: disable=too-many-public-methods
             stderr=subprocess.PIPE,
             startupinfo=startupinfo,
             text=True)
-        stdoutdata, stderrdata = proc.communicate()
+        try:
+            stdoutdata, stderrdata = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            LOGGER.debug('timed out after %ss', timeout)
+            return None
 
         if stderrdata and not quiet:
             LOGGER.error(stderrdata.strip())
@@ -560,8 +656,10 @@ class VMrun():  # pylint: disable=too-many-public-methods
         '''Read a variable in the VM state'''
         return self.vmrun('readVariable', self.vmx_file, mode, var_name, quiet=quiet)
 
-    def get_guest_ip_address(self, wait=True, quiet=False, lookup=False):
-        '''Gets the IP address of the guest'''
+    def get_guest_ip_address(self, wait=True, quiet=False, lookup=False, timeout=None):
+        '''Gets the IP address of the guest
+           With wait, wait for it (at most timeout seconds, see readiness.wait_until()).
+        '''
         if lookup is True:
             guest_tmp_filename = '/tmp/.ip_address'
             cmd = "ifconfig | grep -Eo 'inet (addr:)?([0-9]*\\.){3}[0-9]*'"
@@ -584,9 +682,15 @@ class VMrun():  # pylint: disable=too-many-public-methods
                     return None
             finally:
                 os.unlink(temp_file.name)
+        elif wait:
+            def check(time_left):
+                ip_address = self.vmrun('getGuestIPAddress', self.vmx_file, '-wait',
+                                        quiet=quiet, timeout=time_left)
+                return ip_address if ip_address != 'unknown' else None
+
+            ip_address = readiness.wait_until(check, timeout)
         else:
-            ip_address = self.vmrun('getGuestIPAddress', self.vmx_file,
-                                    '-wait' if wait else None, quiet=quiet)
+            ip_address = self.vmrun('getGuestIPAddress', self.vmx_file, quiet=quiet)
             if ip_address == 'unknown':
                 ip_address = ''
         return ip_address
@@ -614,6 +718,23 @@ class VMrun():  # pylint: disable=too-many-public-methods
         '''List all running VMs'''
         return self.vmrun('list', self.vmx_file, quiet=quiet)
 
+    def list_running(self, quiet=True):
+        '''Return the (absolute) paths of the vmx files of all running VMs
+           or None if they could not be listed.
+        '''
+        if not self.installed():
+            return None
+        output = self.vmrun('list', quiet=quiet)
+        if output is None or not isinstance(output, str):
+            return None
+        running = []
+        for line in output.split('\n'):
+            line = line.strip()
+            if line and not line.startswith('Total running VMs'):
+                running.append(os.path.abspath(line))
+        LOGGER.debug('running:%s', running)
+        return running
+
     def upgradevm(self, quiet=False):
         '''Upgrade VM file format, virtual hw.
            Note: The vm must be stopped before running this command.
@@ -647,9 +768,16 @@ class VMrun():  # pylint: disable=too-many-public-methods
         '''Delete a VM'''
         return self.vmrun('deleteVM', self.vmx_file, quiet=quiet)
 
-    def clone(self, dest_vmx, mode, snap_name=None, quiet=False):
-        '''Create a copy of the VM'''
-        return self.vmrun('clone', self.vmx_file, dest_vmx, mode, snap_name, quiet=quiet)
+    def clone(self, dest_vmx, mode, snap_name=None, clone_name=None, quiet=False):
+        '''Create a copy of the VM (mode is 'full' or 'linked')'''
+        return self.vmrun(
+            'clone',
+            self.vmx_file,
+            dest_vmx,
+            mode,
+            '-snapshot={}'.format(snap_name) if snap_name else None,
+            '-cloneName={}'.format(clone_name) if clone_name else None,
+            quiet=quiet)
 
     ############################################################################
     # RECORD/REPLAY COMMANDS   PARAMETERS           DESCRIPTION
@@ -746,20 +874,10 @@ class VMrun():  # pylint: disable=too-many-public-methods
            Note: This is totally a hack as the VMware vmrun api does not provide much of
                  this info.
 
-           Look in the vmware.log in same dir as .vmx file.
-           Read file in reverse order until we find one of these strings
-
+           Look in the vmware.log in same dir as .vmx file, for the last
+           of the lines in VM_STATE_LINES (see vmware_log_state()).
         '''
         if self.vmx_file:
             vmware_log = os.path.join(os.path.dirname(self.vmx_file), "vmware.log")
-            if os.path.isfile(vmware_log):
-                for line in reversed(list(open(vmware_log))):
-                    if re.search(r"Reporting power state change \(opcode=2, err=0\)", line):
-                        return "started"  # could also be "reset"
-                    if re.search(r"VMX exit \(0\)", line):
-                        return "stopped"  # could also be "suspend"
-                    if re.search("VMAutomation_Pause: pause = FALSE", line):
-                        return "unpaused"
-                    if re.search("VMAutomation_Pause: pause = TRUE", line):
-                        return "paused"
-            return 'unknown'
+            return vmware_log_state(vmware_log)
+        return 'unknown'